@@ -24,6 +24,10 @@ volatile uint8_t ledCounter = 260 / 10; // 300 ms, this variable is used in a tr
 
 volatile uint16_t intervalCount;
 
+volatile COUNTS_VAR_TYPE history[HISTORY_LENGTH];
+volatile uint8_t historySequence = 0;
+volatile uint8_t historyStored = 0;
+
 void counter_init() {
 	// pin change interrupt
 	PCMSK1 |= (1 << PCINT10);
@@ -64,4 +68,12 @@ ISR(TIM0_COMPA_vect, ISR_NOBLOCK) {
 	intervalCount = programmedInterval;
 	countsPerInterval = actualCounts;
 	actualCounts = 0;
+
+	// the entry is written before the sequence number changes, see USB_RQ_GET_HISTORY
+	uint8_t sequence = historySequence + 1;
+	history[sequence % HISTORY_LENGTH] = countsPerInterval;
+	historySequence = sequence;
+	if (historyStored < HISTORY_LENGTH) {
+		historyStored++;
+	}
 }
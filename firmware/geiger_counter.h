@@ -21,6 +21,17 @@ extern volatile COUNTS_VAR_TYPE actualCounts;
 extern volatile uint16_t programmedInterval;
 extern volatile uint16_t intervalCount;
 
+/**
+ * The counts of the last HISTORY_LENGTH intervals. The count of the interval with sequence number n is stored at
+ * history[n % HISTORY_LENGTH]; historySequence is the number of the latest completed interval and historyStored
+ * tells how many of the entries are valid, it's cleared when the interval is changed.
+ */
+#define HISTORY_LENGTH 8
+
+extern volatile COUNTS_VAR_TYPE history[HISTORY_LENGTH];
+extern volatile uint8_t historySequence;
+extern volatile uint8_t historyStored;
+
 // ledCounter is also used in main()
 extern volatile uint8_t ledCounter;
 
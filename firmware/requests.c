@@ -7,6 +7,7 @@
  */
 
 #include "global.h"
+#include <util/atomic.h>
 #include "usbdrv.h"
 #include "requests.h"
 
@@ -18,6 +19,25 @@ usbMsgLen_t usbFunctionSetup(uchar data[8]) {
 
 	static uint16_t result;
 
+	// only one response is sent at a time, so they share the memory
+	static union {
+		struct {
+			uint16_t cpi;
+			uint16_t interval;
+			uint16_t voltage;
+			uint8_t countAcknowledged;
+		} snapshot;
+		struct {
+			uint8_t sequence;
+			uint8_t count;
+			uint16_t interval;
+			uint16_t voltage;
+			COUNTS_VAR_TYPE counts[HISTORY_LENGTH];
+		} history;
+	} reply;
+
+	uint8_t sequence, count, i;
+
 	if ((rq->bmRequestType & USBRQ_TYPE_MASK) != USBRQ_TYPE_VENDOR) {
 		return 0;
 	}
@@ -38,12 +58,45 @@ usbMsgLen_t usbFunctionSetup(uchar data[8]) {
 		result = uncheckedCount;
 		uncheckedCount = false;
 		return 2;
+	case USB_RQ_GET_SNAPSHOT:
+		ATOMIC_BLOCK(ATOMIC_RESTORESTATE) {
+			reply.snapshot.cpi = countsPerInterval;
+			reply.snapshot.interval = programmedInterval;
+		}
+		reply.snapshot.voltage = GEIGER_ACTUAL_VOLTAGE;
+		reply.snapshot.countAcknowledged = uncheckedCount;
+		if (rq->wValue.bytes[0]) {
+			uncheckedCount = false;
+		}
+		usbMsgPtr = (unsigned short) &reply.snapshot;
+		return sizeof(reply.snapshot);
+	case USB_RQ_GET_HISTORY:
+		// copying the counts with interrupts disabled would delay the USB interrupt too long; instead the copy
+		// is repeated if an interval ended meanwhile, the timer interrupt changes the sequence number after the entry
+		do {
+			sequence = historySequence;
+			count = rq->wValue.bytes[1] ? historyStored : (uint8_t) (sequence - rq->wValue.bytes[0]);
+			if (count > historyStored) {
+				count = historyStored;
+			}
+			for (i = 0; i < count; i++) {
+				reply.history.counts[i] = history[(uint8_t) (sequence - count + 1 + i) % HISTORY_LENGTH];
+			}
+			reply.history.interval = programmedInterval;
+		} while (sequence != historySequence);
+		reply.history.sequence = sequence;
+		reply.history.count = count;
+		reply.history.voltage = GEIGER_ACTUAL_VOLTAGE;
+		usbMsgPtr = (unsigned short) &reply.history;
+		return 6 + count * sizeof(COUNTS_VAR_TYPE);
 	case USB_RQ_SET_VOLTAGE:
 		programmedVoltage = rq->wValue.bytes[1] << 8 | rq->wValue.bytes[0];
 		return 0;
 	case USB_RQ_SET_INTERVAL:
 		intervalCount = programmedInterval =  rq->wValue.bytes[1] << 8 | rq->wValue.bytes[0];
 		actualCounts = countsPerInterval = 0;
+		// counts of the intervals of different length can't be compared
+		historyStored = 0;
 		return 0;
 	};
 
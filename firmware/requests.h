@@ -30,4 +30,21 @@
  */
 #define USB_RQ_ACKNOWLEDGE_UNCHECKED_COUNT 40
 
+/**
+ * Returns CPI, programmed interval, actual voltage and the unchecked count flag in one transfer. The layout is:
+ * uint16_t CPI, uint16_t interval, uint16_t voltage, uint8_t flag, all little-endian. If wValue is non-zero, the flag
+ * is cleared like in USB_RQ_ACKNOWLEDGE_UNCHECKED_COUNT. CPI and interval are taken atomically, so they come from
+ * the same interval.
+ */
+#define USB_RQ_GET_SNAPSHOT 50
+
+/**
+ * Returns the counts of the intervals completed since the interval with sequence number given in the lower byte of
+ * wValue, or all stored ones if the upper byte is non-zero. The layout is: uint8_t sequence number of the latest
+ * interval, uint8_t number of the counts, uint16_t programmed interval, uint16_t actual voltage, then the counts
+ * as uint16_t, the oldest first, all little-endian. At most HISTORY_LENGTH counts are kept; the sequence number
+ * wraps at 256.
+ */
+#define USB_RQ_GET_HISTORY 60
+
 #endif /* __REQUESTS_H_INCLUDED__ */
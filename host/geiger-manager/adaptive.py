@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import ConfigParser
+import usbcomm
+
+# default settings, can be changed in [adaptive] section
+DEFAULT_MIN_INTERVAL = 5
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_PRECISION = 0.1
+DEFAULT_PATIENCE = 3
+
+class AdaptiveException(Exception):
+	pass
+
+class IntervalController(object):
+	"""Chooses the measuring interval of one device from its count rate. The counts of an interval have relative
+	standard deviation 1 / sqrt(counts), so for the wanted 'precision' each interval should collect 1 / precision^2
+	counts: at high radiation the interval gets shorter and a rise is reported sooner, at background level it gets
+	longer and the device is read less often. The intervals are min_interval multiplied by powers of two, up to
+	max_interval, so small changes of the rate don't reprogram the device. Setting the interval restarts counting,
+	so a shorter one is taken at once, but a longer one only after 'patience' reads in a row asked for it.
+	"""
+
+	_intervals = None
+	_wantedCounts = None
+	_patience = None
+	_longer = 0
+
+	def __init__(self, minInterval = DEFAULT_MIN_INTERVAL, maxInterval = DEFAULT_MAX_INTERVAL,
+			precision = DEFAULT_PRECISION, patience = DEFAULT_PATIENCE):
+		if minInterval < 1 or maxInterval < minInterval or maxInterval > usbcomm.MAX_INTERVAL:
+			raise AdaptiveException("intervals have to satisfy 1 <= min_interval <= max_interval <= %d"
+				% usbcomm.MAX_INTERVAL)
+		if not 0.0 < precision < 1.0:
+			raise AdaptiveException("precision has to be between 0 and 1")
+
+		self._intervals = []
+		interval = minInterval
+		while interval < maxInterval:
+			self._intervals.append(interval)
+			interval *= 2
+		self._intervals.append(maxInterval)
+		self._wantedCounts = 1.0 / precision ** 2
+		self._patience = max(1, patience)
+
+	@classmethod
+	def fromConfiguration(cls, configuration):
+		"Creates the controller if it's enabled in [adaptive] section, otherwise returns None."
+		confFileSection = 'adaptive'
+		try:
+			if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+				return None
+
+			def option(name, default, getter = configuration.getint):
+				if configuration.has_option(confFileSection, name):
+					return getter(confFileSection, name)
+				return default
+
+			return cls(option('min_interval', DEFAULT_MIN_INTERVAL), option('max_interval', DEFAULT_MAX_INTERVAL),
+				option('precision', DEFAULT_PRECISION, configuration.getfloat), option('patience', DEFAULT_PATIENCE))
+		except (ConfigParser.Error, ValueError) as e:
+			raise AdaptiveException("wrong adaptive interval settings: " + str(e))
+
+	def getIntervals(self):
+		"Returns the list of the intervals the controller chooses from, in seconds."
+		return list(self._intervals)
+
+	def wantedInterval(self, cpm):
+		"Returns the shortest allowed interval collecting the wanted number of counts at given CPM."
+		for interval in self._intervals:
+			if cpm / 60.0 * interval >= self._wantedCounts:
+				return interval
+		return self._intervals[-1]
+
+	def update(self, interval, cpm):
+		"""Takes the current interval of the device and CPM of its latest measurement. Returns the new interval,
+		or None if it should stay.
+		"""
+		wanted = self.wantedInterval(cpm)
+		if wanted < interval:
+			self._longer = 0
+			return wanted
+		if wanted == interval:
+			self._longer = 0
+			return None
+
+		self._longer += 1
+		if self._longer < self._patience:
+			return None
+		self._longer = 0
+		return wanted
+
+	def reset(self):
+		"Forgets the reads which asked for a longer interval, e.g. after the device was programmed again."
+		self._longer = 0
@@ -0,0 +1,380 @@
+#!/usr/bin/python2
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import argparse
+import calendar
+import ConfigParser
+import csv
+import json
+import threading
+import time
+import numpy
+import clock
+import rollup
+import usbcomm
+
+# records of the measurements: time in seconds since epoch (UTC), device number, CPM, radiation in uSv/h;
+# the same fields as in the binary archive
+RECORD_DTYPE = numpy.dtype([('time', '<i4'), ('device', '<u2'), ('cpm', '<f4'), ('radiation', '<f4')])
+
+# default settings, can be changed in [analytics] section; dead_time is read like tube_sensitivity from [device]
+DEFAULT_WINDOW = 10
+DEFAULT_HISTORY = 10000
+DEFAULT_DEAD_TIME = 0.0
+
+# inferIntervals() takes longer gaps between the measurements for breaks of the monitor
+DEFAULT_GAP_FACTOR = 3.0
+
+# lengths of the windows of the dose reported by OnlineAnalytics, in seconds
+DOSE_WINDOWS = (('doseHour', 3600), ('doseDay', 86400))
+
+class AnalyticsException(Exception):
+	pass
+
+def toRadiation(cpm, sensitivity = usbcomm.TUBE_SENSITIVITY):
+	"""Converts CPM to radiation in uSv/h, like usbcomm.Connector.getRadiation(), but without rounding. Both arguments
+	can be arrays; for per-device calibration pass the array of sensitivities indexed by the device numbers, e.g.
+	sensitivities[records['device']].
+	"""
+	return numpy.asarray(cpm, numpy.float64) * (10.0 / 60.0) / sensitivity
+
+def correctDeadTime(cpm, deadTime):
+	"""Returns CPM corrected for the counts lost while the tube was dead after a count, deadTime seconds long
+	(non-paralyzable model). The result is NaN where the measured rate is impossible for that dead time.
+	"""
+	cpm = numpy.asarray(cpm, numpy.float64)
+	loss = 1.0 - cpm / 60.0 * deadTime
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		return numpy.where(loss > 0.0, cpm / loss, numpy.nan)
+
+def poissonBounds(counts, confidence = rollup.DEFAULT_CONFIDENCE):
+	"""Returns the tuple of arrays: lower and upper confidence bounds of the mean of Poisson distribution given
+	the observed counts. Byar's approximation like rollup.poissonBounds().
+	"""
+	z = rollup.normalQuantile(0.5 + confidence / 2.0)
+	counts = numpy.asarray(counts, numpy.float64)
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		lower = counts * (1.0 - 1.0 / (9.0 * counts) - z / (3.0 * numpy.sqrt(counts))) ** 3
+	lower = numpy.where(counts > 0.0, numpy.maximum(lower, 0.0), 0.0)
+	upper = (counts + 1.0) * (1.0 - 1.0 / (9.0 * (counts + 1.0)) + z / (3.0 * numpy.sqrt(counts + 1.0))) ** 3
+	return (lower, upper)
+
+def cpmBounds(cpm, interval, confidence = rollup.DEFAULT_CONFIDENCE):
+	"""Returns the tuple of arrays: lower and upper confidence bounds of CPM measured during interval seconds.
+	interval can be an array, e.g. the sum of intervals when cpm is the mean of many measurements.
+	"""
+	perMinute = 60.0 / numpy.asarray(interval, numpy.float64)
+	lower, upper = poissonBounds(numpy.asarray(cpm, numpy.float64) / perMinute, confidence)
+	return (lower * perMinute, upper * perMinute)
+
+def movingAverage(values, window):
+	"Returns the array of means of the last 'window' values at each position; fewer at the beginning."
+	values = numpy.asarray(values, numpy.float64)
+	sums = numpy.cumsum(values)
+	sums[window:] = sums[window:] - sums[:-window]
+	return sums / numpy.minimum(numpy.arange(1, len(values) + 1), window)
+
+def inferIntervals(times, devices = None, gapFactor = DEFAULT_GAP_FACTOR):
+	"""Returns the measuring interval of each record, in seconds: the time since the previous record of the same
+	device. The first record of each device, and each record after a gap longer than gapFactor times the median
+	interval, e.g. when the monitor wasn't running, gets the median interval of that device. The records must be
+	sorted by time. Use it if the interval isn't known, e.g. for archives written with different intervals.
+	"""
+	times = numpy.asarray(times, numpy.float64)
+	if devices is None:
+		devices = numpy.zeros(len(times), numpy.uint16)
+	intervals = numpy.empty(len(times))
+	# stable sort keeps time order within each device
+	order = numpy.argsort(devices, kind = 'mergesort')
+	sortedDevices = devices[order]
+	gaps = numpy.diff(times[order])
+	starts = numpy.concatenate(([True], sortedDevices[1:] != sortedDevices[:-1]))
+	byDevice = numpy.empty(len(times))
+	byDevice[1:] = gaps
+	firsts = numpy.nonzero(starts)[0]
+	for first, last in zip(firsts, numpy.append(firsts[1:], len(times))):
+		if last - first > 1:
+			own = byDevice[first + 1:last]
+			median = numpy.median(own)
+			own[own > gapFactor * median] = median
+			byDevice[first] = median
+		else:
+			byDevice[first] = numpy.nan
+	intervals[order] = byDevice
+	return intervals
+
+def cumulativeDose(radiation, intervals):
+	"Returns the array of dose in uSv accumulated up to each measurement; intervals in seconds, array or scalar."
+	return numpy.cumsum(numpy.asarray(radiation, numpy.float64) * intervals / 3600.0)
+
+def doseInWindows(times, radiation, intervals, edges):
+	"""Returns the array of doses in uSv in the windows [edges[i], edges[i + 1]), by the time of the measurements.
+	The records must be sorted by time; edges must be increasing. Costs one pass over the records and a binary
+	search for each edge, so any number of windows can be taken.
+	"""
+	dose = numpy.concatenate(([0.0], cumulativeDose(radiation, intervals)))
+	positions = numpy.searchsorted(numpy.asarray(times), numpy.asarray(edges), 'left')
+	return numpy.diff(dose[positions])
+
+
+class Calibration(object):
+	"Tube sensitivity and dead time of one device."
+
+	__slots__ = ('sensitivity', 'deadTime')
+
+	def __init__(self, sensitivity = usbcomm.TUBE_SENSITIVITY, deadTime = DEFAULT_DEAD_TIME):
+		self.sensitivity = sensitivity
+		self.deadTime = deadTime
+
+	@classmethod
+	def fromConfiguration(cls, configuration, deviceId):
+		"""Reads 'tube_sensitivity' and 'dead_time' from the section 'device:<ID>', then from 'device'. Missing
+		options get default values.
+		"""
+		def option(name, default):
+			for section in ('device:' + str(deviceId), 'device'):
+				if configuration.has_option(section, name):
+					return configuration.getfloat(section, name)
+			return default
+
+		try:
+			return cls(option('tube_sensitivity', usbcomm.TUBE_SENSITIVITY), option('dead_time', DEFAULT_DEAD_TIME))
+		except (ConfigParser.Error, ValueError) as e:
+			raise AnalyticsException("wrong calibration of device %s: %s" % (deviceId, str(e)))
+
+
+def loadArchive(fileName, start = None, end = None):
+	"""Returns the tuple: records from the binary archive (see updaters.binary), optionally only with time in
+	[start, end), as RECORD_DTYPE array, and the list of device IDs indexed by the device field.
+	"""
+	import updaters.binary
+
+	reader = updaters.binary.BinaryArchiveReader(fileName)
+	try:
+		if start is None and end is None:
+			source = reader.getAll()
+		else:
+			source = reader.getRange(start if start is not None else -2 ** 31, end if end is not None else 2 ** 31 - 1)
+		records = numpy.empty(len(source), RECORD_DTYPE)
+		for field in RECORD_DTYPE.names:
+			records[field] = source[field]
+		return (records, reader.getDevices())
+	finally:
+		reader.close()
+
+def loadCsv(fileName, dateFormat = '%Y-%m-%d', timeFormat = '%H:%M:%S', decimalSeparator = '.', delimiter = ','):
+	"""Returns the tuple: records from the CSV file written by the csvfile updater, or its rotated segment, as
+	RECORD_DTYPE array, and the list of device IDs indexed by the device field. The date and time are converted from
+	local time with the current UTC offset, like the updater wrote them. Distinct dates and times are parsed only
+	once, which keeps it fast.
+	"""
+	offset = calendar.timegm(time.localtime()) - calendar.timegm(time.gmtime())
+	dates = {}
+	times = {}
+	devices = {}
+	columns = ([], [], [], [])
+
+	import updaters.csvfile
+
+	with updaters.csvfile.openSegment(fileName) as handle:
+		for row in csv.reader(handle, delimiter = delimiter):
+			if len(row) < 4 or row[0].endswith(':'):
+				continue
+			date = dates.get(row[0])
+			if date is None:
+				date = dates[row[0]] = calendar.timegm(time.strptime(row[0], dateFormat)) - offset
+			seconds = times.get(row[1])
+			if seconds is None:
+				parsed = time.strptime(row[1], timeFormat)
+				seconds = times[row[1]] = parsed.tm_hour * 3600 + parsed.tm_min * 60 + parsed.tm_sec
+			deviceId = row[4] if len(row) > 4 else ''
+			columns[0].append(date + seconds)
+			columns[1].append(devices.setdefault(deviceId, len(devices)))
+			columns[2].append(row[3])
+			columns[3].append(row[2])
+
+	records = numpy.empty(len(columns[0]), RECORD_DTYPE)
+	records['time'] = columns[0]
+	records['device'] = columns[1]
+	for field, column in (('cpm', columns[2]), ('radiation', columns[3])):
+		values = numpy.array(column)
+		if decimalSeparator != '.':
+			values = numpy.char.replace(values, decimalSeparator, '.')
+		records[field] = values.astype(numpy.float64)
+
+	# rows of many devices written by separate threads can be slightly out of order
+	records = records[numpy.argsort(records['time'], kind = 'mergesort')]
+	return (records, sorted(devices, key = devices.get))
+
+def summarize(records, devices, edges = None, confidence = rollup.DEFAULT_CONFIDENCE):
+	"""Returns the dictionary by device ID with: samples, mean CPM and radiation with confidence bounds of CPM,
+	maximal radiation and the dose in uSv, in total and, if edges are given, in windows between them.
+	"""
+	summary = {}
+	for number, deviceId in enumerate(devices):
+		own = records[records['device'] == number]
+		if len(own) == 0:
+			continue
+		intervals = inferIntervals(own['time'])
+		if numpy.isnan(intervals).all():
+			intervals[:] = 0.0
+		exposure = numpy.nansum(intervals)
+		meanCPM = float(numpy.dot(own['cpm'], numpy.nan_to_num(intervals)) / exposure) if exposure > 0 else None
+		lower, upper = cpmBounds(meanCPM, exposure, confidence) if meanCPM is not None else (None, None)
+		entry = {'samples' : len(own), 'meanCPM' : meanCPM, 'cpmLower' : float(lower) if lower is not None else None,
+			'cpmUpper' : float(upper) if upper is not None else None,
+			'meanRadiation' : float(own['radiation'].mean()), 'maxRadiation' : float(own['radiation'].max()),
+			'dose' : float(cumulativeDose(own['radiation'], numpy.nan_to_num(intervals))[-1])}
+		if edges is not None:
+			entry['windows'] = doseInWindows(own['time'], own['radiation'], numpy.nan_to_num(intervals), edges).tolist()
+		summary[deviceId] = entry
+	return summary
+
+
+class OnlineAnalytics(object):
+	"""Keeps the last 'history' measurements of each device in preallocated arrays and computes on request: dose
+	since the start and in the last hour and day (as far as the history reaches), moving mean of radiation and
+	confidence bounds of CPM over the last 'window' measurements, and CPM corrected for the dead time. add() only
+	stores the values, so it can be a listener of the monitor (see monitor.Monitor.addListener()). The means are
+	weighted by the intervals of the measurements, which can differ if the interval is adaptive; 'interval' is
+	used for the measurements which come without it.
+	"""
+
+	_interval = None
+	_window = None
+	_history = None
+	_confidence = None
+	_calibrations = None
+	_devices = None
+	_lock = None
+
+	def __init__(self, deviceIds, interval, calibrations = None, window = DEFAULT_WINDOW, history = DEFAULT_HISTORY,
+			confidence = rollup.DEFAULT_CONFIDENCE):
+		self._interval = float(interval)
+		self._window = window
+		self._history = max(history, window)
+		self._confidence = confidence
+		self._calibrations = calibrations if calibrations is not None else {}
+		self._lock = threading.Lock()
+		self._devices = {}
+		for deviceId in deviceIds:
+			# times, CPM, radiation, intervals, number of stored measurements, total dose
+			self._devices[deviceId] = [numpy.zeros(self._history), numpy.zeros(self._history),
+				numpy.zeros(self._history), numpy.zeros(self._history), 0, 0.0]
+
+	@classmethod
+	def fromConfiguration(cls, configuration, deviceIds, interval):
+		"Creates the analytics if it's enabled in [analytics] section, otherwise returns None."
+		confFileSection = 'analytics'
+		try:
+			if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+				return None
+
+			def option(name, default, getter = configuration.getint):
+				if configuration.has_option(confFileSection, name):
+					return getter(confFileSection, name)
+				return default
+
+			window = max(1, option('window', DEFAULT_WINDOW))
+			history = option('history', DEFAULT_HISTORY)
+			confidence = rollup.DEFAULT_CONFIDENCE
+			if configuration.has_option('monitor', 'confidence'):
+				confidence = configuration.getfloat('monitor', 'confidence')
+		except (ConfigParser.Error, ValueError) as e:
+			raise AnalyticsException("wrong analytics settings: " + str(e))
+
+		calibrations = dict((deviceId, Calibration.fromConfiguration(configuration, deviceId)) for deviceId in deviceIds)
+		return cls(deviceIds, interval, calibrations, window, history, confidence)
+
+	def add(self, deviceId, timestamp, measurement, interval = None):
+		"Stores the measurement (usbcomm.Measurement) taken at UTC time_struct during interval seconds."
+		interval = float(interval) if interval is not None else self._interval
+		with self._lock:
+			device = self._devices.get(deviceId)
+			if device is None:
+				return
+			times, cpms, radiations, intervals, count, dose = device
+			position = count % self._history
+			times[position] = calendar.timegm(timestamp)
+			cpms[position] = measurement.cpm
+			radiations[position] = measurement.radiation
+			intervals[position] = interval
+			device[4] = count + 1
+			device[5] = dose + measurement.radiation * interval / 3600.0
+
+	def getStatistics(self, deviceId, now = None):
+		"""Returns the dictionary with: dose - uSv since the start, doseHour, doseDay - uSv in the last hour and day,
+		meanRadiation, meanCPM, cpmLower, cpmUpper - over the last 'window' measurements, correctedCPM - the last
+		CPM corrected for the dead time, None if it's impossible. Returns None if the device has no measurements.
+		"""
+		with self._lock:
+			device = self._devices.get(deviceId)
+			if device is None or device[4] == 0:
+				return None
+			times, cpms, radiations, intervals, count, dose = device
+			stored = min(count, self._history)
+			# oldest first
+			order = (numpy.arange(stored) + count - stored) % self._history
+			times, cpms, radiations, intervals = times[order], cpms[order], radiations[order], intervals[order]
+
+		calibration = self._calibrations.get(deviceId, Calibration())
+		now = now if now is not None else time.time()
+		recent = min(self._window, stored)
+		exposure = intervals[-recent:].sum()
+		meanCPM = float(numpy.dot(cpms[-recent:], intervals[-recent:]) / exposure)
+		lower, upper = cpmBounds(meanCPM, exposure, self._confidence)
+		corrected = float(correctDeadTime(cpms[-1], calibration.deadTime))
+		statistics = {'dose' : dose, 'meanCPM' : meanCPM,
+			'meanRadiation' : float(numpy.dot(radiations[-recent:], intervals[-recent:]) / exposure),
+			'cpmLower' : float(lower), 'cpmUpper' : float(upper),
+			'correctedCPM' : corrected if not numpy.isnan(corrected) else None}
+		for name, length in DOSE_WINDOWS:
+			statistics[name] = float(doseInWindows(times, radiations, intervals, [now - length, now + 1])[0])
+		return statistics
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = """Prints statistics of the measurements archived by the csvfile
+		or binary updater as JSON: for each device the number of samples, mean CPM with its confidence bounds, mean and
+		maximal radiation and the total dose in uSv, optionally the dose in each window of given length.""")
+	parser.add_argument("file", help = "CSV file or binary archive; the archive is recognized by its header")
+	parser.add_argument("-w", "--window", type = float, help = "length of the dose windows in seconds, e.g. 86400")
+	parser.add_argument("--start", type = float, help = "only measurements since this time (seconds since epoch, UTC)")
+	parser.add_argument("--end", type = float, help = "only measurements before this time (seconds since epoch, UTC)")
+	parser.add_argument("--date-format", default = '%Y-%m-%d', help = "date format of the CSV file")
+	parser.add_argument("--time-format", default = '%H:%M:%S', help = "time format of the CSV file")
+	parser.add_argument("--decimal-separator", default = '.', help = "decimal separator of the CSV file")
+	parser.add_argument("--delimiter", default = ',', help = "delimiter of the CSV file")
+	parser.add_argument("--confidence", type = float, default = rollup.DEFAULT_CONFIDENCE, help = "confidence level of the bounds")
+	args = parser.parse_args()
+
+	import updaters.binary
+
+	started = clock.monotonic()
+	with open(args.file, 'rb') as handle:
+		isArchive = handle.read(len(updaters.binary.MAGIC)) == updaters.binary.MAGIC
+	if isArchive:
+		records, devices = loadArchive(args.file, args.start, args.end)
+	else:
+		records, devices = loadCsv(args.file, args.date_format, args.time_format, args.decimal_separator, args.delimiter)
+		if args.start is not None:
+			records = records[records['time'] >= args.start]
+		if args.end is not None:
+			records = records[records['time'] < args.end]
+	loaded = clock.monotonic()
+
+	edges = None
+	if args.window and len(records) > 0:
+		first = records['time'].min() // args.window * args.window
+		edges = numpy.arange(first, records['time'].max() + args.window, args.window)
+
+	report = {'devices' : summarize(records, devices, edges, args.confidence), 'samples' : len(records),
+		'loadTime' : loaded - started, 'computeTime' : clock.monotonic() - loaded}
+	if edges is not None:
+		report['windowStarts'] = edges[:-1].tolist()
+	print(json.dumps(report, indent = 2, sort_keys = True))
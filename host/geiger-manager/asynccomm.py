@@ -0,0 +1,220 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import collections
+import threading
+import logging
+import Queue
+import usbcomm
+
+# default number of threads performing USB transfers
+DEFAULT_WORKERS = 4
+
+class Future(object):
+	"""Result of the call running in the background. The caller can wait for it with result() or register a callback
+	with addDoneCallback(); the latter is the way to connect it to an event loop, e.g. by calling the loop's
+	thread-safe scheduling method in the callback.
+	"""
+
+	_condition = None
+	_done = False
+	_result = None
+	_exception = None
+	_callbacks = None
+
+	def __init__(self):
+		self._condition = threading.Condition()
+		self._callbacks = []
+
+	def done(self):
+		"Returns True if the call has finished."
+		return self._done
+
+	def result(self, timeout = None):
+		"""Waits for the call to finish, but not longer than timeout seconds if it's given, and returns its result.
+		If the call raised an exception, it's raised here.
+		"""
+		self._wait(timeout)
+		if self._exception is not None:
+			raise self._exception
+		return self._result
+
+	def exception(self, timeout = None):
+		"Waits like result() and returns the exception raised by the call, or None."
+		self._wait(timeout)
+		return self._exception
+
+	def _wait(self, timeout):
+		with self._condition:
+			if not self._done:
+				self._condition.wait(timeout)
+			if not self._done:
+				raise usbcomm.CommException("operation didn't finish in %.1f s" % timeout)
+
+	def addDoneCallback(self, callback):
+		"""Calls callback with the future as the argument when the call finishes. The callback runs in the thread
+		which finished the call, or at once if it's already finished.
+		"""
+		with self._condition:
+			if not self._done:
+				self._callbacks.append(callback)
+				return
+		self._invoke(callback)
+
+	def setResult(self, result):
+		self._finish(result, None)
+
+	def setException(self, exception):
+		self._finish(None, exception)
+
+	def _finish(self, result, exception):
+		with self._condition:
+			self._result = result
+			self._exception = exception
+			self._done = True
+			self._condition.notifyAll()
+			callbacks = self._callbacks
+			self._callbacks = []
+		for callback in callbacks:
+			self._invoke(callback)
+
+	def _invoke(self, callback):
+		try:
+			callback(self)
+		except Exception as e:
+			logging.getLogger("geiger.asynccomm").exception("Error in the callback: %s", str(e))
+
+
+class Executor(object):
+	"Pool of threads running the submitted functions."
+
+	_queue = None
+	_workers = None
+
+	def __init__(self, workers = DEFAULT_WORKERS, name = "geiger-usb"):
+		self._queue = Queue.Queue()
+		self._workers = []
+		for number in xrange(max(1, workers)):
+			worker = threading.Thread(target = self._run, name = "%s-%d" % (name, number))
+			worker.setDaemon(True)
+			worker.start()
+			self._workers.append(worker)
+
+	def submit(self, function, *args, **kwargs):
+		"Runs function(*args, **kwargs) in one of the threads and returns Future of its result."
+		future = Future()
+		self._queue.put((future, function, args, kwargs))
+		return future
+
+	def shutdown(self, wait = True):
+		"Stops the threads after they finish the functions which are already submitted."
+		# None in the queue stops the worker; unlike a module-level marker it survives interpreter shutdown
+		for worker in self._workers:
+			self._queue.put(None)
+		if wait:
+			for worker in self._workers:
+				if worker is not threading.currentThread():
+					worker.join()
+
+	def _run(self):
+		while True:
+			task = self._queue.get()
+			if task is None:
+				return
+			future, function, args, kwargs = task
+			try:
+				result = function(*args, **kwargs)
+			except Exception as e:
+				future.setException(e)
+			else:
+				future.setResult(result)
+
+
+class AsyncConnector(object):
+	"""Asynchronous facade of usbcomm.Connector. The methods don't wait for the device, they return Future instead.
+	The transfers run in the executor, which can be shared by many devices, but the calls of one device run one at
+	a time, in the order of submitting, so the device is never accessed by two threads at once. Callbacks of the
+	futures run inside that order too, so they can use the connector directly.
+	"""
+
+	_connector = None
+	_executor = None
+	_lock = None
+	_pending = None
+	_running = False
+
+	def __init__(self, connector, executor):
+		self._connector = connector
+		self._executor = executor
+		self._lock = threading.Lock()
+		self._pending = collections.deque()
+
+	def getConnector(self):
+		"Returns the wrapped Connector."
+		return self._connector
+
+	def getDeviceId(self):
+		"Returns the ID of the device."
+		return self._connector.getDeviceId()
+
+	def submit(self, function, *args, **kwargs):
+		"Runs function(*args, **kwargs) with exclusive access to the device and returns Future of its result."
+		future = Future()
+		with self._lock:
+			self._pending.append((future, function, args, kwargs))
+			if self._running:
+				return future
+			self._running = True
+		self._executor.submit(self._drain)
+		return future
+
+	def _drain(self):
+		"Runs the pending calls one after another until there are none."
+		while True:
+			with self._lock:
+				if len(self._pending) == 0:
+					self._running = False
+					return
+				future, function, args, kwargs = self._pending.popleft()
+			try:
+				result = function(*args, **kwargs)
+			except Exception as e:
+				future.setException(e)
+			else:
+				future.setResult(result)
+
+	def getCPMandRadiation(self):
+		"Returns Future of the tuple containing CPM and Radiation."
+		return self.submit(self._connector.getCPMandRadiation)
+
+	def getMeasurement(self):
+		"Returns Future of usbcomm.Measurement tuple: CPM, radiation and voltage."
+		return self.submit(self._connector.getMeasurement)
+
+	def getSnapshot(self, acknowledge = False):
+		"Returns Future of usbcomm.Snapshot."
+		return self.submit(self._connector.getSnapshot, acknowledge)
+
+	def getVoltage(self):
+		"Returns Future of the measured tube supply voltage in volts."
+		return self.submit(self._connector.getVoltage)
+
+	def isCountAcknowledged(self):
+		"Returns Future of the count acknowledge flag, which is cleared on the device."
+		return self.submit(self._connector.isCountAcknowledged)
+
+	def setInterval(self, seconds):
+		"Sets the measuring interval in seconds. Returns Future which is done when the device is programmed."
+		return self.submit(self._connector.setInterval, seconds)
+
+	def setVoltageFromConfigFile(self):
+		"Sets the tube voltage from the config file. Returns Future which is done when the device is programmed."
+		return self.submit(self._connector.setVoltageFromConfigFile)
+
+	def resetConnection(self):
+		"Resets the device. Returns Future which is done when it's found again."
+		return self.submit(self._connector.resetConnection)
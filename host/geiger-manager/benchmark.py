@@ -0,0 +1,321 @@
+#!/usr/bin/python2
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import argparse
+import asyncore
+import BaseHTTPServer
+import collections
+import ConfigParser
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import smtpd
+import SocketServer
+import sqlite3
+import sys
+import tempfile
+import time
+import clock
+import usbcomm
+
+# updaters which can be benchmarked, by the name of their configuration section
+SCENARIOS = ('csvfile', 'mysql', 'email', 'cosm.com')
+
+# latency percentiles in the results
+PERCENTILES = (50, 90, 99, 99.9)
+
+# how long to wait for the results besides the measuring time, in seconds
+RESULTS_TIMEOUT = 120.0
+
+
+class _SmtpSink(smtpd.SMTPServer):
+	"Local SMTP server which accepts and discards all mails."
+
+	def process_message(self, peer, mailfrom, rcpttos, data):
+		pass
+
+def _runSmtpServer(pipe):
+	server = _SmtpSink(('127.0.0.1', 0), None)
+	pipe.send(server.socket.getsockname()[1])
+	asyncore.loop()
+
+
+class _FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"Accepts feed updates like the xively.com API does, keeping the connection open."
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_PUT(self):
+		self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+		self.send_response(200)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		pass
+
+class _FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+def _runHttpServer(pipe):
+	server = _FeedServer(('127.0.0.1', 0), _FeedHandler)
+	pipe.send(server.server_address[1])
+	server.serve_forever()
+
+# local stand-ins of the services, run in separate processes so they don't count in the measured CPU time
+SERVERS = {'email' : _runSmtpServer, 'cosm.com' : _runHttpServer}
+
+
+def _configuration(scenario, directory, port, args):
+	"Builds the configuration with simulated devices and only the benchmarked updater enabled."
+	conf = ConfigParser.RawConfigParser()
+
+	def section(name, **options):
+		conf.add_section(name)
+		for option, value in options.iteritems():
+			conf.set(name, option, str(value))
+
+	section('monitor', interval = args.interval, async_workers = args.async_workers)
+	section('device', transport = 'simulator', devices = 'all', tube_sensitivity = usbcomm.TUBE_SENSITIVITY,
+		tube_voltage = usbcomm.TUBE_VOLTAGE, lower_resistor = usbcomm.VOLTAGE_DIVIDER_LOWER_RESISTOR,
+		upper_resistor = usbcomm.VOLTAGE_DIVIDER_UPPER_RESISTOR)
+	section('simulator', devices = args.devices, cpm = args.cpm, latency = args.latency, seed = args.seed)
+
+	# the block policy keeps the order of measurements, which the latency measurement relies on
+	queue = {'enabled' : 'true', 'queue_size' : args.queue_size, 'queue_overflow' : 'block'}
+
+	if scenario == 'csvfile':
+		section('csvfile', file_name = os.path.join(directory, 'readings.csv'), date_format = '%Y-%m-%d',
+			time_format = '%H:%M:%S', decimal_separator = '.', delimiter = ',', device_column = 'true', **queue)
+	elif scenario == 'mysql':
+		# sqlite3 stands in for the MySQL server
+		dbName = os.path.join(directory, 'geiger.db')
+		db = sqlite3.connect(dbName)
+		db.execute("create table readings (radiation real, cpm real, time text, device text)")
+		db.close()
+		section('mysql', driver = 'sqlite3', db_name = dbName, table_name = 'readings', device_column = 'device', **queue)
+	elif scenario == 'email':
+		# every measurement exceeds the threshold and the rate limit is off, so each one is mailed
+		section('email', addresses = 'benchmark@localhost', date_format = '%Y-%m-%d', time_format = '%H:%M:%S',
+			message_subject = 'Radiation $radiation$ uSv/h', message_content = 'CPM: $cpm$, device: $device$',
+			smtp_server = '127.0.0.1', smtp_port = port, smtp_user = '', smtp_password = '',
+			smtp_sender_email = 'geiger@localhost', smtp_starttls = 'false', radiation_threshold = 0,
+			min_interval = 0, digest_interval = 0, **queue)
+	elif scenario == 'cosm.com':
+		section('cosm.com', feed_id = 'benchmark', cpm_id = 'CPM-$device$', radiation_id = 'Radiation-$device$',
+			api_key = 'benchmark', url = 'http://127.0.0.1:%d/v2/feeds/' % port, **queue)
+
+	return conf
+
+
+class LatencyProbe(object):
+	"""Measures the time from putting the measurement in the updater queue to its delivery. The updaters which send
+	the measurements in batches (MySQL, xively.com) keep them in their '_buffer' list, so a measurement is delivered
+	at the end of the update(), flush() or close() call which took it out of the buffer, i.e. wrote the batch.
+	The queue must keep the order of measurements, i.e. use the block overflow policy.
+	"""
+
+	_enqueued = None
+	_accepted = None
+	_updater = None
+	latencies = None
+	errors = 0
+	first = None
+	last = None
+
+	def __init__(self, queued):
+		self._enqueued = collections.deque()
+		self._accepted = collections.deque()
+		self.latencies = []
+		self._wrap(queued)
+
+	def _wrap(self, queued):
+		put = queued.update
+		self._updater = updater = queued.getUpdater()
+
+		def update(**sample):
+			now = clock.monotonic()
+			if self.first is None:
+				self.first = now
+			self._enqueued.append(now)
+			put(**sample)
+
+		def delivering(method, accepting = False):
+			def call(*args, **named):
+				if accepting:
+					self._accepted.append(self._enqueued.popleft())
+				try:
+					return method(*args, **named)
+				except Exception:
+					self.errors += 1
+					raise
+				finally:
+					self._written()
+			return call
+
+		queued.update = update
+		updater.update = delivering(updater.update, True)
+		updater.flush = delivering(updater.flush)
+		updater.close = delivering(updater.close)
+
+	def _written(self):
+		"Records the latency of the accepted measurements which aren't in the buffer of the updater any more."
+		pending = len(getattr(self._updater, '_buffer', None) or ())
+		now = clock.monotonic()
+		while len(self._accepted) > pending:
+			self.last = now
+			self.latencies.append(now - self._accepted.popleft())
+
+	def getProduced(self):
+		"Returns the number of measurements put in the queue."
+		return len(self.latencies) + len(self._accepted) + len(self._enqueued)
+
+
+def _percentile(values, percent):
+	"Returns the percentile of the sorted list, using the nearest rank."
+	if len(values) == 0:
+		return None
+	rank = int(round(percent / 100.0 * (len(values) - 1)))
+	return values[rank]
+
+def _currentRSS():
+	"Returns the resident set size of the process in kilobytes, None where /proc isn't available."
+	try:
+		with open('/proc/self/statm') as handle:
+			return int(handle.read().split()[1]) * resource.getpagesize() // 1024
+	except (IOError, IndexError, ValueError):
+		return None
+
+def _runScenario(scenario, port, args, results):
+	"Runs the monitor with the updater of the scenario and puts the results in the queue."
+	import monitor
+
+	# the report may go to the standard output, so whatever the updaters print goes to stderr
+	sys.stdout.flush()
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+	directory = tempfile.mkdtemp(prefix = 'geiger-benchmark-')
+	try:
+		conf = _configuration(scenario, directory, port, args)
+		usbcomm.configureTransport(conf)
+		connectors = usbcomm.openConnectors(conf)
+
+		usageBefore = resource.getrusage(resource.RUSAGE_SELF)
+		rssBefore = _currentRSS()
+
+		geiger = monitor.createMonitor(configuration = conf, connectors = connectors)
+		updaters = geiger.getUpdaters()
+		probes = [LatencyProbe(queued) for queued in updaters]
+
+		started = clock.monotonic()
+		geiger.start()
+		time.sleep(args.duration)
+		geiger.stop()
+		finished = clock.monotonic()
+		scheduler = geiger.getSchedulerStatistics()
+
+		usageAfter = resource.getrusage(resource.RUSAGE_SELF)
+	except Exception as e:
+		results.put({'error' : "%s: %s" % (type(e).__name__, str(e))})
+		return
+	finally:
+		shutil.rmtree(directory, ignore_errors = True)
+
+	cpuUser = usageAfter.ru_utime - usageBefore.ru_utime
+	cpuSystem = usageAfter.ru_stime - usageBefore.ru_stime
+
+	report = {'wallTime' : finished - started, 'cpuUser' : cpuUser, 'cpuSystem' : cpuSystem,
+		'rssBefore' : rssBefore, 'rssAfter' : _currentRSS(), 'maxRSS' : usageAfter.ru_maxrss,
+		'scheduler' : scheduler, 'updaters' : {}}
+
+	for queued, probe in zip(updaters, probes):
+		latencies = sorted(probe.latencies)
+		delivered = len(latencies)
+		span = probe.last - probe.first if delivered > 1 else None
+		stats = {'produced' : probe.getProduced(), 'delivered' : delivered, 'errors' : probe.errors,
+			'dropped' : queued.getDroppedCount(),
+			'samplesPerSecond' : delivered / span if span else None,
+			'cpuPerSample' : (cpuUser + cpuSystem) / delivered if delivered else None,
+			'latencyMean' : sum(latencies) / delivered if delivered else None,
+			'latencyMax' : latencies[-1] if delivered else None}
+		for percent in PERCENTILES:
+			stats['latencyP%g' % percent] = _percentile(latencies, percent)
+		report['updaters'][queued.getName()] = stats
+
+	results.put(report)
+
+def runBenchmark(scenario, args):
+	"""Runs the scenario in a separate process, so CPU time and memory are measured for it alone. The service
+	stand-in, if the updater needs one, runs in another process. Returns the dictionary with the results.
+	"""
+	server = None
+	port = None
+	if scenario in SERVERS:
+		receiver, sender = multiprocessing.Pipe(False)
+		server = multiprocessing.Process(target = SERVERS[scenario], args = (sender,))
+		server.daemon = True
+		server.start()
+		port = receiver.recv()
+
+	try:
+		results = multiprocessing.Queue()
+		worker = multiprocessing.Process(target = _runScenario, args = (scenario, port, args, results))
+		worker.start()
+		report = results.get(timeout = args.duration + RESULTS_TIMEOUT)
+		worker.join()
+		return report
+	finally:
+		if server is not None:
+			server.terminate()
+			server.join()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = """Measures the throughput, latency, CPU time and memory of the
+		updaters, driving the monitor with simulated Geiger devices at accelerated rate. Services are replaced by
+		local stand-ins: sqlite3 for MySQL, SMTP server for e-mail and HTTP server for xively.com. The results are
+		printed as JSON; times are in seconds, memory in kilobytes.""")
+	parser.add_argument("scenarios", nargs = '*', default = list(SCENARIOS),
+		help = "updaters to benchmark: " + ', '.join(SCENARIOS) + "; all by default")
+	parser.add_argument("-d", "--devices", type = int, default = 1000, help = "number of simulated devices")
+	parser.add_argument("-t", "--duration", type = float, default = 10.0, help = "time of measuring in seconds")
+	parser.add_argument("-i", "--interval", type = int, default = 1, help = "measuring interval of each device in seconds")
+	parser.add_argument("--cpm", type = float, default = 1000.0, help = "mean CPM of the simulated devices")
+	parser.add_argument("--latency", type = float, default = 0.0, help = "simulated USB transfer time in seconds")
+	parser.add_argument("--async-workers", type = int, default = 0,
+		help = "number of threads performing USB transfers, 0 means the scheduler thread does them")
+	parser.add_argument("--queue-size", type = int, default = 1000, help = "size of the updater queue")
+	parser.add_argument("--seed", type = int, default = 1, help = "seed of the simulated counts")
+	parser.add_argument("-o", "--output", help = "writes the results to given file instead of standard output")
+	parser.add_argument("-v", "--verbose", action = 'store_true', help = "shows the log of the monitor")
+	args = parser.parse_args()
+
+	for scenario in args.scenarios:
+		if scenario not in SCENARIOS:
+			parser.error("unknown updater '%s', should be one of: %s" % (scenario, ', '.join(SCENARIOS)))
+
+	logging.basicConfig(level = logging.INFO if args.verbose else logging.CRITICAL,
+		format = '%(asctime)s %(name)s %(message)s', datefmt = '[%Y-%m-%d %H:%M:%S]')
+
+	report = {'python' : platform.python_version(), 'platform' : platform.platform(),
+		'settings' : {'devices' : args.devices, 'duration' : args.duration, 'interval' : args.interval,
+			'cpm' : args.cpm, 'latency' : args.latency, 'asyncWorkers' : args.async_workers, 'queueSize' : args.queue_size, 'seed' : args.seed},
+		'started' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'scenarios' : {}}
+
+	for scenario in args.scenarios:
+		report['scenarios'][scenario] = runBenchmark(scenario, args)
+
+	text = json.dumps(report, indent = 2, sort_keys = True)
+	if args.output:
+		with open(args.output, 'w') as handle:
+			handle.write(text + '\n')
+	else:
+		print(text)
@@ -0,0 +1,52 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import time
+import threading
+
+# from <time.h> on Linux
+CLOCK_MONOTONIC = 1
+
+class _Timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _loadClockGettime():
+	"Returns clock_gettime() from libc or librt, or None on systems without it."
+	if os.name != 'posix':
+		return None
+	for name in ('c', 'rt'):
+		path = ctypes.util.find_library(name)
+		if path is None:
+			continue
+		try:
+			function = getattr(ctypes.CDLL(path, use_errno = True), 'clock_gettime')
+		except (OSError, AttributeError):
+			continue
+		function.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+		return function
+	return None
+
+_clockGettime = _loadClockGettime()
+# each thread reuses its own structure
+_local = threading.local()
+
+def monotonic():
+	"""Returns the time in seconds from the clock which never goes back, e.g. when the system time is set.
+	Only differences between the values are meaningful. Falls back to time.time() on systems without
+	clock_gettime(), like Windows.
+	"""
+	if _clockGettime is None:
+		return time.time()
+	timespec = getattr(_local, 'timespec', None)
+	if timespec is None:
+		timespec = _local.timespec = _Timespec()
+	if _clockGettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+		return time.time()
+	return timespec.tv_sec + timespec.tv_nsec * 1e-9
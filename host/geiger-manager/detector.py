@@ -0,0 +1,241 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import calendar
+import ConfigParser
+import math
+import threading
+import time
+
+# default settings, can be changed in [detector] section
+DEFAULT_RISE_FACTOR = 2.0
+DEFAULT_FALSE_ALARM_RATE = 0.1
+DEFAULT_BASELINE_TIME = 3600.0
+
+# the background rate is learned from the measurements; no alarms are raised until it rests on this many counts
+MIN_BASELINE_COUNTS = 100
+
+SECONDS_PER_DAY = 86400.0
+
+RISE = 'rise'
+END = 'end'
+
+class DetectorException(Exception):
+	pass
+
+class Alert(object):
+	"""Start (kind 'rise') or end (kind 'end') of the alarm of one device. time is UTC time_struct, baselineCPM the
+	background rate the detector compares with and cpm the rate estimated since the change began, which covers
+	the whole alarm for the end. statistic is the CUSUM statistic which crossed the threshold.
+	"""
+
+	__slots__ = ('deviceId', 'kind', 'time', 'baselineCPM', 'cpm', 'statistic', 'threshold')
+
+	def __init__(self, **values):
+		for name in self.__slots__:
+			setattr(self, name, values.get(name))
+
+	def asDict(self):
+		"Returns all fields as the dictionary, with time in seconds since the epoch."
+		values = dict((name, getattr(self, name)) for name in self.__slots__)
+		values['time'] = calendar.timegm(self.time)
+		return values
+
+
+class PoissonCusum(object):
+	"""Two-sided CUSUM test of the count rate of one device. Each sample is a number of counts over the exposure in
+	seconds: a whole measuring interval, or a single count with the time since the previous one. The log-likelihood
+	ratio of the rate 'riseFactor' times the background against the background is summed, clipped at zero; the alarm
+	starts when the sum exceeds the threshold, and ends when the opposite sum does. The threshold h = ln(ARL) keeps
+	the mean time between false alarms at background above 1 / falseAlarmRate days (Lorden's bound). Each sample
+	takes constant time.
+
+	The background is 'baselineCPM' if given, otherwise it's learned as the exponentially weighted rate of the last
+	'baselineTime' seconds, frozen during the alarm.
+	"""
+
+	_riseFactor = None
+	_logFactor = None
+	_falseAlarmRate = None
+	_baselineTime = None
+	_fixedBaseline = None
+
+	_baselineCounts = 0.0
+	_baselineExposure = 0.0
+	_learnedCounts = 0.0
+
+	alarm = False
+	statistic = 0.0
+	_runCounts = 0.0
+	_runExposure = 0.0
+	threshold = None
+
+	# the statistic and the run CPM when the threshold was crossed last time
+	crossedStatistic = None
+	crossedCPM = None
+
+	def __init__(self, riseFactor = DEFAULT_RISE_FACTOR, falseAlarmRate = DEFAULT_FALSE_ALARM_RATE,
+			baselineCPM = None, baselineTime = DEFAULT_BASELINE_TIME):
+		if riseFactor <= 1.0:
+			raise DetectorException("rise factor has to be greater than 1")
+		if falseAlarmRate <= 0.0:
+			raise DetectorException("false alarm rate has to be positive")
+		self._riseFactor = riseFactor
+		self._logFactor = math.log(riseFactor)
+		self._falseAlarmRate = falseAlarmRate
+		self._fixedBaseline = baselineCPM / 60.0 if baselineCPM is not None else None
+		self._baselineTime = baselineTime
+
+	def getBaseline(self):
+		"Returns the background rate in counts per second, or None while it's being learned."
+		if self._fixedBaseline is not None:
+			return self._fixedBaseline
+		if self._learnedCounts < MIN_BASELINE_COUNTS or self._baselineExposure <= 0.0:
+			return None
+		return self._baselineCounts / self._baselineExposure
+
+	def _learn(self, counts, exposure):
+		weight = min(1.0, exposure / self._baselineTime)
+		self._baselineCounts = self._baselineCounts * (1.0 - weight) + counts
+		self._baselineExposure = self._baselineExposure * (1.0 - weight) + exposure
+		self._learnedCounts += counts
+
+	def add(self, counts, exposure, spacing = None):
+		"""Adds the sample: counts over exposure seconds. spacing is the mean time between the samples, the exposure
+		by default; it sets the threshold for the wanted false alarm rate. Returns RISE or END if the alarm started
+		or ended, otherwise None.
+		"""
+		baseline = self.getBaseline()
+		if baseline is None or baseline <= 0.0 or exposure <= 0.0:
+			self._learn(counts, exposure)
+			return None
+
+		spacing = spacing if spacing is not None else exposure
+		self.threshold = math.log(max(SECONDS_PER_DAY / (self._falseAlarmRate * spacing), 1.0))
+		ratio = counts * self._logFactor - (self._riseFactor - 1.0) * baseline * exposure
+
+		if not self.alarm:
+			self._learn(counts, exposure)
+			self.statistic = max(0.0, self.statistic + ratio)
+			if self.statistic == 0.0:
+				self._runCounts = self._runExposure = 0.0
+			else:
+				self._runCounts += counts
+				self._runExposure += exposure
+			if self.statistic >= self.threshold:
+				self._cross()
+				self.alarm = True
+				return RISE
+			return None
+
+		# during the alarm the same test runs the other way, for the return to the background
+		self._runCounts += counts
+		self._runExposure += exposure
+		self.statistic = max(0.0, self.statistic - ratio)
+		if self.statistic >= self.threshold:
+			self._cross()
+			self.alarm = False
+			self._runCounts = self._runExposure = 0.0
+			return END
+		return None
+
+	def _cross(self):
+		self.crossedStatistic = self.statistic
+		self.crossedCPM = self.getRunCPM()
+		self.statistic = 0.0
+
+	def getRunCPM(self):
+		"Returns CPM since the change began, including the alarm, or None if no change is under way."
+		if self._runExposure <= 0.0:
+			return None
+		return self._runCounts / self._runExposure * 60.0
+
+
+class DetectorStage(object):
+	"""Runs PoissonCusum for each device. add() takes the measurements of the monitor, addEvent() single counts
+	captured in event mode (see events.EventCapture); a device should be fed only one way. Both return the list
+	of alerts, which the monitor passes to the updaters.
+	"""
+
+	_settings = None
+	_detectors = None
+	_lastEvents = None
+	_lock = None
+
+	def __init__(self, **settings):
+		# checks the settings at once
+		PoissonCusum(**settings)
+		self._settings = settings
+		self._detectors = {}
+		self._lastEvents = {}
+		self._lock = threading.Lock()
+
+	@classmethod
+	def fromConfiguration(cls, configuration):
+		"Creates the detector if it's enabled in [detector] section, otherwise returns None."
+		confFileSection = 'detector'
+		try:
+			if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+				return None
+
+			def option(name, default):
+				if configuration.has_option(confFileSection, name):
+					return configuration.getfloat(confFileSection, name)
+				return default
+
+			return cls(riseFactor = option('rise_factor', DEFAULT_RISE_FACTOR),
+				falseAlarmRate = option('false_alarm_rate', DEFAULT_FALSE_ALARM_RATE),
+				baselineCPM = option('baseline_cpm', None), baselineTime = option('baseline_time', DEFAULT_BASELINE_TIME))
+		except (ConfigParser.Error, ValueError) as e:
+			raise DetectorException("wrong detector settings: " + str(e))
+
+	def _detector(self, deviceId):
+		detector = self._detectors.get(deviceId)
+		if detector is None:
+			detector = self._detectors[deviceId] = PoissonCusum(**self._settings)
+		return detector
+
+	def _alert(self, deviceId, detector, kind, timestamp):
+		return Alert(deviceId = deviceId, kind = kind, time = timestamp, baselineCPM = detector.getBaseline() * 60.0,
+			cpm = detector.crossedCPM, statistic = detector.crossedStatistic, threshold = detector.threshold)
+
+	def add(self, deviceId, timestamp, cpm, interval):
+		"Adds the measurement: UTC time_struct, CPM and the measuring interval in seconds. Returns the list of alerts."
+		with self._lock:
+			detector = self._detector(deviceId)
+			kind = detector.add(cpm * interval / 60.0, interval)
+			if kind is None:
+				return []
+			return [self._alert(deviceId, detector, kind, timestamp)]
+
+	def addEvent(self, deviceId, when):
+		"""Adds single count captured at 'when' (monotonic clock, seconds). The exposure is the time since
+		the previous count. Returns the list of alerts.
+		"""
+		with self._lock:
+			last = self._lastEvents.get(deviceId)
+			self._lastEvents[deviceId] = when
+			if last is None:
+				return []
+			detector = self._detector(deviceId)
+			baseline = detector.getBaseline()
+			kind = detector.add(1.0, when - last, 1.0 / baseline if baseline else None)
+			if kind is None:
+				return []
+			return [self._alert(deviceId, detector, kind, time.gmtime())]
+
+	def getStatus(self, deviceId):
+		"""Returns the dictionary with: alarm, statistic, threshold, baselineCPM (None while it's being learned),
+		runCPM, or None if the device had no measurements.
+		"""
+		with self._lock:
+			detector = self._detectors.get(deviceId)
+			if detector is None:
+				return None
+			baseline = detector.getBaseline()
+			return {'alarm' : detector.alarm, 'statistic' : detector.statistic, 'threshold' : detector.threshold,
+				'baselineCPM' : baseline * 60.0 if baseline is not None else None, 'runCPM' : detector.getRunCPM()}
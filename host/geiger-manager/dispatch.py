@@ -0,0 +1,393 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import os
+import time
+import threading
+import collections
+import Queue
+import ConfigParser
+import logging
+import updaters.dummy
+import updaters.spool
+import rollup
+import clock
+import tracing
+
+# default settings of the updater queue, can be changed in each updater section
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_OVERFLOW_POLICY = 'drop_oldest'
+
+OVERFLOW_POLICIES = ('drop_oldest', 'block')
+
+# how often flush() of the updater is called when its queue is empty, in seconds
+FLUSH_PERIOD = 1.0
+
+# how many spooled measurements are replayed at once
+REPLAY_BATCH = 500
+# how long to wait before retrying the replay after a failure, in seconds
+REPLAY_RETRY = 30.0
+
+# number of the latest delivery latencies kept for the percentiles
+LATENCY_HISTORY = 1000
+
+# put in the queue to stop the worker
+_STOP = object()
+
+class QueuedUpdater(updaters.dummy.DummyUpdater):
+	"""Runs the wrapped updater in its own worker thread, fed by a bounded queue. update() only puts the measurement
+	in the queue, so a slow updater doesn't hold up the others nor the measuring cycle. When the queue is full,
+	the oldest measurement is dropped ('drop_oldest' policy) or the caller waits for free space ('block' policy).
+	The updater gets either every measurement or aggregates of the chosen resolution (minute, hour, day).
+
+	If the spool is given, measurements which the updater failed to deliver are stored there. They are replayed
+	in batches, oldest first, whenever the queue is empty and the last delivery succeeded, so the live data
+	always goes first.
+	"""
+
+	_updater = None
+	_name = None
+	_queue = None
+	_overflowPolicy = None
+	_worker = None
+	_dropped = 0
+	_log = None
+
+	_resolution = rollup.RAW
+
+	_spool = None
+	_replayAfter = 0
+	_replayed = 0
+	_replayStarted = None
+	_replayCount = 0
+
+	_spanName = None
+	_delivered = 0
+	_failed = 0
+	_latencySum = 0.0
+	_latencies = None
+
+	def __init__(self, updater, name, queueSize = DEFAULT_QUEUE_SIZE, overflowPolicy = DEFAULT_OVERFLOW_POLICY,
+			spool = None, resolution = rollup.RAW):
+		if overflowPolicy not in OVERFLOW_POLICIES:
+			raise updaters.dummy.UpdaterException("unknown queue overflow policy '%s', should be one of: %s"
+				% (overflowPolicy, ', '.join(OVERFLOW_POLICIES)))
+		if queueSize < 1:
+			raise updaters.dummy.UpdaterException("queue size has to be positive")
+
+		self._log = logging.getLogger("geiger.dispatch")
+		self._updater = updater
+		self._name = name
+		self._spanName = 'updater.' + name
+		self._enabled = updater.isEnabled()
+		self._queue = Queue.Queue(queueSize)
+		self._latencies = collections.deque(maxlen = LATENCY_HISTORY)
+		self._overflowPolicy = overflowPolicy
+		self._spool = spool
+		if resolution != rollup.RAW and resolution not in rollup.RESOLUTIONS:
+			raise updaters.dummy.UpdaterException("unknown resolution '%s', should be one of: %s"
+				% (resolution, ', '.join([rollup.RAW] + rollup.RESOLUTIONS.keys())))
+		self._resolution = resolution
+
+		if spool is not None and not spool.isEmpty():
+			self._log.info("%s updater has %d bytes of spooled measurements to replay.", name, spool.getPendingSize())
+
+		self._worker = threading.Thread(target = self._run, name = "geiger-updater-" + name)
+		self._worker.setDaemon(True)
+		self._worker.start()
+
+	@classmethod
+	def fromConfiguration(cls, updater, name, configuration, confFileSection):
+		"""Creates the queue using options 'queue_size', 'queue_overflow' and 'resolution' from given section of the
+		configuration file. Missing options get default values. The spool is created if it's enabled in [spool]
+		section, the updater supports it and the option 'spool' in its section isn't false.
+		"""
+		queueSize = DEFAULT_QUEUE_SIZE
+		overflowPolicy = DEFAULT_OVERFLOW_POLICY
+		spoolWanted = updater.isSpoolable()
+		resolution = rollup.RAW
+		try:
+			if confFileSection is not None and configuration.has_section(confFileSection):
+				if configuration.has_option(confFileSection, 'queue_size'):
+					queueSize = configuration.getint(confFileSection, 'queue_size')
+				if configuration.has_option(confFileSection, 'queue_overflow'):
+					overflowPolicy = configuration.get(confFileSection, 'queue_overflow').strip()
+				if configuration.has_option(confFileSection, 'spool'):
+					spoolWanted = configuration.getboolean(confFileSection, 'spool')
+				if configuration.has_option(confFileSection, 'resolution'):
+					resolution = configuration.get(confFileSection, 'resolution').strip()
+		except (ConfigParser.Error, ValueError) as e:
+			raise updaters.dummy.UpdaterException("wrong queue settings: " + str(e))
+
+		spool = None
+		if spoolWanted:
+			spool = _createSpool(configuration, confFileSection if confFileSection is not None else name)
+
+		return cls(updater, name, queueSize, overflowPolicy, spool, resolution)
+
+	def getName(self):
+		"Returns the name of the wrapped updater."
+		return self._name
+
+	def getUpdater(self):
+		"Returns the wrapped updater instance."
+		return self._updater
+
+	def getQueueDepth(self):
+		"Returns the number of measurements waiting in the queue."
+		return self._queue.qsize()
+
+	def getDroppedCount(self):
+		"Returns the number of measurements dropped because of the full queue."
+		return self._dropped
+
+	def getResolution(self):
+		"Returns 'raw' or the name of the rollup resolution the updater is subscribed to."
+		return self._resolution
+
+	def getSpool(self):
+		"Returns the spool of failed measurements or None if it's disabled."
+		return self._spool
+
+	def getReplayedCount(self):
+		"Returns the number of spooled measurements delivered so far."
+		return self._replayed
+
+	def getStatistics(self):
+		"""Returns the dictionary with: delivered, failed - numbers of measurements passed to the updater successfully
+		and not, queueDepth, dropped, replayed, latencyMean - mean time from queueing the measurement to the end of
+		its delivery in seconds, latencyP50, latencyP99 - percentiles of the latency of the latest deliveries.
+		"""
+		latencies = sorted(self._latencies)
+		count = self._delivered + self._failed
+		statistics = {'delivered' : self._delivered, 'failed' : self._failed, 'queueDepth' : self.getQueueDepth(),
+			'dropped' : self._dropped, 'replayed' : self._replayed,
+			'latencyMean' : self._latencySum / count if count > 0 else None}
+		for name, fraction in (('latencyP50', 0.5), ('latencyP99', 0.99)):
+			statistics[name] = latencies[int(fraction * (len(latencies) - 1))] if len(latencies) > 0 else None
+		return statistics
+
+	def update(self, timestamp, radiation = None, cpm = None, deviceId = None):
+		"Puts the measurement in the queue. Never raises UpdaterException, errors are logged by the worker."
+		if not self._enabled:
+			return
+
+		self._put({'timestamp' : timestamp, 'radiation' : radiation, 'cpm' : cpm, 'deviceId' : deviceId})
+
+	def updateRollup(self, rollup):
+		"Puts the aggregate in the queue."
+		if not self._enabled:
+			return
+
+		self._put({'rollup' : rollup})
+
+	def alert(self, alert):
+		"Puts the alert in the queue."
+		if not self._enabled:
+			return
+
+		self._put({'alert' : alert})
+
+	def _put(self, item):
+		# the time of queueing goes along with the item, to measure the latency of delivery
+		item = (clock.monotonic(), item)
+		if self._overflowPolicy == 'block':
+			self._queue.put(item)
+			return
+
+		while True:
+			try:
+				self._queue.put_nowait(item)
+				return
+			except Queue.Full:
+				pass
+			try:
+				entry = self._queue.get_nowait()
+				self._queue.task_done()
+				self._dropped += 1
+				if entry is _STOP:
+					# the updater is being closed, the stop marker goes back and the measurement is dropped instead
+					self._queue.put(_STOP)
+					return
+				self._log.warning("%s updater queue is full, dropping the oldest measurement.", self._name)
+			except Queue.Empty:
+				pass
+
+	def _connect(self):
+		"Lets the updater connect to its service. If it fails, the updater connects when it sends the data."
+		started = clock.monotonic()
+		try:
+			self._updater.connect()
+		except updaters.dummy.UpdaterException as e:
+			self._log.error("%s updater could not connect: %s", self._name, str(e))
+			return
+		except Exception as e:
+			self._log.exception("Unexpected error in %s updater: %s", self._name, str(e))
+			return
+		self._log.info("%s updater ready in %.0f ms.", self._name, (clock.monotonic() - started) * 1000.0)
+
+	def _run(self):
+		self._connect()
+		while True:
+			if self._queue.empty() and self._canReplay():
+				self._replay()
+				continue
+			try:
+				entry = self._queue.get(timeout = FLUSH_PERIOD)
+			except Queue.Empty:
+				self._flush()
+				continue
+			if entry is _STOP:
+				# the updater is closed in the thread which used it, some database drivers require that
+				self._closeUpdater()
+				self._queue.task_done()
+				return
+			queued, item = entry
+			try:
+				with tracing.span(self._spanName):
+					if 'rollup' in item:
+						self._updater.updateRollup(item['rollup'])
+					elif 'alert' in item:
+						self._updater.alert(item['alert'])
+					else:
+						self._updater.update(**item)
+				self._replayAfter = 0
+				self._delivered += 1
+			except updaters.dummy.UpdaterException as e:
+				self._log.error("Updater error: %s", str(e))
+				self._failed += 1
+				self._spoolFailed(e, item)
+			except Exception as e:
+				# the worker has to survive anything the updater throws
+				self._log.exception("Unexpected error in %s updater: %s", self._name, str(e))
+				self._failed += 1
+			finally:
+				latency = clock.monotonic() - queued
+				self._latencySum += latency
+				self._latencies.append(latency)
+				self._queue.task_done()
+
+	def _spoolFailed(self, error, item):
+		self._replayAfter = time.time() + REPLAY_RETRY
+		# a late alert is useless, so alerts aren't spooled
+		if self._spool is None or 'alert' in item:
+			return
+		if error.samples is not None:
+			samples = error.samples
+		elif 'rollup' in item:
+			samples = [item['rollup'].asSample()]
+		else:
+			samples = [item]
+		try:
+			self._spool.append(samples)
+		except updaters.dummy.UpdaterException as e:
+			self._log.error("Could not spool %d measurements of %s updater: %s", len(samples), self._name, str(e))
+
+	def _canReplay(self):
+		return self._spool is not None and time.time() >= self._replayAfter and not self._spool.isEmpty()
+
+	def _replay(self):
+		"Delivers one batch of spooled measurements and reports the throughput once the spool is drained."
+		try:
+			samples, position = self._spool.read(REPLAY_BATCH)
+			if self._replayStarted is None:
+				self._replayStarted = time.time()
+				self._replayCount = 0
+			if len(samples) > 0:
+				self._updater.updateMany(samples)
+			self._spool.consume(position)
+		except updaters.dummy.UpdaterException as e:
+			self._log.error("Replay of spooled measurements failed: %s", str(e))
+			self._replayAfter = time.time() + REPLAY_RETRY
+			return
+		except Exception as e:
+			self._log.exception("Unexpected error in %s updater during replay: %s", self._name, str(e))
+			self._replayAfter = time.time() + REPLAY_RETRY
+			return
+
+		self._replayed += len(samples)
+		self._replayCount += len(samples)
+
+		if self._spool.isEmpty():
+			elapsed = max(time.time() - self._replayStarted, 1e-6)
+			self._log.info("%s updater replayed %d spooled measurements in %.1f s (%.0f measurements/s).",
+				self._name, self._replayCount, elapsed, self._replayCount / elapsed)
+			self._replayStarted = None
+
+	def _flush(self):
+		try:
+			if self._spool is not None:
+				self._spool.sync()
+			self._updater.flush()
+		except updaters.dummy.UpdaterException as e:
+			self._log.error("Updater error: %s", str(e))
+		except Exception as e:
+			self._log.exception("Unexpected error in %s updater: %s", self._name, str(e))
+
+	def close(self, timeout = 10.0):
+		"""Waits for the worker to process the measurements which are already in the queue, but not longer than
+		timeout seconds, then closes the wrapped updater.
+		"""
+		if self._worker.isAlive():
+			started = clock.monotonic()
+			try:
+				# the queue stays full if the updater hangs
+				self._queue.put(_STOP, True, timeout)
+				self._worker.join(max(timeout - (clock.monotonic() - started), 0.0))
+			except Queue.Full:
+				pass
+			if self._worker.isAlive():
+				self._log.error("%s updater didn't finish in %.1f s, %d measurements lost.", self._name, timeout,
+					self._queue.qsize())
+
+		self._enabled = False
+		if self._spool is not None:
+			self._spool.close()
+		if not self._worker.isAlive():
+			# normally the worker closed it already
+			self._closeUpdater()
+
+	def _closeUpdater(self):
+		if not self._updater.isEnabled():
+			return
+		try:
+			self._updater.close()
+		except updaters.dummy.UpdaterException as e:
+			self._log.error("Error at closing %s updater: %s", self._name, str(e))
+			if self._spool is not None and e.samples:
+				try:
+					self._spool.append(e.samples)
+				except updaters.dummy.UpdaterException as spoolError:
+					self._log.error("Could not spool %d measurements of %s updater: %s", len(e.samples), self._name,
+						str(spoolError))
+		except Exception as e:
+			self._log.exception("Unexpected error at closing %s updater: %s", self._name, str(e))
+
+
+def _createSpool(configuration, key):
+	"""Creates the spool for the updater identified by key, if it's enabled in [spool] section. The key becomes
+	the name of the subdirectory.
+	"""
+	confFileSection = 'spool'
+	try:
+		if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+			return None
+
+		def option(name, default, getter = configuration.getfloat):
+			if configuration.has_option(confFileSection, name):
+				return getter(confFileSection, name)
+			return default
+
+		directory = option('directory', updaters.spool.DEFAULT_DIRECTORY, configuration.get)
+		maxSize = int(option('max_size', updaters.spool.DEFAULT_MAX_SIZE / 1048576.0) * 1048576)
+		segmentSize = int(option('segment_size', updaters.spool.DEFAULT_SEGMENT_SIZE / 1048576.0) * 1048576)
+		syncEvery = int(option('sync_every', updaters.spool.DEFAULT_SYNC_EVERY))
+		syncInterval = option('sync_interval', updaters.spool.DEFAULT_SYNC_INTERVAL)
+	except (ConfigParser.Error, ValueError) as e:
+		raise updaters.dummy.UpdaterException("wrong spool settings: " + str(e))
+
+	return updaters.spool.Spool(os.path.join(directory, key), maxSize, segmentSize, syncEvery, syncInterval)
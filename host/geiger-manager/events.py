@@ -0,0 +1,246 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import array
+import math
+import threading
+import time
+import ConfigParser
+import logging
+import clock
+import usbcomm
+
+# NumPy is optional, it only speeds up computing statistics over the whole buffer
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# default settings, can be changed in [events] section
+DEFAULT_POLL_INTERVAL = 0.002
+DEFAULT_BUFFER_SIZE = 65536
+DEFAULT_HISTOGRAM_BINS = 50
+DEFAULT_HISTOGRAM_WIDTH = 0.1
+DEFAULT_WINDOW = 1.0
+
+# pause after USB error, the monitor resets the device in the meantime
+ERROR_PAUSE = 1.0
+
+class EventBuffer(object):
+	"""Preallocated ring buffer of count timestamps (monotonic clock, in seconds). Adding an event doesn't allocate
+	memory: the timestamp is stored in the array and the inter-arrival histogram is updated in place. The histogram
+	has 'bins' bins 'width' seconds wide and the last one collects all longer intervals.
+	"""
+
+	_times = None
+	_size = None
+	_next = 0
+	_total = 0
+	_last = None
+
+	_histogram = None
+	_bins = None
+	_width = None
+
+	_minInterval = None
+	_intervalSum = 0.0
+
+	def __init__(self, size = DEFAULT_BUFFER_SIZE, bins = DEFAULT_HISTOGRAM_BINS, width = DEFAULT_HISTOGRAM_WIDTH):
+		self._size = size
+		if numpy is not None:
+			self._times = numpy.zeros(size)
+		else:
+			self._times = array.array('d', [0.0]) * size
+		self._bins = bins
+		self._width = float(width)
+		self._histogram = array.array('L', [0]) * (bins + 1)
+
+	def add(self, timestamp):
+		"Stores the timestamp of the new count."
+		self._times[self._next] = timestamp
+		self._next += 1
+		if self._next == self._size:
+			self._next = 0
+
+		if self._last is not None:
+			interval = timestamp - self._last
+			index = int(interval / self._width)
+			self._histogram[index if index < self._bins else self._bins] += 1
+			self._intervalSum += interval
+			if self._minInterval is None or interval < self._minInterval:
+				self._minInterval = interval
+		self._last = timestamp
+		self._total += 1
+
+	def getTotal(self):
+		"Returns the number of counts since the start, including the ones which don't fit in the buffer anymore."
+		return self._total
+
+	def getTimestamps(self):
+		"Returns the stored timestamps, oldest first."
+		stored = min(self._total, self._size)
+		end = self._next
+		if numpy is not None:
+			if stored < self._size:
+				return self._times[:end].copy()
+			return numpy.concatenate((self._times[end:], self._times[:end]))
+		if stored < self._size:
+			return self._times[:end]
+		return self._times[end:] + self._times[:end]
+
+	def countSince(self, since):
+		"Returns the number of stored counts with timestamp not older than since."
+		stored = min(self._total, self._size)
+		end = self._next
+		if numpy is not None:
+			# both parts of the ring are sorted, so binary search is enough
+			newer = self._times[:end]
+			count = len(newer) - int(numpy.searchsorted(newer, since))
+			if stored == self._size and count == len(newer):
+				older = self._times[end:]
+				count += len(older) - int(numpy.searchsorted(older, since))
+			return count
+
+		count = 0
+		index = end
+		for i in xrange(stored):
+			index = index - 1 if index > 0 else self._size - 1
+			if self._times[index] < since:
+				break
+			count += 1
+		return count
+
+	def getCPM(self, window, now = None):
+		"Returns counts per minute computed from the last window seconds."
+		if now is None:
+			now = clock.monotonic()
+		return self.countSince(now - window) * 60.0 / window
+
+	def getHistogram(self):
+		"Returns the list of (lower edge of the bin in seconds, number of intervals) tuples."
+		return [(i * self._width, self._histogram[i]) for i in xrange(self._bins + 1)]
+
+	def getIntervalStatistics(self):
+		"Returns the tuple: shortest and mean interval between counts in seconds, None if there were less than two counts."
+		if self._total < 2:
+			return (None, None)
+		return (self._minInterval, self._intervalSum / (self._total - 1))
+
+
+class EventCapture(threading.Thread):
+	"""Polls the count acknowledge flag of the device in a dedicated thread and stores the time of each count
+	in EventBuffer. The flag tells only if there was at least one count since the last poll, so counts closer
+	than the poll period merge into one. That's the dead time of the capture; its losses are estimated from
+	the fraction of polls which found the flag set, assuming Poisson distributed counts.
+	"""
+
+	_connector = None
+	_buffer = None
+	_pollInterval = None
+	_stopEvent = None
+	_log = None
+	_listener = None
+
+	_polls = 0
+	_hits = 0
+	_errors = 0
+	_started = None
+
+	def __init__(self, connector, eventBuffer, pollInterval = DEFAULT_POLL_INTERVAL):
+		threading.Thread.__init__(self, name = "geiger-events-" + connector.getDeviceId())
+		self.setDaemon(True)
+		self._log = logging.getLogger("geiger.events")
+		self._connector = connector
+		self._buffer = eventBuffer
+		self._pollInterval = pollInterval
+		self._stopEvent = threading.Event()
+
+	@classmethod
+	def fromConfiguration(cls, connector, configuration):
+		"""Creates the capture of given device if it's enabled in [events] section, otherwise returns None."""
+		confFileSection = 'events'
+		try:
+			if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+				return None
+
+			def option(name, default, getter = configuration.getfloat):
+				if configuration.has_option(confFileSection, name):
+					return getter(confFileSection, name)
+				return default
+
+			pollInterval = option('poll_interval', DEFAULT_POLL_INTERVAL)
+			bufferSize = option('buffer_size', DEFAULT_BUFFER_SIZE, configuration.getint)
+			bins = option('histogram_bins', DEFAULT_HISTOGRAM_BINS, configuration.getint)
+			width = option('histogram_width', DEFAULT_HISTOGRAM_WIDTH)
+		except (ConfigParser.Error, ValueError) as e:
+			raise usbcomm.CommException("wrong event capture settings: " + str(e))
+
+		return cls(connector, EventBuffer(bufferSize, bins, width), pollInterval)
+
+	def getBuffer(self):
+		"Returns EventBuffer with captured counts."
+		return self._buffer
+
+	def setListener(self, listener):
+		"""Sets the function called as listener(time) for each captured count, with its monotonic time. It's called
+		in the capture thread, so it should return quickly.
+		"""
+		self._listener = listener
+
+	def stop(self):
+		"Stops polling the device."
+		self._stopEvent.set()
+
+	def run(self):
+		self._started = clock.monotonic()
+		while not self._stopEvent.isSet():
+			before = clock.monotonic()
+			try:
+				counted = self._connector.isCountAcknowledged()
+			except usbcomm.CommException as e:
+				self._errors += 1
+				self._log.debug("Event capture of %s failed: %s", self._connector.getDeviceId(), str(e))
+				self._stopEvent.wait(ERROR_PAUSE)
+				continue
+			after = clock.monotonic()
+
+			self._polls += 1
+			if counted:
+				self._hits += 1
+				self._buffer.add(before)
+				if self._listener is not None:
+					self._listener(before)
+
+			if self._pollInterval > 0:
+				remaining = self._pollInterval - (after - before)
+				if remaining > 0:
+					time.sleep(remaining)
+
+	def getStatistics(self, window = DEFAULT_WINDOW):
+		"""Returns the dictionary with: counts - number of captured counts, cpm - CPM from the last window seconds,
+		polls, errors, pollPeriod - mean time between polls, which is the dead time of the capture, occupancy - the
+		fraction of polls which found a count, correctedCPM - CPM corrected for the counts lost in the dead time,
+		minInterval, meanInterval - shortest and mean time between captured counts.
+		"""
+		now = clock.monotonic()
+		elapsed = now - self._started if self._started is not None else 0.0
+		polls = self._polls
+		hits = self._hits
+
+		pollPeriod = elapsed / polls if polls > 0 else None
+		occupancy = float(hits) / polls if polls > 0 else 0.0
+
+		correctedCPM = None
+		if pollPeriod and occupancy < 1.0:
+			# probability of at least one count in a poll period is 1 - exp(-rate * period)
+			correctedCPM = -math.log(1.0 - occupancy) / pollPeriod * 60.0
+
+		minInterval, meanInterval = self._buffer.getIntervalStatistics()
+
+		return {'counts' : self._buffer.getTotal(), 'cpm' : self._buffer.getCPM(window, now), 'polls' : polls,
+			'errors' : self._errors, 'pollPeriod' : pollPeriod, 'occupancy' : occupancy, 'correctedCPM' : correctedCPM,
+			'minInterval' : minInterval, 'meanInterval' : meanInterval}
@@ -0,0 +1,271 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import ConfigParser
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+# default settings, can be changed in [ipc] section; the socket lies in the directory only the user can write to,
+# so other users can't listen on it in place of the monitor
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.geiger'), 'geiger-manager.sock')
+
+# a subscriber which doesn't read and has more than this number of messages waiting is disconnected
+MAX_CLIENT_BACKLOG = 10000
+
+class IpcException(Exception):
+	pass
+
+def getSocketPath(configuration):
+	"Returns the path of the socket from [ipc] section, or None if publishing is disabled."
+	confFileSection = 'ipc'
+	try:
+		if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+			return None
+		if configuration.has_option(confFileSection, 'socket'):
+			return configuration.get(confFileSection, 'socket').strip()
+		return DEFAULT_SOCKET
+	except (ConfigParser.Error, ValueError) as e:
+		raise IpcException("wrong IPC settings: " + str(e))
+
+def _encode(message):
+	return json.dumps(message, separators = (',', ':'), sort_keys = True) + '\n'
+
+def _setNonBlocking(fd):
+	fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class SamplePublisher(threading.Thread):
+	"""Publishes the measurements of the monitor on the Unix domain socket, one JSON object per line. A subscriber
+	gets first the line {"type": "snapshot", "samples": [...]} with the latest measurement of each device, then
+	{"type": "sample", ...} lines as the measurements come. A sample has the keys: device, time (ISO 8601, UTC), cpm,
+	radiation, voltage and interval (seconds). Subscribers never touch the device, so any number of them can follow the monitor.
+	"""
+
+	_path = None
+	_listener = None
+	_wakeupRead = None
+	_wakeupWrite = None
+	_lock = None
+	_clients = None
+	_slow = None
+	_latest = None
+	_stopped = False
+	_log = None
+
+	def __init__(self, path = DEFAULT_SOCKET):
+		threading.Thread.__init__(self, name = "geiger-ipc")
+		self.setDaemon(True)
+		self._log = logging.getLogger("geiger.ipc")
+		self._path = path
+		self._lock = threading.Lock()
+		self._clients = {}
+		self._slow = set()
+		self._latest = {}
+
+		directory = os.path.dirname(path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory, 0700)
+
+		self._removeStaleSocket()
+		self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self._listener.bind(path)
+			os.chmod(path, 0600)
+			self._listener.listen(16)
+		except socket.error:
+			self._listener.close()
+			raise
+		self._listener.setblocking(False)
+
+		self._wakeupRead, self._wakeupWrite = os.pipe()
+		_setNonBlocking(self._wakeupRead)
+		_setNonBlocking(self._wakeupWrite)
+
+	@classmethod
+	def fromConfiguration(cls, configuration):
+		"Creates the publisher if it's enabled in [ipc] section, otherwise returns None."
+		path = getSocketPath(configuration)
+		if path is None:
+			return None
+		try:
+			return cls(path)
+		except EnvironmentError as e:
+			raise IpcException("could not listen on %s: %s" % (path, str(e)))
+
+	def _removeStaleSocket(self):
+		"Removes the socket left by the monitor which wasn't stopped cleanly. Fails if a monitor listens on it."
+		if not os.path.exists(self._path):
+			return
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(self._path)
+		except socket.error:
+			os.unlink(self._path)
+			return
+		finally:
+			probe.close()
+		raise IpcException("another monitor publishes on " + self._path)
+
+	def getPath(self):
+		"Returns the path of the socket."
+		return self._path
+
+	def publish(self, deviceId, timestamp, measurement, interval = None):
+		"Sends the measurement to all subscribers. It doesn't wait for them, slow ones are disconnected."
+		sample = {'device' : deviceId, 'time' : time.strftime("%Y-%m-%dT%H:%M:%SZ", timestamp),
+			'cpm' : measurement.cpm, 'radiation' : measurement.radiation, 'voltage' : measurement.voltage,
+			'interval' : interval}
+		line = _encode(dict(sample, type = 'sample'))
+		with self._lock:
+			self._latest[deviceId] = sample
+			for client, pending in self._clients.iteritems():
+				if len(pending) < MAX_CLIENT_BACKLOG:
+					pending.append(line)
+				else:
+					self._slow.add(client)
+		self._wakeup()
+
+	def _wakeup(self):
+		try:
+			os.write(self._wakeupWrite, 'x')
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def run(self):
+		while not self._stopped:
+			with self._lock:
+				clients = self._clients.keys()
+				writing = [client for client, pending in self._clients.iteritems() if len(pending) > 0]
+			try:
+				readable, writable, failed = select.select([self._listener, self._wakeupRead] + clients, writing, [])
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			for fd in readable:
+				if fd is self._listener:
+					self._accept()
+				elif fd == self._wakeupRead:
+					try:
+						os.read(self._wakeupRead, 4096)
+					except OSError:
+						pass
+				else:
+					self._receive(fd)
+			for client in writable:
+				self._send(client)
+
+			with self._lock:
+				slow = list(self._slow)
+				self._slow.clear()
+			for client in slow:
+				self._log.info("Disconnecting subscriber, which doesn't keep up.")
+				self._disconnect(client)
+
+		with self._lock:
+			for client in self._clients:
+				client.close()
+			self._clients = {}
+
+	def _accept(self):
+		try:
+			client, address = self._listener.accept()
+		except socket.error:
+			return
+		client.setblocking(False)
+		with self._lock:
+			samples = [self._latest[deviceId] for deviceId in sorted(self._latest)]
+			self._clients[client] = [_encode({'type' : 'snapshot', 'samples' : samples})]
+		self._log.info("Subscriber connected, %d subscribers.", len(self._clients))
+
+	def _receive(self, client):
+		"Subscribers don't send anything, so readable socket means it was closed."
+		try:
+			data = client.recv(4096)
+		except socket.error:
+			data = ''
+		if data == '':
+			self._disconnect(client)
+
+	def _send(self, client):
+		with self._lock:
+			pending = self._clients.get(client)
+			if pending is None:
+				return
+			data = ''.join(pending)
+			try:
+				sent = client.send(data)
+				self._clients[client] = [data[sent:]] if sent < len(data) else []
+				return
+			except socket.error as e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+		self._log.info("Disconnecting subscriber: %s.", str(e))
+		self._disconnect(client)
+
+	def _disconnect(self, client):
+		with self._lock:
+			if self._clients.pop(client, None) is None:
+				return
+		client.close()
+
+	def stop(self):
+		"Disconnects the subscribers and removes the socket."
+		self._stopped = True
+		self._wakeup()
+		if self.isAlive():
+			self.join()
+		self._listener.close()
+		os.close(self._wakeupRead)
+		os.close(self._wakeupWrite)
+		try:
+			os.unlink(self._path)
+		except OSError:
+			pass
+
+
+def subscribe(path = DEFAULT_SOCKET, timeout = None):
+	"""Connects to the monitor publishing on the socket and yields the received messages as dictionaries, starting
+	with the snapshot. Raises IpcException if there's no monitor or the connection fails.
+	"""
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	connection.settimeout(timeout)
+	try:
+		try:
+			connection.connect(path)
+		except socket.error as e:
+			raise IpcException("no monitor publishes on %s: %s" % (path, str(e)))
+
+		buffered = ''
+		while True:
+			try:
+				data = connection.recv(4096)
+			except socket.error as e:
+				raise IpcException("error at receiving from %s: %s" % (path, str(e)))
+			if data == '':
+				return
+			lines = (buffered + data).split('\n')
+			buffered = lines.pop()
+			for line in lines:
+				yield json.loads(line)
+	finally:
+		connection.close()
+
+def readSnapshot(path = DEFAULT_SOCKET, timeout = 1.0):
+	"Returns the list of the latest samples of each device from the monitor publishing on the socket."
+	for message in subscribe(path, timeout):
+		return message['samples']
+	raise IpcException("monitor closed the connection")
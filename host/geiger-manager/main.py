@@ -6,6 +6,10 @@
  * This code is distributed under the terms of GNU General Public License version 3.0.
 '''
 
+# the startup time is measured from here, so it includes importing the modules
+import clock
+startTime = clock.monotonic()
+
 import argparse
 import ConfigParser
 import usbcomm
@@ -33,6 +37,9 @@ def signalHandler(signum, frame):
 		logger.info("Catched signal no. %d, stopping.", signum)
 		global monitor
 		monitor.stop()
+		global publisher
+		if publisher is not None:
+			publisher.stop()
 		logging.shutdown()
 		sys.exit(1)
 
@@ -49,10 +56,16 @@ parser.add_argument("-b", "--background", action = 'store_true', help = "runs as
 group = parser.add_mutually_exclusive_group()
 group.add_argument("-m", "--monitor", action = 'store_true', help = "starts program in monitor mode")
 group.add_argument("-s", "--status", action = 'store_true', help = "reads data from Geiger device and leaves (enabled by default)")
+group.add_argument("-l", "--list", action = 'store_true', help = "lists all connected Geiger devices and leaves")
+# started by the supervisor with the IDs of the devices the worker process monitors
+group.add_argument("--worker", nargs = 1, help = argparse.SUPPRESS)
 
 args = parser.parse_args()
 
-if args.verbose and not args.background:
+# standard output of the worker is the pipe to the supervisor, so it gets only the log, on stderr
+console = sys.stderr if args.worker else sys.stdout
+
+if args.verbose and not args.background and not args.worker:
 	print("Geiger manager v. " + __version__ + ', ' + __author__)
 
 # become a daemon and fork
@@ -63,7 +76,7 @@ if args.background:
 if args.config:
 	CONFIG_PATH = []
 	CONFIG_PATH.append(args.config[0])
-	if args.verbose and not args.background:
+	if args.verbose and not args.background and not args.worker:
 		print("Using configuration file '%s'" % args.config[0])
 
 # load configuration file
@@ -73,7 +86,8 @@ for filePath in CONFIG_PATH:
 	try:
 		conf.readfp(open(filePath))
 		configurationLoaded = True
-		if args.verbose and not args.background:
+		configPath = filePath
+		if args.verbose and not args.background and not args.worker:
 			print("Configuration file loaded from: " + filePath)
 		break
 	except IOError:
@@ -98,11 +112,11 @@ else:
 	logger.setLevel(logging.ERROR)
 
 if not args.background:
-	consoleLog = logging.StreamHandler(sys.stdout)
+	consoleLog = logging.StreamHandler(console)
 	consoleLog.setFormatter(logFormatter)
 	logger.addHandler(consoleLog)
 
-if not args.monitor:
+if not args.monitor and not args.worker:
 	loggingEnabled = False
 
 if loggingEnabled:
@@ -114,27 +128,124 @@ if loggingEnabled:
 		print >> sys.stderr, ("Could open log file to write: %s" % str(exp))
 		sys.exit(1)
 
-# establish USB connection
+# if the monitor is running, take the measurements from it instead of competing with it for the devices
+if not args.monitor and not args.list and not args.worker:
+	import ipc
+	try:
+		socketPath = ipc.getSocketPath(conf)
+	except ipc.IpcException as exp:
+		logger.critical("Error at loading IPC settings: %s", str(exp))
+		sys.exit(1)
+
+	if socketPath is not None and os.path.exists(socketPath):
+		try:
+			samples = ipc.readSnapshot(socketPath)
+		except ipc.IpcException as exp:
+			logger.info("Reading devices directly: %s", str(exp))
+		else:
+			if len(samples) == 0:
+				print >> sys.stderr, ("Monitor is running, but it has no measurements yet.")
+				sys.exit(1)
+			for sample in samples:
+				text = "Radiation: %s uS/h, CPM: %s, supply: %s V, measured at %s" % (sample['radiation'], sample['cpm'],
+					sample['voltage'], sample['time'])
+				if len(samples) > 1:
+					print(sample['device'] + ": " + text)
+				else:
+					print(text)
+			sys.exit()
+
 try:
-	logger.info("Initializing Geiger device...")
-	comm = usbcomm.Connector(conf)
+	usbcomm.configureTransport(conf)
 except usbcomm.CommException as exp:
-	logger.critical("Error at initializing USB device: %s", str(exp))
+	logger.critical("Error at initializing USB transport: %s", str(exp))
 	sys.exit(1)
 
+if args.list:
+	for info in usbcomm.listDevices():
+		print("%s: bus %d, port %s, address %d, serial: %s" % (info.deviceId, info.bus, info.port, info.address, info.serial))
+	sys.exit()
+
+if args.worker:
+	import supervisor
+	supervisor.runWorker(conf, args.worker[0].split(';'))
+	sys.exit()
+
+# in supervisor mode the devices are opened by the worker processes
+supervised = False
+if args.monitor:
+	import supervisor
+	try:
+		supervised = supervisor.isEnabled(conf)
+	except supervisor.SupervisorException as exp:
+		logger.critical("Error at loading supervisor settings: %s", str(exp))
+		sys.exit(1)
+
+# establish USB connections
+if not supervised:
+	try:
+		logger.info("Initializing Geiger devices...")
+		comms = usbcomm.openConnectors(conf)
+	except usbcomm.CommException as exp:
+		logger.critical("Error at initializing USB device: %s", str(exp))
+		sys.exit(1)
+
+publisher = None
+
 # register SIGINT (Ctrl-C) signal handler
 signal.signal(signal.SIGINT, signalHandler)
 signal.signal(signal.SIGTERM, signalHandler)
 
 # start monitor mode
 if args.monitor:
-	import monitor
-	monitor = monitor.Monitor(configuration = conf, usbcomm = comm)
+	import tracing
+	try:
+		profilerSwitch = tracing.configure(conf)
+	except tracing.TracingException as exp:
+		logger.critical("Error at configuring tracing: %s", str(exp))
+		sys.exit(1)
+
+	if supervised:
+		try:
+			monitor = supervisor.Supervisor.fromConfiguration(conf, configPath, args.verbose)
+		except supervisor.SupervisorException as exp:
+			logger.critical("Error at starting supervisor: %s", str(exp))
+			sys.exit(1)
+	else:
+		import monitor
+		monitor = monitor.createMonitor(configuration = conf, connectors = comms)
 	monitor.start()
 
+	import status
+	try:
+		statusServer = status.StatusServer.fromConfiguration(monitor, conf)
+	except status.StatusException as exp:
+		logger.error("Error at starting status server: %s", str(exp))
+		statusServer = None
+	if statusServer is not None:
+		logger.info("Status server listens on %s:%d.", *statusServer.getAddress())
+		statusServer.start()
+
+	import ipc
+	try:
+		publisher = ipc.SamplePublisher.fromConfiguration(conf)
+	except ipc.IpcException as exp:
+		logger.error("Error at starting measurement publisher: %s", str(exp))
+		publisher = None
+	if publisher is not None:
+		logger.info("Publishing measurements on %s.", publisher.getPath())
+		monitor.addListener(publisher.publish)
+		publisher.start()
+
+	logger.info("Monitor started in %.2f s.", clock.monotonic() - startTime)
+
 	while True:
 		time.sleep(5)
 
-# default behavior: display values from Geiger device and leave
-print(comm)
+# default behavior: display values from Geiger devices and leave
+for comm in comms:
+	if len(comms) > 1:
+		print(comm.getDeviceId() + ": " + str(comm))
+	else:
+		print(comm)
 sys.exit()
@@ -6,80 +6,366 @@
 '''
 
 import sys
-import os
 import threading
-import thread
 import time
+import calendar
+import heapq
+import itertools
+import functools
+import collections
 import updaters.dummy
-import importlib
 import ConfigParser
 import usbcomm
 import logging
+import dispatch
+import events
+import rollup
+import clock
+import asynccomm
+import tracing
+import adaptive
+import detector
+
+# the device publishes CPI at the end of each counting interval; reading it in the middle of the next interval keeps
+# the read farthest from both boundaries, so small timing errors never make it catch the same CPI twice or skip one
+READ_PHASE = 0.5
+
+# number of the latest job delays kept for the percentiles
+JITTER_HISTORY = 1000
+
+# a lost device is looked for after INITIAL_BACKOFF seconds, then the wait is doubled up to 'max_backoff'
+INITIAL_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 300.0
+
+class Scheduler(threading.Thread):
+	"""Runs timed jobs of all devices in one thread, so the number of threads doesn't grow with the number of devices.
+	Each job is called with its deadline as the only argument and is responsible for scheduling its next run.
+	Deadlines are absolute times of the monotonic clock (see clock.monotonic()), so setting the system time doesn't
+	move them and periodic jobs don't drift. The delay of each job start after its deadline is recorded. An exception
+	raised by the job is logged, so it doesn't stop the jobs of the other devices.
+	"""
+
+	_log = None
+	_queue = None
+	_condition = None
+	_stopped = False
+	_sequence = None
+
+	_runs = 0
+	_delaySum = 0.0
+	_delayMax = 0.0
+	_delays = None
+	_missed = 0
+
+	def __init__(self):
+		threading.Thread.__init__(self, name = "geiger-scheduler")
+		self.setDaemon(True)
+		self._log = logging.getLogger("geiger.monitor")
+		self._queue = []
+		self._condition = threading.Condition()
+		self._sequence = itertools.count()
+		self._delays = collections.deque(maxlen = JITTER_HISTORY)
+
+	def schedule(self, deadline, job):
+		"Adds job to be run at given time of the monotonic clock."
+		with self._condition:
+			heapq.heappush(self._queue, (deadline, next(self._sequence), job))
+			self._condition.notify()
+
+	def nextTick(self, deadline, period):
+		"""Returns the deadline of the next run of the periodic job: deadline + period, or if that's already past,
+		the first later tick deadline + k * period. Skipped ticks are counted as missed, so a late job catches up
+		with one run instead of a burst of runs, and keeps its phase.
+		"""
+		tick = deadline + period
+		now = clock.monotonic()
+		if tick <= now:
+			missed = int((now - tick) // period) + 1
+			tick += missed * period
+			with self._condition:
+				self._missed += missed
+		return tick
+
+	def getStatistics(self):
+		"""Returns the dictionary with: runs - number of jobs run, missed - ticks skipped by periodic jobs which were
+		late, delayMean, delayMax - mean and maximal delay of the job start after the deadline in seconds, delayP50,
+		delayP99 - percentiles of the delay of latest jobs.
+		"""
+		with self._condition:
+			delays = sorted(self._delays)
+			runs = self._runs
+			statistics = {'runs' : runs, 'missed' : self._missed, 'delayMax' : self._delayMax,
+				'delayMean' : self._delaySum / runs if runs > 0 else None}
+		for name, fraction in (('delayP50', 0.5), ('delayP99', 0.99)):
+			statistics[name] = delays[int(fraction * (len(delays) - 1))] if len(delays) > 0 else None
+		return statistics
+
+	def stop(self):
+		"Stops the scheduler. Jobs which are already running are finished."
+		with self._condition:
+			self._stopped = True
+			self._queue = []
+			self._condition.notify()
+
+	def run(self):
+		while True:
+			with self._condition:
+				while not self._stopped:
+					if len(self._queue) == 0:
+						self._condition.wait()
+						continue
+					delay = self._queue[0][0] - clock.monotonic()
+					if delay <= 0:
+						break
+					self._condition.wait(delay)
+
+				if self._stopped:
+					return
+
+				deadline, sequence, job = heapq.heappop(self._queue)
+
+				late = clock.monotonic() - deadline
+				self._runs += 1
+				self._delaySum += late
+				self._delayMax = max(self._delayMax, late)
+				self._delays.append(late)
+
+			try:
+				job(deadline)
+			except Exception:
+				self._log.exception("Error in scheduled job.")
+
+
+class Device(object):
+	"""Holds the connector of single Geiger device along with its ID and the event capture, if it's enabled.
+	anchor is the monotonic time when the device was programmed, which starts its first counting interval.
+	latest is the last usbcomm.Measurement of the device and latestTime its UTC time_struct. measurements and errors
+	count successful reads and USB errors. lost is True while the device can't be found; failures counts the
+	attempts to find it, which set the backoff. sequence is the number of the latest interval read from the history
+	of the device, None if the firmware doesn't keep it or the device was just programmed; missed counts
+	the intervals which dropped out of the history before they were read. interval is the measuring interval of
+	the device in seconds, changed by the controller (adaptive.IntervalController) if it's enabled.
+	"""
+
+	connector = None
+	deviceId = None
+	events = None
+	anchor = None
+	asyncConnector = None
+
+	latest = None
+	latestTime = None
+	measurements = 0
+	errors = 0
+
+	lost = False
+	failures = 0
+	recoveryToken = 0
+
+	sequence = None
+	missed = 0
+
+	interval = None
+	controller = None
+
+	def __init__(self, connector):
+		self.connector = connector
+		self.deviceId = connector.getDeviceId()
+
 
 class Monitor(object):
 
 	_interval = None
-	_usbcomm = None
+	_devices = None
 	_log = False
 	_configuration = None
 
-	_timer = None
+	_scheduler = None
+	_rollups = None
+	_analytics = None
+	_detector = None
+	_watcher = None
+	_maxBackoff = DEFAULT_MAX_BACKOFF
+	_pollIntervals = 1
 
-	_updatersList = []
+	_updatersList = None
+	_listeners = None
+	_alertListeners = None
 
-	def __init__(self, configuration, usbcomm):
+	def __init__(self, configuration, connectors, measuring = True, updating = True):
+		"""Takes ConfigParser instance and the list of Connector instances. A single Connector is accepted too.
+		Without 'measuring' the analytics and the change detector aren't set up, without 'updating' the updaters
+		aren't loaded; the supervisor (see supervisor.py) uses them to split the work between the processes.
+		"""
 		self._log = logging.getLogger("geiger.monitor")
-		self._usbcomm = usbcomm
 		self._configuration = configuration
+		self._updatersList = []
+		self._listeners = []
+		self._alertListeners = []
 		confFileSection = 'monitor'
 		try:
 			self._interval = configuration.getint(confFileSection, 'interval')
-		except ConfigParser.Error as e:
+			if not 1 <= self._interval <= usbcomm.MAX_INTERVAL:
+				raise ValueError("it has to be between 1 and %d seconds" % usbcomm.MAX_INTERVAL)
+		except (ConfigParser.Error, ValueError) as e:
 			self._log.critical("Measuring interval wrong or not provided: %s.", str(e))
 			sys.exit(1)
 
-		self._log.info("Setting programmed voltage and interval to %d seconds.", self._interval)
+		try:
+			if configuration.has_option(confFileSection, 'max_backoff'):
+				self._maxBackoff = configuration.getfloat(confFileSection, 'max_backoff')
+		except (ConfigParser.Error, ValueError) as e:
+			self._log.critical("Wrong maximal backoff: %s.", str(e))
+			sys.exit(1)
 
-		usbcomm.setVoltageFromConfigFile()
-		usbcomm.setInterval(self._interval)
+		try:
+			if configuration.has_option(confFileSection, 'poll_intervals'):
+				self._pollIntervals = configuration.getint(confFileSection, 'poll_intervals')
+			if not 1 <= self._pollIntervals <= usbcomm.HISTORY_LENGTH:
+				raise ValueError("it has to be between 1 and %d" % usbcomm.HISTORY_LENGTH)
+		except (ConfigParser.Error, ValueError) as e:
+			self._log.critical("Wrong number of intervals between reads: %s.", str(e))
+			sys.exit(1)
 
-		# initialize all updater modules in the directory
-		for files in os.listdir(os.path.join(os.path.dirname(__file__), "updaters")):
-			if files.endswith(".py"):
-				self._initializeUpdater(files[:-3])
+		if isinstance(connectors, usbcomm.RawConnector):
+			connectors = [connectors]
+		self._devices = [Device(connector) for connector in connectors]
 
+		try:
+			for device in self._devices:
+				device.events = events.EventCapture.fromConfiguration(device.connector, configuration)
+		except usbcomm.CommException as e:
+			self._log.critical("Error at setting up event capture: %s.", str(e))
+			sys.exit(1)
 
-	def _initializeUpdater(self, importName):
-		importlib.import_module("updaters." + importName, "updaters")
+		try:
+			for device in self._devices:
+				device.interval = self._interval
+				device.controller = adaptive.IntervalController.fromConfiguration(configuration)
+		except adaptive.AdaptiveException as e:
+			self._log.critical("Error at setting up adaptive interval: %s.", str(e))
+			sys.exit(1)
+
+		self._scheduler = Scheduler()
+
+		try:
+			confidence = rollup.DEFAULT_CONFIDENCE
+			if configuration.has_option(confFileSection, 'confidence'):
+				confidence = configuration.getfloat(confFileSection, 'confidence')
+			self._rollups = rollup.RollupStage(confidence)
+		except (ConfigParser.Error, ValueError) as e:
+			self._log.critical("Wrong confidence level: %s.", str(e))
+			sys.exit(1)
 
-		module = sys.modules["updaters." + importName]
+		if measuring:
+			self._setUpAnalysis(configuration)
+		if updating:
+			self._loadUpdaters(configuration)
+
+	def _setUpAnalysis(self, configuration):
+		# numpy is needed only by the analytics, so it's imported only if they're configured
+		if configuration.has_section('analytics'):
+			try:
+				import analytics
+				self._analytics = analytics.OnlineAnalytics.fromConfiguration(configuration,
+					[device.deviceId for device in self._devices], self._interval)
+			except ImportError as e:
+				self._log.error("Analytics disabled, they need numpy: %s.", str(e))
+			except analytics.AnalyticsException as e:
+				self._log.critical("Error at setting up analytics: %s.", str(e))
+				sys.exit(1)
+			if self._analytics is not None:
+				self.addListener(self._analytics.add)
+
+		try:
+			self._detector = detector.DetectorStage.fromConfiguration(configuration)
+		except detector.DetectorException as e:
+			self._log.critical("Error at setting up change detector: %s.", str(e))
+			sys.exit(1)
+		if self._detector is not None:
+			# with event capture each count is tested as soon as it's captured
+			for device in self._devices:
+				if device.events is not None:
+					device.events.setListener(functools.partial(self._detectEvent, device))
 
-		for elem in getattr(module, '__dict__'):
-			if elem.endswith('Updater'):
-				className = elem
+	def _loadUpdaters(self, configuration):
+		# import and initialize only the enabled updaters
+		started = clock.monotonic()
 		try:
-			name = getattr(module, 'IDENTIFICATOR')
-		except:
+			enabled = updaters.enabledUpdaters(configuration)
+		except updaters.PluginException as e:
+			self._log.critical("Error at loading updaters: %s.", str(e))
+			sys.exit(1)
+		for section, moduleName, className in enabled:
+			self._initializeUpdater(section, moduleName, className)
+		self._log.info("%d updaters initialized in %.0f ms.", len(self._updatersList),
+			(clock.monotonic() - started) * 1000.0)
+
+	def _initializeUpdater(self, section, moduleName, className):
+		try:
+			updaterClass, name = updaters.loadUpdater(moduleName, className)
+		except updaters.PluginException as e:
+			self._log.error("Error at loading updater of section [%s]: %s. Disabling.", section, str(e))
 			return
 		try:
-			u = getattr(module, className)(self._configuration)
+			u = updaterClass(self._configuration)
 			if u.isEnabled():
-				self._updatersList.append(u)
-				self._log.info("%s updater enabled.", name)
+				u.setDevices([device.deviceId for device in self._devices])
+				# each updater works in its own thread, so a slow one doesn't delay the others
+				queued = dispatch.QueuedUpdater.fromConfiguration(u, name, self._configuration, section)
+				self._updatersList.append(queued)
+				self._log.info("%s updater enabled, resolution: %s.", name, queued.getResolution())
 		except updaters.dummy.UpdaterException as e:
 			self._log.error("Error at initializing %s updater: %s. Disabling.", name, str(e))
 
 	def start(self):
-		"""Enables cyclic monitoring. The first measurement cycle has the 1.5 length of the given interval
-		in order to collect data by the device.
+		"""Enables cyclic monitoring. The devices are programmed one after another, spread evenly over one interval,
+		so their reads don't hit the bus at the same moment. The first measurement of each device takes place
+		1.5 interval after programming it in order to collect data by the device.
 		"""
-		self._timer = threading.Timer(1.5 * self._interval, self._update)
-		self._timer.setDaemon(True)
-		self._timer.start()
+		now = clock.monotonic()
+		for number, device in enumerate(self._devices):
+			stagger = float(number) * self._interval / len(self._devices)
+			self._scheduler.schedule(now + stagger, functools.partial(self._program, device))
+			if device.events is not None:
+				self._log.info("Starting event capture of device %s.", device.deviceId)
+				device.events.start()
+		self._scheduler.start()
+
+		if len(self._devices) > 0:
+			self._watcher = usbcomm.ReplugWatcher(self._devices[0].connector.getTransport(), self._devicesChanged)
+			self._watcher.start()
 
 	def stop(self):
 		"""Stops measuring cycle and closes all updaters."""
-		self._timer.cancel()
+		self._scheduler.stop()
+		if self._scheduler.isAlive():
+			# the job which is running may still pass its measurement to the updaters
+			self._scheduler.join()
+		if self._watcher is not None:
+			self._watcher.stop()
+
+		statistics = self._scheduler.getStatistics()
+		self._log.info("Scheduler ran %d jobs, mean delay %.1f ms, max. %.1f ms, %d ticks missed.", statistics['runs'],
+			(statistics['delayMean'] or 0.0) * 1000.0, statistics['delayMax'] * 1000.0, statistics['missed'])
+
+		for device in self._devices:
+			if device.events is not None:
+				device.events.stop()
+
+		self._closeUpdaters()
+
+	def _closeUpdaters(self):
+		"""Passes the rollups of the periods in progress to the updaters of their resolution, so they don't lose up
+		to the whole period, and closes all updaters.
+		"""
+		for aggregate in self._rollups.flush():
+			for updater in self._updatersList:
+				if updater.getResolution() == aggregate.resolution:
+					try:
+						updater.updateRollup(aggregate)
+					except updaters.dummy.UpdaterException as exp:
+						self._log.error("Updater error: %s", str(exp))
 
 		self._log.info("Stopping all updaters.")
 
@@ -87,46 +373,395 @@ class Monitor(object):
 			if updater.isEnabled():
 				updater.close()
 
-	def _update(self):
-		"""This method is called by the internal timer every 'interval' time to gather measurements
+	def _program(self, device, deadline):
+		"""Sets the tube voltage and the interval of the device. CPI is cleared by the device then, so the first
+		measurement is scheduled after 1.5 interval.
+		"""
+		try:
+			self._log.info("Setting programmed voltage and interval of device %s to %d seconds.", device.deviceId, device.interval)
+			device.connector.setVoltageFromConfigFile()
+			device.connector.setInterval(device.interval)
+		except usbcomm.CommException as e:
+			self._log.error("Error at programming device %s: %s.", device.deviceId, str(e))
+			device.errors += 1
+			self._lose(device)
+			return
+		except Exception:
+			# looking for the device again is the only way to retry programming
+			self._log.exception("Unexpected error at programming device %s.", device.deviceId)
+			self._lose(device)
+			return
+
+		# the history of the device starts anew
+		device.sequence = None
+		device.lost = False
+		device.failures = 0
+		if device.controller is not None:
+			device.controller.reset()
+		self._scheduleFirstRead(device)
+
+	def _scheduleFirstRead(self, device):
+		"""Setting the interval starts the counting interval of the device. The first complete one ends
+		one interval later, so it's read in the middle of the second one.
+		"""
+		device.anchor = clock.monotonic()
+		self._scheduler.schedule(device.anchor + (1 + READ_PHASE) * device.interval, functools.partial(self._update, device))
+
+	def _handleError(self, device, error, deadline, timestamp):
+		"""Recovers the device after the failed read. Transient errors are handled by the connector, which repeats
+		the transfer; here the device is reopened or reset (see usbcomm.RawConnector.recover()). If it kept its
+		settings, it's read again at once, so the measurement isn't lost. If it was plugged in again, it's programmed
+		like at start. If it can't be found, it's looked for with exponential backoff, or at once when any device
+		is plugged in. The devices are never given up.
+		"""
+		self._log.error("USB device %s error: %s.", device.deviceId, str(error))
+		device.errors += 1
+		address = device.connector.getDeviceInfo().address
+		try:
+			method = device.connector.recover()
+			intact = device.connector.getDeviceInfo().address == address and device.connector.getInterval() == device.interval
+		except usbcomm.CommException as e:
+			self._log.error("Device %s lost: %s.", device.deviceId, str(e))
+			self._lose(device)
+			return
+
+		if not intact:
+			self._log.info("Device %s recovered by %s, but it lost its settings.", device.deviceId, method)
+			self._program(device, deadline)
+			return
+
+		self._log.info("Device %s recovered by %s, reading it again.", device.deviceId, method)
+		try:
+			measurements = self._read(device)
+		except usbcomm.CommException as e:
+			self._log.error("Device %s lost: %s.", device.deviceId, str(e))
+			device.errors += 1
+			self._lose(device)
+			return
+
+		self._publish(device, deadline, timestamp, measurements)
+
+	def _lose(self, device):
+		"Marks the device as lost and schedules looking for it, waiting twice longer after each failed attempt."
+		device.lost = True
+		delay = min(self._maxBackoff, INITIAL_BACKOFF * 2 ** device.failures)
+		device.failures += 1
+		self._log.info("Looking for device %s in %.0f seconds.", device.deviceId, delay)
+		self._scheduleRecovery(device, clock.monotonic() + delay)
+
+	def _scheduleRecovery(self, device, deadline):
+		"Schedules looking for the lost device. The attempts scheduled before are cancelled."
+		device.recoveryToken += 1
+		self._scheduler.schedule(deadline, functools.partial(self._recoverLost, device, device.recoveryToken))
+
+	def _recoverLost(self, device, token, deadline):
+		"Looks for the lost device. If it's found, it's programmed like at start."
+		if token != device.recoveryToken or not device.lost:
+			return
+		try:
+			method = device.connector.recover()
+		except usbcomm.CommException as e:
+			self._log.error("Device %s still lost: %s.", device.deviceId, str(e))
+			self._lose(device)
+			return
+		except Exception:
+			self._log.exception("Unexpected error at looking for device %s.", device.deviceId)
+			self._lose(device)
+			return
+
+		self._log.info("Device %s found again by %s.", device.deviceId, method)
+		self._program(device, deadline)
+
+	def _devicesChanged(self):
+		"Called by the replug watcher. The lost devices are looked for at once instead of waiting for the backoff."
+		now = clock.monotonic()
+		for device in self._devices:
+			if device.lost:
+				self._scheduleRecovery(device, now)
+
+	@tracing.traced('monitor.update')
+	def _update(self, device, deadline):
+		"""This method is called by the scheduler every 'interval' time to gather measurements of the device
 		and send them to specified updaters. The first cycle has 1.5*interval length to give the
 		Geiger device time to collect counts. Then, update takes place in the middle of the next
-		measuring cycle.
+		measuring cycle. The deadlines are anchor + (n + 1.5) * interval, so they stay in the middle of the device
+		intervals; if the read is late by more than an interval, the missed reads are skipped.
 		"""
 
-		self._timer = threading.Timer(self._interval, self._update)
-		self._timer.setDaemon(True)
-		# start new cycle here to prevent shifting next update time stamp
-		self._timer.start()
-
 		timestamp = time.gmtime()
 
 		try:
-			cpm, radiation = self._usbcomm.getCPMandRadiation()
+			measurements = self._read(device)
 		except usbcomm.CommException as e:
-			self._log.error("USB device error: %s. Forcing device reset and wait of 1.5 cycle length.", str(e))
-			self._log.info("Resetting device.")
-			try:
-				self._usbcomm.resetConnection()
-				self._log.info("Setting programmed voltage and interval to %d seconds.", self._interval)
-				self._usbcomm.setVoltageFromConfigFile()
-				self._usbcomm.setInterval(self._interval)
-			except usbcomm.CommException as e:
-				self._log.critical("Error at reinitializing device: %s", str(e))
-				self.stop()
-				# close entire application
-				thread.interrupt_main()
-
-			self._timer.cancel()
-			self._timer = threading.Timer(1.5 * self._interval, self._update)
-			self._timer.setDaemon(True)
-			self._timer.start()
+			self._handleError(device, e, deadline, timestamp)
+			return
+		except Exception:
+			self._log.exception("Unexpected error at reading device %s.", device.deviceId)
+			self._scheduleNextRead(device, deadline, device.interval)
 			return
 
-		self._log.info("pushing data: %f CPM, %f uSv/h", cpm, radiation)
+		self._publish(device, deadline, timestamp, measurements)
+
+	def _scheduleNextRead(self, device, deadline, period):
+		# next cycle is relative to the deadline to prevent shifting next update time stamp
+		self._scheduler.schedule(self._scheduler.nextTick(deadline, period), functools.partial(self._update, device))
+
+	def _read(self, device):
+		"""Returns the list of measurements of the intervals completed since the last read, the oldest first. If the
+		firmware keeps the history, they all come in one transfer and the intervals which dropped out of it are
+		counted; otherwise only the latest interval is read.
+		"""
+		history = device.connector.getMeasurements(device.sequence)
+		if history is None:
+			return [device.connector.getMeasurement()]
+
+		sequence, measurements, lost = history
+		if lost > 0:
+			self._log.warning("%d intervals of device %s lost before they were read.", lost, device.deviceId)
+			device.missed += lost
+		device.sequence = sequence
+		return measurements
+
+	@tracing.traced('monitor.publish')
+	def _publish(self, device, deadline, timestamp, measurements):
+		"""Schedules the next read of the device and passes the measurements to the updaters. The latest one is taken
+		at the time of the read, the earlier ones one interval before each other. If the device keeps the history, it's
+		read every 'poll_intervals' intervals.
+		"""
+		interval = device.interval
+		if not self._adapt(device, measurements):
+			self._scheduleNextRead(device, deadline, interval * (self._pollIntervals if device.sequence is not None else 1))
+
+		seconds = calendar.timegm(timestamp)
+		for number, measurement in enumerate(measurements):
+			self._pass(device, time.gmtime(seconds - (len(measurements) - 1 - number) * interval), measurement, interval)
+
+	def _adapt(self, device, measurements):
+		"""Asks the controller of the device for the interval fitting the latest measurement. If it's different,
+		the device is programmed with it; that restarts counting, so the reads start anew like after programming.
+		Returns True if the next read is already taken care of.
+		"""
+		if device.controller is None or len(measurements) == 0:
+			return False
+		interval = device.controller.update(device.interval, measurements[-1].cpm)
+		if interval is None:
+			return False
+		if not 1 <= interval <= usbcomm.MAX_INTERVAL:
+			# a wrong setting, not a fault of the device, so the device isn't treated as lost
+			self._log.error("Interval of %d seconds wanted for device %s is out of range, keeping %d seconds.",
+				interval, device.deviceId, device.interval)
+			return False
+
+		self._log.info("Changing interval of device %s from %d to %d seconds at %.1f CPM.", device.deviceId,
+			device.interval, interval, measurements[-1].cpm)
+		try:
+			device.connector.setInterval(interval)
+		except usbcomm.CommException as e:
+			self._log.error("Error at changing interval of device %s: %s.", device.deviceId, str(e))
+			device.errors += 1
+			self._lose(device)
+			return True
+
+		device.interval = interval
+		device.sequence = None
+		self._scheduleFirstRead(device)
+		return True
+
+	def _pass(self, device, timestamp, measurement, interval):
+		"Caches the measurement and passes it to the listeners, the rollups and the updaters."
+		cpm, radiation = measurement.cpm, measurement.radiation
+		device.latest = measurement
+		device.latestTime = timestamp
+		device.measurements += 1
+
+		self._log.info("pushing data from %s: %f CPM, %f uSv/h", device.deviceId, cpm, radiation)
+
+		if device.events is not None:
+			stats = device.events.getStatistics()
+			self._log.info("events of %s: %d counts, %.1f CPM in last second, %.1f CPM corrected for dead time.",
+				device.deviceId, stats['counts'], stats['cpm'], stats['correctedCPM'] or 0.0)
+
+		for listener in self._listeners:
+			try:
+				listener(device.deviceId, timestamp, measurement, interval)
+			except Exception as exp:
+				self._log.error("Error in measurement listener: %s", str(exp))
+
+		# a failing stage mustn't keep the measurement from the updaters
+		if self._detector is not None and device.events is None:
+			try:
+				self._dispatchAlerts(self._detector.add(device.deviceId, timestamp, cpm, interval))
+			except Exception:
+				self._log.exception("Error in change detector.")
+
+		try:
+			completed = self._rollups.add(device.deviceId, timestamp, cpm, radiation, interval)
+		except Exception:
+			self._log.exception("Error in rollups.")
+			completed = []
 
 		for updater in self._updatersList:
 			try:
-				updater.update(radiation = radiation, cpm = cpm, timestamp = timestamp)
+				if updater.getResolution() == rollup.RAW:
+					updater.update(radiation = radiation, cpm = cpm, timestamp = timestamp, deviceId = device.deviceId)
+				else:
+					for aggregate in completed:
+						if aggregate.resolution == updater.getResolution():
+							updater.updateRollup(aggregate)
 			except updaters.dummy.UpdaterException as exp:
 				self._log.error("Updater error: %s", str(exp))
+
+	def _detectEvent(self, device, when):
+		"Passes the captured count to the detector. Called in the capture thread of the device."
+		try:
+			self._dispatchAlerts(self._detector.addEvent(device.deviceId, when))
+		except Exception as exp:
+			self._log.error("Error in change detector: %s", str(exp))
+
+	def _dispatchAlerts(self, alerts):
+		"Logs the alerts and passes them to the alert listeners and all updaters, whatever their resolution."
+		for alert in alerts:
+			if alert.kind == detector.RISE:
+				self._log.warning("Radiation alarm of device %s: %.1f CPM against %.1f CPM of background.",
+					alert.deviceId, alert.cpm or 0.0, alert.baselineCPM)
+			else:
+				self._log.warning("Radiation alarm of device %s ended at %.1f CPM.", alert.deviceId, alert.cpm or 0.0)
+			for listener in self._alertListeners:
+				try:
+					listener(alert)
+				except Exception as exp:
+					self._log.error("Error in alert listener: %s", str(exp))
+			self._alertUpdaters(alert)
+
+	def _alertUpdaters(self, alert):
+		for updater in self._updatersList:
+			try:
+				updater.alert(alert)
+			except updaters.dummy.UpdaterException as exp:
+				self._log.error("Updater error: %s", str(exp))
+
+	def addListener(self, listener):
+		"""Registers the function called as listener(deviceId, timestamp, measurement, interval) after each
+		measurement, where measurement is usbcomm.Measurement and interval is its length in seconds. It's called
+		in the thread reading the device, so it should return quickly.
+		"""
+		self._listeners.append(listener)
+
+	def addAlertListener(self, listener):
+		"Registers the function called as listener(alert) with each detector.Alert, in the thread which raised it."
+		self._alertListeners.append(listener)
+
+	def addTimer(self, period, function):
+		"""Calls function() every period seconds in the scheduler thread, from start() on. It should return quickly;
+		if the scheduler is held up, e.g. by a device which doesn't respond, the calls stop.
+		"""
+		def tick(deadline):
+			self._scheduler.schedule(self._scheduler.nextTick(deadline, period), tick)
+			function()
+
+		self._scheduler.schedule(clock.monotonic() + period, tick)
+
+	def getDevices(self):
+		"Returns the list of monitored devices, as Device instances."
+		return list(self._devices)
+
+	def getUpdaters(self):
+		"Returns the list of enabled updaters, each wrapped in QueuedUpdater."
+		return list(self._updatersList)
+
+	def getSchedulerStatistics(self):
+		"Returns the statistics of delays of the measurements, see Scheduler.getStatistics()."
+		return self._scheduler.getStatistics()
+
+	def getRollups(self):
+		"Returns RollupStage with minute, hour and day aggregates of all devices."
+		return self._rollups
+
+	def getAnalytics(self):
+		"Returns analytics.OnlineAnalytics of all devices, or None if they're disabled."
+		return self._analytics
+
+	def getDetector(self):
+		"Returns detector.DetectorStage of all devices, or None if it's disabled."
+		return self._detector
+
+	def getWorkerStatistics(self):
+		"Returns the statistics of the worker processes, see supervisor.Supervisor. The monitor has none, so None."
+		return None
+
+
+class AsyncMonitor(Monitor):
+	"""Variant of the monitor which doesn't perform USB transfers in the scheduler thread. Each device is accessed
+	through asynccomm.AsyncConnector; the transfers run in a pool of 'async_workers' threads shared by all devices,
+	so a slow or resetting device doesn't delay the reads of the others. The measurements are passed to
+	the updaters by the pool thread which read them.
+	"""
+
+	_executor = None
+
+	def __init__(self, configuration, connectors, workers = asynccomm.DEFAULT_WORKERS, **parts):
+		super(AsyncMonitor, self).__init__(configuration, connectors, **parts)
+		self._executor = asynccomm.Executor(min(workers, len(self._devices)))
+		for device in self._devices:
+			device.asyncConnector = asynccomm.AsyncConnector(device.connector, self._executor)
+
+	def stop(self):
+		"""Stops measuring cycle, the transfer threads and closes all updaters."""
+		super(AsyncMonitor, self).stop()
+		self._executor.shutdown()
+
+	def _submit(self, device, function, *args):
+		"Runs the function in the order of the device. Errors other than USB ones are logged, as nobody waits for them."
+		future = device.asyncConnector.submit(function, *args)
+		future.addDoneCallback(self._checkError)
+
+	def _checkError(self, future):
+		error = future.exception()
+		if error is not None:
+			self._log.error("Error in device task: %s: %s", type(error).__name__, str(error))
+
+	def _program(self, device, deadline):
+		self._submit(device, super(AsyncMonitor, self)._program, device, deadline)
+
+	def _recoverLost(self, device, token, deadline):
+		self._submit(device, super(AsyncMonitor, self)._recoverLost, device, token, deadline)
+
+	def _update(self, device, deadline):
+		timestamp = time.gmtime()
+		future = device.asyncConnector.submit(self._read, device)
+		future.addDoneCallback(functools.partial(self._readDone, device, deadline, timestamp))
+
+	def _readDone(self, device, deadline, timestamp, future):
+		"""Called when the read finishes. It runs in the order of the device, so _handleError can use the connector.
+		Other errors are logged and the device is read again in the next interval, like in Monitor._update().
+		"""
+		error = future.exception()
+		if error is not None:
+			if isinstance(error, usbcomm.CommException):
+				self._handleError(device, error, deadline, timestamp)
+			else:
+				self._log.error("Unexpected error at reading device %s: %s: %s.", device.deviceId,
+					type(error).__name__, str(error))
+				self._scheduleNextRead(device, deadline, device.interval)
+			return
+
+		self._publish(device, deadline, timestamp, future.result())
+
+
+def createMonitor(configuration, connectors, updating = True):
+	"""Returns AsyncMonitor if the option 'async_workers' in section 'monitor' is greater than zero, otherwise
+	Monitor, which reads the devices in the scheduler thread. Without 'updating' the updaters aren't loaded.
+	"""
+	log = logging.getLogger("geiger.monitor")
+	try:
+		workers = 0
+		if configuration.has_option('monitor', 'async_workers'):
+			workers = configuration.getint('monitor', 'async_workers')
+	except (ConfigParser.Error, ValueError) as e:
+		log.critical("Wrong number of asynchronous workers: %s.", str(e))
+		sys.exit(1)
+
+	if workers > 0:
+		log.info("USB transfers are performed by %d asynchronous workers.", workers)
+		return AsyncMonitor(configuration, connectors, workers, updating = updating)
+	return Monitor(configuration, connectors, updating = updating)
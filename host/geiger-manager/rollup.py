@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import calendar
+import collections
+import math
+import threading
+import time
+
+# resolution name and its length in seconds
+RESOLUTIONS = collections.OrderedDict([('minute', 60), ('hour', 3600), ('day', 86400)])
+RAW = 'raw'
+
+DEFAULT_CONFIDENCE = 0.95
+
+def normalQuantile(probability):
+	"Returns x for which the standard normal distribution function equals probability. Found by bisection of erf."
+	low, high = -10.0, 10.0
+	for i in xrange(100):
+		middle = (low + high) / 2.0
+		if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < probability:
+			low = middle
+		else:
+			high = middle
+	return (low + high) / 2.0
+
+def poissonBounds(counts, z):
+	"""Returns the tuple: lower and upper confidence bound of the mean of Poisson distribution, given the observed
+	number of counts. z is the normal quantile of the wanted confidence, e.g. 1.96 for 95%. Uses Byar's
+	approximation of the exact interval, which is good even for a few counts.
+	"""
+	if counts <= 0:
+		lower = 0.0
+	else:
+		lower = counts * (1.0 - 1.0 / (9.0 * counts) - z / (3.0 * math.sqrt(counts))) ** 3
+	upper = (counts + 1.0) * (1.0 - 1.0 / (9.0 * (counts + 1.0)) + z / (3.0 * math.sqrt(counts + 1.0))) ** 3
+	return (max(lower, 0.0), upper)
+
+
+class Rollup(object):
+	"""Aggregate of the measurements of one device during one period (minute, hour or day). Counts are the numbers
+	of counts in single measuring intervals. cpmLower and cpmUpper are Poisson confidence bounds of the mean CPM.
+	partial is True if the period wasn't over yet, e.g. when the program stopped.
+	"""
+
+	__slots__ = ('deviceId', 'resolution', 'start', 'period', 'samples', 'countSum', 'countMin', 'countMax',
+		'countMean', 'exposure', 'cpm', 'radiation', 'cpmLower', 'cpmUpper', 'partial')
+
+	def __init__(self, **values):
+		for name in self.__slots__:
+			setattr(self, name, values.get(name))
+
+	def asSample(self):
+		"Returns the dictionary of update() arguments: the mean values with the period start as timestamp."
+		return {'timestamp' : time.gmtime(self.start), 'radiation' : self.radiation, 'cpm' : self.cpm,
+			'deviceId' : self.deviceId}
+
+	def asDict(self):
+		"Returns all fields as the dictionary."
+		return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class _Accumulator(object):
+	"Running sums of one period. Adding a measurement takes constant time."
+
+	__slots__ = ('bucket', 'samples', 'countSum', 'countMin', 'countMax', 'exposure', 'radiationSum')
+
+	def __init__(self, bucket):
+		self.bucket = bucket
+		self.samples = 0
+		self.countSum = 0.0
+		self.countMin = None
+		self.countMax = None
+		self.exposure = 0.0
+		self.radiationSum = 0.0
+
+	def add(self, counts, exposure, radiation):
+		self.samples += 1
+		self.countSum += counts
+		self.countMin = counts if self.countMin is None else min(self.countMin, counts)
+		self.countMax = counts if self.countMax is None else max(self.countMax, counts)
+		self.exposure += exposure
+		self.radiationSum += radiation
+
+	def result(self, deviceId, resolution, period, z, partial = False):
+		lower, upper = poissonBounds(self.countSum, z)
+		perMinute = 60.0 / self.exposure if self.exposure > 0 else 0.0
+		return Rollup(deviceId = deviceId, resolution = resolution, start = self.bucket * period, period = period,
+			samples = self.samples, countSum = self.countSum, countMin = self.countMin, countMax = self.countMax,
+			countMean = self.countSum / self.samples, exposure = self.exposure, cpm = self.countSum * perMinute,
+			radiation = self.radiationSum / self.samples, cpmLower = lower * perMinute, cpmUpper = upper * perMinute,
+			partial = partial)
+
+
+class RollupStage(object):
+	"""Keeps minute, hour and day aggregates of each device. The periods are aligned to UTC. A period is complete
+	when the first measurement from the next one arrives; add() returns such completed rollups. flush() returns
+	the periods which are in progress, e.g. when the program stops.
+	"""
+
+	_z = None
+	_current = None
+	_latest = None
+	_lock = None
+
+	def __init__(self, confidence = DEFAULT_CONFIDENCE):
+		self._z = normalQuantile(0.5 + confidence / 2.0)
+		self._current = {}
+		self._latest = {}
+		self._lock = threading.Lock()
+
+	def add(self, deviceId, timestamp, cpm, radiation, interval):
+		"""Adds the measurement: UTC time_struct, CPM, radiation and the measuring interval in seconds. Returns
+		the list of rollups completed by this measurement.
+		"""
+		epoch = calendar.timegm(timestamp)
+		counts = cpm * interval / 60.0
+		completed = []
+
+		with self._lock:
+			for resolution, period in RESOLUTIONS.iteritems():
+				key = (deviceId, resolution)
+				bucket = epoch // period
+				accumulator = self._current.get(key)
+
+				if accumulator is None or accumulator.bucket != bucket:
+					if accumulator is not None and accumulator.samples > 0:
+						rollup = accumulator.result(deviceId, resolution, period, self._z)
+						self._latest[key] = rollup
+						completed.append(rollup)
+					accumulator = self._current[key] = _Accumulator(bucket)
+
+				accumulator.add(counts, interval, radiation)
+
+		return completed
+
+	def getLatest(self, deviceId, resolution):
+		"Returns the last completed rollup of the device or None."
+		with self._lock:
+			return self._latest.get((deviceId, resolution))
+
+	def getCurrent(self, deviceId, resolution):
+		"Returns the rollup of the period which is in progress, or None."
+		with self._lock:
+			accumulator = self._current.get((deviceId, resolution))
+			if accumulator is None or accumulator.samples == 0:
+				return None
+			return accumulator.result(deviceId, resolution, RESOLUTIONS[resolution], self._z, True)
+
+	def flush(self):
+		"""Returns the list of rollups of the periods which are in progress, marked as partial, and starts them anew.
+		The following measurements of the same periods are aggregated separately.
+		"""
+		flushed = []
+		with self._lock:
+			for (deviceId, resolution), accumulator in self._current.iteritems():
+				if accumulator.samples > 0:
+					rollup = accumulator.result(deviceId, resolution, RESOLUTIONS[resolution], self._z, True)
+					self._latest[(deviceId, resolution)] = rollup
+					flushed.append(rollup)
+			self._current = {}
+		return flushed
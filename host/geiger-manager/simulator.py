@@ -0,0 +1,321 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import ConfigParser
+import collections
+import random
+import struct
+import threading
+import time
+import clock
+import usbcomm
+
+# firmware defaults, from global.h
+DEFAULT_INTERVAL_SECONDS = 60
+DEFAULT_GEIGER_VOLTAGE = 395
+
+# default settings, can be changed in [simulator] section
+DEFAULT_DEVICES = 1
+DEFAULT_CPM = 20.0
+DEFAULT_LATENCY = 0.001
+DEFAULT_JITTER = 0.0
+DEFAULT_ERROR_RATE = 0.0
+DEFAULT_DISCONNECT_RATE = 0.0
+DEFAULT_DISCONNECT_TIME = 5.0
+
+# ADC value of the supply voltage measured by the simulated device differs from the programmed one by up to this
+VOLTAGE_NOISE = 2
+
+def _voltageToADC(volts):
+	"The same as VOLTAGE_TO_ADC macro of the firmware."
+	lower = usbcomm.VOLTAGE_DIVIDER_LOWER_RESISTOR
+	upper = usbcomm.VOLTAGE_DIVIDER_UPPER_RESISTOR
+	return int(lower / (lower + upper) * volts * 1024 / 1.1)
+
+class SimulatedDevice(object):
+	"""Emulates the firmware of Geiger device: the request table, counting in programmed intervals and the count
+	acknowledge flag. Counts come at random with given mean CPM, like Poisson process. They are generated lazily,
+	when the device is asked, using the monotonic clock. Each transfer takes 'latency' seconds plus up to 'jitter'
+	seconds and fails with probability 'errorRate'. With probability 'disconnectRate' the transfer disconnects the
+	device for 'disconnectTime' seconds; it comes back with new address and the firmware state reset, like after
+	replugging. If 'snapshot' is False, the device doesn't support GET_SNAPSHOT and GET_HISTORY, like older firmware.
+	"""
+
+	_info = None
+	_random = None
+	_lock = None
+
+	_rate = None
+	_latency = DEFAULT_LATENCY
+	_jitter = DEFAULT_JITTER
+	_errorRate = DEFAULT_ERROR_RATE
+	_disconnectRate = DEFAULT_DISCONNECT_RATE
+	_disconnectTime = DEFAULT_DISCONNECT_TIME
+	_snapshot = True
+
+	_programmedInterval = None
+	_programmedVoltage = None
+	_intervalEnd = None
+	_actualCounts = 0
+	_countsPerInterval = 0
+	_nextCount = None
+	_countAcknowledged = False
+	_absentUntil = None
+	_history = None
+	_historySequence = 0
+
+	_requests = None
+
+	def __init__(self, info, cpm = DEFAULT_CPM, latency = DEFAULT_LATENCY, jitter = DEFAULT_JITTER,
+			errorRate = DEFAULT_ERROR_RATE, disconnectRate = DEFAULT_DISCONNECT_RATE,
+			disconnectTime = DEFAULT_DISCONNECT_TIME, snapshot = True, seed = None):
+		self._info = info
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self._rate = cpm / 60.0
+		self._latency = latency
+		self._jitter = jitter
+		self._errorRate = errorRate
+		self._disconnectRate = disconnectRate
+		self._disconnectTime = disconnectTime
+		self._snapshot = snapshot
+
+		self._requests = {
+			usbcomm.GET_CPI : self._getCPI,
+			usbcomm.SET_INTERVAL : self._setInterval,
+			usbcomm.GET_INTERVAL : self._getInterval,
+			usbcomm.SET_VOLTAGE : self._setVoltage,
+			usbcomm.GET_VOLTAGE : self._getVoltage,
+			usbcomm.ACKNOWLEDGE_UNCHECKED_COUNT : self._acknowledgeUncheckedCount,
+		}
+		if snapshot:
+			self._requests[usbcomm.GET_SNAPSHOT] = self._getSnapshot
+			self._requests[usbcomm.GET_HISTORY] = self._getHistory
+
+		self._powerOn(clock.monotonic())
+
+	def _powerOn(self, now):
+		self._programmedInterval = usbcomm.TIMER_TICKS_PER_SECOND * DEFAULT_INTERVAL_SECONDS
+		self._programmedVoltage = _voltageToADC(DEFAULT_GEIGER_VOLTAGE)
+		self._historySequence = 0
+		self._restartCounting(now)
+
+	def _intervalSeconds(self):
+		return max(self._programmedInterval, 1) / float(usbcomm.TIMER_TICKS_PER_SECOND)
+
+	def _restartCounting(self, now):
+		self._intervalEnd = now + self._intervalSeconds()
+		self._actualCounts = 0
+		self._countsPerInterval = 0
+		self._countAcknowledged = False
+		self._nextCount = self._drawCount(now)
+		self._history = collections.deque(maxlen = usbcomm.HISTORY_LENGTH)
+
+	def _drawCount(self, after):
+		"Returns the time of the next count."
+		if self._rate <= 0:
+			return float('inf')
+		return after + self._random.expovariate(self._rate)
+
+	def _advance(self, now):
+		"Generates the counts and closes the counting intervals up to now."
+		interval = self._intervalSeconds()
+
+		# the intervals older than the ones kept in the history don't matter, only their sequence numbers
+		skipped = int((now - self._intervalEnd) / interval) + 1 - usbcomm.HISTORY_LENGTH
+		if skipped >= 1:
+			start = self._intervalEnd + (skipped - 1) * interval
+			self._intervalEnd = start + interval
+			self._actualCounts = 0
+			self._nextCount = self._drawCount(start)
+			self._historySequence = (self._historySequence + skipped) & 0xff
+
+		while True:
+			if self._nextCount <= self._intervalEnd:
+				if self._nextCount > now:
+					break
+				self._actualCounts += 1
+				self._countAcknowledged = True
+				self._nextCount = self._drawCount(self._nextCount)
+			else:
+				if self._intervalEnd > now:
+					break
+				self._countsPerInterval = self._actualCounts & 0xffff
+				self._actualCounts = 0
+				self._intervalEnd += interval
+				self._history.append(self._countsPerInterval)
+				self._historySequence = (self._historySequence + 1) & 0xff
+
+	def _getCPI(self, value, now):
+		return struct.pack('<H', self._countsPerInterval)
+
+	def _setInterval(self, value, now):
+		self._programmedInterval = value
+		self._restartCounting(now)
+
+	def _getInterval(self, value, now):
+		return struct.pack('<H', self._programmedInterval)
+
+	def _setVoltage(self, value, now):
+		self._programmedVoltage = value
+
+	def _measuredVoltage(self):
+		voltage = self._programmedVoltage + self._random.randint(-VOLTAGE_NOISE, VOLTAGE_NOISE)
+		return min(max(voltage, 0), 1023)
+
+	def _getVoltage(self, value, now):
+		return struct.pack('<H', self._measuredVoltage())
+
+	def _acknowledgeUncheckedCount(self, value, now):
+		flag = self._countAcknowledged
+		self._countAcknowledged = False
+		return struct.pack('<H', 1 if flag else 0)
+
+	def _getSnapshot(self, value, now):
+		flag = self._countAcknowledged
+		if value & 0xff:
+			self._countAcknowledged = False
+		return struct.pack(usbcomm.SNAPSHOT_FORMAT, self._countsPerInterval, self._programmedInterval,
+			self._measuredVoltage(), 1 if flag else 0)
+
+	def _getHistory(self, value, now):
+		stored = len(self._history)
+		count = stored if value & 0xff00 else min((self._historySequence - value) & 0xff, stored)
+		counts = list(self._history)[stored - count:]
+		return struct.pack(usbcomm.HISTORY_HEADER_FORMAT + '%dH' % count, self._historySequence, count,
+			self._programmedInterval, self._measuredVoltage(), *counts)
+
+	def getInfo(self):
+		"Returns DeviceInfo tuple of the device."
+		return self._info
+
+	def isPresent(self):
+		"Returns True if the device is connected."
+		with self._lock:
+			return self._checkPresence(clock.monotonic())
+
+	def _checkPresence(self, now):
+		if self._absentUntil is None:
+			return True
+		if now < self._absentUntil:
+			return False
+
+		# plugged in again: new address and the firmware starts from the beginning
+		self._absentUntil = None
+		self._info = self._info._replace(address = self._info.address % 127 + 1)
+		self._powerOn(now)
+		return True
+
+	def transfer(self, request, value, length = None):
+		"""Handles the vendor request like the firmware does. Returns the response, truncated to length bytes,
+		or None for requests without response. Unknown requests get empty response.
+		"""
+		delay = self._latency
+		if self._jitter > 0:
+			delay += self._random.uniform(0, self._jitter)
+		if delay > 0:
+			time.sleep(delay)
+
+		with self._lock:
+			now = clock.monotonic()
+			if not self._checkPresence(now):
+				raise usbcomm.TransportError("simulated device is disconnected")
+			if self._disconnectRate > 0 and self._random.random() < self._disconnectRate:
+				self._absentUntil = now + self._disconnectTime
+				raise usbcomm.TransportError("simulated device disconnected")
+			if self._errorRate > 0 and self._random.random() < self._errorRate:
+				raise usbcomm.TransportError("simulated transfer error")
+
+			self._advance(now)
+			handler = self._requests.get(request)
+			response = handler(value & 0xffff, now) if handler is not None else ''
+
+		if length is None:
+			return None
+		return bytearray((response or '')[:length])
+
+	def reset(self):
+		"USB reset doesn't change the firmware state, it only fails if the device is disconnected."
+		with self._lock:
+			if not self._checkPresence(clock.monotonic()):
+				raise usbcomm.TransportError("simulated device is disconnected")
+
+
+class SimulatedTransport(object):
+	"Transport to the simulated devices, used instead of usbcomm.UsbTransport for tests and benchmarks."
+
+	_devices = None
+
+	def __init__(self, devices):
+		self._devices = list(devices)
+
+	@classmethod
+	def fromConfiguration(cls, configuration):
+		"""Creates the simulated devices described by [simulator] section. Their IDs are 'sim-0', 'sim-1' etc."""
+		confFileSection = 'simulator'
+
+		def option(name, default, getter = configuration.getfloat):
+			if configuration.has_option(confFileSection, name):
+				return getter(confFileSection, name)
+			return default
+
+		try:
+			count = option('devices', DEFAULT_DEVICES, configuration.getint)
+			settings = {'cpm' : option('cpm', DEFAULT_CPM), 'latency' : option('latency', DEFAULT_LATENCY),
+				'jitter' : option('jitter', DEFAULT_JITTER), 'errorRate' : option('error_rate', DEFAULT_ERROR_RATE),
+				'disconnectRate' : option('disconnect_rate', DEFAULT_DISCONNECT_RATE),
+				'disconnectTime' : option('disconnect_time', DEFAULT_DISCONNECT_TIME),
+				'snapshot' : option('snapshot', True, configuration.getboolean)}
+			seed = option('seed', None, configuration.getint)
+		except (ConfigParser.Error, ValueError) as e:
+			raise usbcomm.CommException("wrong simulator settings: " + str(e))
+
+		return cls(cls.createDevices(count, seed = seed, **settings))
+
+	@staticmethod
+	def createDevices(count, seed = None, **settings):
+		"""Returns the list of count SimulatedDevice instances. Other keyword arguments are passed to them. If the seed
+		is given, each device gets its own random generator seeded with seed + device number.
+		"""
+		devices = []
+		for number in xrange(count):
+			deviceId = 'sim-%d' % number
+			info = usbcomm.DeviceInfo(deviceId, 0, str(number + 1), number + 1, deviceId)
+			devices.append(SimulatedDevice(info, seed = seed + number if seed is not None else None, **settings))
+		return devices
+
+	def getDevices(self):
+		"Returns the list of SimulatedDevice instances."
+		return list(self._devices)
+
+	def findDevices(self):
+		"Yields (DeviceInfo, device) pairs for each connected simulated device."
+		for device in self._devices:
+			if device.isPresent():
+				yield (device.getInfo(), device)
+
+	def reopen(self, device, info):
+		"Returns the device present at the bus and address from info if it has the same ID, otherwise None."
+		for candidate in self._devices:
+			if candidate.isPresent():
+				found = candidate.getInfo()
+				if (found.bus, found.address) == (info.bus, info.address):
+					return candidate if found.deviceId == info.deviceId else None
+		return None
+
+	def getTopology(self):
+		"Returns the set of (bus, address) of the connected devices."
+		return frozenset((device.getInfo().bus, device.getInfo().address) for device in self._devices if device.isPresent())
+
+	def controlOut(self, device, request, value):
+		device.transfer(request, value)
+
+	def controlIn(self, device, request, value, length):
+		return device.transfer(request, value, length)
+
+	def reset(self, device):
+		device.reset()
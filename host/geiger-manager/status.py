@@ -0,0 +1,305 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import ConfigParser
+import calendar
+import json
+import logging
+import threading
+import time
+import rollup
+import tracing
+
+# default settings, can be changed in [status] section
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8088
+
+class StatusException(Exception):
+	pass
+
+def _isoTime(timestamp):
+	return time.strftime("%Y-%m-%dT%H:%M:%SZ", timestamp) if timestamp is not None else None
+
+def collectStatus(monitor):
+	"""Returns the dictionary with the latest measurement, counters and current rollups of each device, statistics
+	of the updaters and of the scheduler. Only the values cached by the monitor are used, the devices aren't accessed.
+	"""
+	now = time.time()
+	rollups = monitor.getRollups()
+	analytics = monitor.getAnalytics()
+	detector = monitor.getDetector()
+
+	devices = {}
+	for device in monitor.getDevices():
+		latest = device.latest
+		entry = {'measurements' : device.measurements, 'errors' : device.errors, 'missed' : device.missed,
+			'interval' : device.interval, 'time' : _isoTime(device.latestTime),
+			'lost' : device.lost, 'recovery' : device.connector.getRecoveryStatistics(),
+			'age' : now - calendar.timegm(device.latestTime) if device.latestTime is not None else None,
+			'cpm' : latest.cpm if latest is not None else None,
+			'radiation' : latest.radiation if latest is not None else None,
+			'voltage' : latest.voltage if latest is not None else None}
+		for resolution in rollup.RESOLUTIONS:
+			current = rollups.getCurrent(device.deviceId, resolution)
+			entry[resolution] = current.asDict() if current is not None else None
+		if device.events is not None:
+			entry['events'] = device.events.getStatistics()
+		if analytics is not None:
+			entry['analytics'] = analytics.getStatistics(device.deviceId, now)
+		if detector is not None:
+			entry['detector'] = detector.getStatus(device.deviceId)
+		devices[device.deviceId] = entry
+
+	updaters = {}
+	for updater in monitor.getUpdaters():
+		entry = updater.getStatistics()
+		entry['resolution'] = updater.getResolution()
+		spool = updater.getSpool()
+		entry['spooled'] = spool.getPendingSize() if spool is not None else None
+		updaters[updater.getName()] = entry
+
+	status = {'time' : _isoTime(time.gmtime(now)), 'devices' : devices, 'updaters' : updaters,
+		'scheduler' : monitor.getSchedulerStatistics(), 'tracing' : tracing.getStatistics()}
+	workers = monitor.getWorkerStatistics()
+	if workers is not None:
+		status['workers'] = workers
+	return status
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metrics(object):
+	"Builds the text in Prometheus exposition format."
+
+	_lines = None
+
+	def __init__(self):
+		self._lines = []
+
+	def add(self, name, kind, description, samples):
+		"""Adds the metric with its description. samples is the list of (labels dictionary, value) tuples; None values
+		are skipped.
+		"""
+		samples = [(labels, value) for labels, value in samples if value is not None]
+		if len(samples) == 0:
+			return
+		self._lines.append("# HELP %s %s" % (name, description))
+		self._lines.append("# TYPE %s %s" % (name, kind))
+		for labels, value in samples:
+			self._lines.append(self._sample(name, labels, value))
+
+	def addSummary(self, name, description, summaries):
+		"""Adds the summary metric. summaries is the list of (labels dictionary, quantiles, sum, count) tuples, where
+		quantiles is the list of (quantile, value) tuples; summaries without observations are skipped.
+		"""
+		summaries = [summary for summary in summaries if summary[3] > 0]
+		if len(summaries) == 0:
+			return
+		self._lines.append("# HELP %s %s" % (name, description))
+		self._lines.append("# TYPE %s summary" % name)
+		for labels, quantiles, total, count in summaries:
+			for quantile, value in quantiles:
+				if value is not None:
+					self._lines.append(self._sample(name, dict(labels, quantile = str(quantile)), value))
+			self._lines.append(self._sample(name + '_sum', labels, total))
+			self._lines.append(self._sample(name + '_count', labels, count))
+
+	def addHistogram(self, name, description, histograms):
+		"""Adds the histogram metric. histograms is the list of (labels dictionary, buckets, sum, count) tuples, where
+		buckets is the list of (upper bound, number of values in the bucket) tuples; the counts are made cumulative here.
+		"""
+		if len(histograms) == 0:
+			return
+		self._lines.append("# HELP %s %s" % (name, description))
+		self._lines.append("# TYPE %s histogram" % name)
+		for labels, buckets, total, count in histograms:
+			cumulative = 0
+			for bound, number in buckets:
+				cumulative += number
+				self._lines.append(self._sample(name + '_bucket', dict(labels, le = '+Inf' if bound == float('inf')
+					else repr(bound)), cumulative))
+			self._lines.append(self._sample(name + '_sum', labels, total))
+			self._lines.append(self._sample(name + '_count', labels, count))
+
+	def _sample(self, name, labels, value):
+		if len(labels) > 0:
+			name += '{' + ','.join('%s="%s"' % (key, _escape(labels[key])) for key in sorted(labels)) + '}'
+		return "%s %s" % (name, repr(float(value)))
+
+	def render(self):
+		return '\n'.join(self._lines) + '\n'
+
+def renderMetrics(status):
+	"Returns the status collected by collectStatus() in Prometheus exposition format."
+	metrics = _Metrics()
+	devices = sorted(status['devices'].iteritems())
+
+	def perDevice(key):
+		return [({'device' : deviceId}, entry[key]) for deviceId, entry in devices]
+
+	metrics.add('geiger_cpm', 'gauge', 'Counts per minute of the latest measurement.', perDevice('cpm'))
+	metrics.add('geiger_radiation_usv_per_hour', 'gauge', 'Radiation of the latest measurement in uSv/h.',
+		perDevice('radiation'))
+	metrics.add('geiger_tube_voltage_volts', 'gauge', 'Geiger tube supply voltage of the latest measurement.',
+		perDevice('voltage'))
+	metrics.add('geiger_interval_seconds', 'gauge', 'Measuring interval of the device.', perDevice('interval'))
+	metrics.add('geiger_measurement_age_seconds', 'gauge', 'Time since the latest measurement.', perDevice('age'))
+	metrics.add('geiger_measurements_total', 'counter', 'Number of measurements read from the device.',
+		perDevice('measurements'))
+	metrics.add('geiger_usb_errors_total', 'counter', 'Number of USB errors of the device.', perDevice('errors'))
+	metrics.add('geiger_intervals_missed_total', 'counter', 'Number of counting intervals which dropped out of '
+		'the history of the device before they were read.', perDevice('missed'))
+	metrics.add('geiger_device_lost', 'gauge', '1 if the device can\'t be found, 0 if it works.',
+		[(labels, int(value)) for labels, value in perDevice('lost')])
+	metrics.add('geiger_usb_recoveries_total', 'counter', 'Number of USB recoveries by method: retry of the transfer, '
+		'reopen of the device, reset and full search; failed counts the recoveries which didn\'t find the device.',
+		[({'device' : deviceId, 'method' : method}, count) for deviceId, entry in devices
+		for method, count in sorted(entry['recovery'].iteritems())])
+
+	def perDeviceAnalytics(key):
+		return [({'device' : deviceId}, entry['analytics'][key]) for deviceId, entry in devices
+			if entry.get('analytics') is not None]
+
+	metrics.add('geiger_dose_usv_total', 'counter', 'Dose in uSv accumulated since the start of the monitor.',
+		perDeviceAnalytics('dose'))
+	metrics.add('geiger_dose_last_hour_usv', 'gauge', 'Dose in uSv accumulated in the last hour.',
+		perDeviceAnalytics('doseHour'))
+	metrics.add('geiger_radiation_mean_usv_per_hour', 'gauge', 'Moving mean of radiation in uSv/h.',
+		perDeviceAnalytics('meanRadiation'))
+	metrics.add('geiger_cpm_bound', 'gauge', 'Confidence bounds of the moving mean of CPM.',
+		[({'device' : labels['device'], 'bound' : bound}, value) for bound, key in (('lower', 'cpmLower'),
+		('upper', 'cpmUpper')) for labels, value in perDeviceAnalytics(key)])
+	metrics.add('geiger_cpm_corrected', 'gauge', 'CPM of the latest measurement corrected for the dead time.',
+		perDeviceAnalytics('correctedCPM'))
+
+	detectors = [(deviceId, entry['detector']) for deviceId, entry in devices if entry.get('detector') is not None]
+	metrics.add('geiger_alarm', 'gauge', '1 if the change detector found the rise of radiation, 0 otherwise.',
+		[({'device' : deviceId}, int(state['alarm'])) for deviceId, state in detectors])
+	metrics.add('geiger_detector_statistic', 'gauge', 'CUSUM statistic of the change detector and its threshold.',
+		[({'device' : deviceId, 'kind' : kind}, state[key]) for deviceId, state in detectors
+		for kind, key in (('statistic', 'statistic'), ('threshold', 'threshold'))])
+
+	updaters = sorted(status['updaters'].iteritems())
+
+	def perUpdater(key):
+		return [({'updater' : name}, entry[key]) for name, entry in updaters]
+
+	metrics.add('geiger_updater_queue_depth', 'gauge', 'Number of measurements waiting in the updater queue.',
+		perUpdater('queueDepth'))
+	metrics.add('geiger_updater_delivered_total', 'counter', 'Number of measurements delivered by the updater.',
+		perUpdater('delivered'))
+	metrics.add('geiger_updater_failed_total', 'counter', 'Number of measurements the updater failed to deliver.',
+		perUpdater('failed'))
+	metrics.add('geiger_updater_dropped_total', 'counter', 'Number of measurements dropped because of the full queue.',
+		perUpdater('dropped'))
+	metrics.add('geiger_updater_spooled_bytes', 'gauge', 'Size of the spooled measurements waiting for replay.',
+		perUpdater('spooled'))
+	summaries = []
+	for name, entry in updaters:
+		count = entry['delivered'] + entry['failed']
+		summaries.append(({'updater' : name}, [(0.5, entry['latencyP50']), (0.99, entry['latencyP99'])],
+			(entry['latencyMean'] or 0.0) * count, count))
+	metrics.addSummary('geiger_updater_latency_seconds', 'Time from queueing the measurement to its delivery.', summaries)
+
+	scheduler = status['scheduler']
+	metrics.addSummary('geiger_scheduler_delay_seconds', 'Delay of the measurement after its deadline.',
+		[({}, [(0.5, scheduler['delayP50']), (0.99, scheduler['delayP99'])],
+		(scheduler['delayMean'] or 0.0) * scheduler['runs'], scheduler['runs'])])
+	metrics.add('geiger_scheduler_missed_ticks_total', 'counter', 'Number of measurements skipped because of delay.',
+		[({}, scheduler['missed'])])
+
+	workers = list(enumerate(status.get('workers', [])))
+	metrics.add('geiger_worker_up', 'gauge', '1 if the worker process of the supervisor runs, 0 otherwise.',
+		[({'worker' : str(number)}, int(worker['pid'] is not None)) for number, worker in workers])
+	metrics.add('geiger_worker_restarts_total', 'counter', 'Number of restarts of the worker process of the supervisor.',
+		[({'worker' : str(number)}, worker['restarts']) for number, worker in workers])
+
+	histograms = [({'span' : name}, histogram.getBuckets(), histogram.total, histogram.count)
+		for name, histogram in sorted(tracing.getHistograms().iteritems())]
+	metrics.addHistogram('geiger_trace_duration_seconds', 'Duration of the traced operations, if tracing is enabled.',
+		histograms)
+
+	return metrics.render()
+
+
+class _StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		path = self.path.split('?')[0]
+		if path in ('/', '/status'):
+			body = json.dumps(collectStatus(self.server.monitor), indent = 2, sort_keys = True)
+			contentType = 'application/json'
+		elif path == '/metrics':
+			body = renderMetrics(collectStatus(self.server.monitor))
+			contentType = 'text/plain; version=0.0.4'
+		else:
+			self.send_error(404)
+			return
+
+		self.send_response(200)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logging.getLogger("geiger.status").debug("%s %s", self.client_address[0], format % args)
+
+class _StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	monitor = None
+
+
+class StatusServer(threading.Thread):
+	"""HTTP server showing the state of the monitor: /status (or /) returns JSON with the latest measurement and
+	rollups of each device and statistics of the updaters, /metrics returns the same in Prometheus format. It uses
+	only the values cached by the monitor, so it can be queried often without touching the USB bus.
+	"""
+
+	_server = None
+
+	def __init__(self, monitor, host = DEFAULT_HOST, port = DEFAULT_PORT):
+		threading.Thread.__init__(self, name = "geiger-status")
+		self.setDaemon(True)
+		self._server = _StatusServer((host, port), _StatusHandler)
+		self._server.monitor = monitor
+
+	@classmethod
+	def fromConfiguration(cls, monitor, configuration):
+		"""Creates the server if it's enabled in [status] section, otherwise returns None."""
+		confFileSection = 'status'
+		try:
+			if not configuration.has_section(confFileSection) or not configuration.getboolean(confFileSection, 'enabled'):
+				return None
+			host = DEFAULT_HOST
+			port = DEFAULT_PORT
+			if configuration.has_option(confFileSection, 'host'):
+				host = configuration.get(confFileSection, 'host').strip()
+			if configuration.has_option(confFileSection, 'port'):
+				port = configuration.getint(confFileSection, 'port')
+		except (ConfigParser.Error, ValueError) as e:
+			raise StatusException("wrong status server settings: " + str(e))
+
+		try:
+			return cls(monitor, host, port)
+		except EnvironmentError as e:
+			raise StatusException("could not listen on %s:%d: %s" % (host, port, str(e)))
+
+	def getAddress(self):
+		"Returns the tuple: host and port the server listens on."
+		return self._server.server_address
+
+	def run(self):
+		self._server.serve_forever()
+
+	def stop(self):
+		"Stops the server."
+		self._server.shutdown()
+		self._server.server_close()
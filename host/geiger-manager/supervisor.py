@@ -0,0 +1,463 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import calendar
+import ConfigParser
+import errno
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+import clock
+import detector
+import monitor
+import usbcomm
+
+# default settings, can be changed in [supervisor] section
+DEFAULT_HEARTBEAT_TIMEOUT = 30.0
+DEFAULT_MAX_RESTART_DELAY = 60.0
+
+# the worker reports the state of its devices this often, in seconds; it's its heartbeat too
+HEARTBEAT_PERIOD = 1.0
+# a crashed worker is restarted after INITIAL_RESTART_DELAY seconds, then the wait is doubled up to max_restart_delay
+INITIAL_RESTART_DELAY = 1.0
+# how long the workers have to finish after SIGTERM before they're killed, in seconds
+STOP_TIMEOUT = 10.0
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+class SupervisorException(Exception):
+	pass
+
+def isEnabled(configuration):
+	"Returns True if the supervisor mode is enabled in [supervisor] section."
+	confFileSection = 'supervisor'
+	try:
+		return configuration.has_section(confFileSection) and configuration.getboolean(confFileSection, 'enabled')
+	except (ConfigParser.Error, ValueError) as e:
+		raise SupervisorException("wrong supervisor settings: " + str(e))
+
+def _encode(message):
+	return json.dumps(message, separators = (',', ':')) + '\n'
+
+
+class _MessageWriter(object):
+	"""Writes the messages of the worker to the pipe, one JSON array per line: ["sample", device, time (seconds since
+	the epoch), cpm, radiation, voltage, interval], ["alert", {detector.Alert fields}] and ["state", {device: state},
+	scheduler statistics]. The listeners call it from many threads, so the lines are written under the lock.
+	"""
+
+	_channel = None
+	_lock = None
+	_closed = None
+
+	def __init__(self, channel, closed):
+		self._channel = channel
+		self._lock = threading.Lock()
+		self._closed = closed
+
+	def _write(self, message):
+		line = _encode(message)
+		with self._lock:
+			try:
+				self._channel.write(line)
+				self._channel.flush()
+			except (IOError, ValueError):
+				# the supervisor is gone
+				self._closed.set()
+
+	def sample(self, deviceId, timestamp, measurement, interval):
+		self._write(['sample', deviceId, calendar.timegm(timestamp), measurement.cpm, measurement.radiation,
+			measurement.voltage, interval])
+
+	def alert(self, alert):
+		self._write(['alert', alert.asDict()])
+
+	def state(self, worker):
+		"Sends the counters of the devices and the statistics the monitor computes for the status server."
+		now = time.time()
+		analytics = worker.getAnalytics()
+		changes = worker.getDetector()
+		devices = {}
+		for device in worker.getDevices():
+			entry = {'errors' : device.errors, 'missed' : device.missed, 'lost' : device.lost,
+				'interval' : device.interval, 'recovery' : device.connector.getRecoveryStatistics()}
+			if device.events is not None:
+				entry['events'] = device.events.getStatistics()
+			if analytics is not None:
+				entry['analytics'] = analytics.getStatistics(device.deviceId, now)
+			if changes is not None:
+				entry['detector'] = changes.getStatus(device.deviceId)
+			devices[device.deviceId] = entry
+		self._write(['state', devices, worker.getSchedulerStatistics()])
+
+
+def runWorker(configuration, deviceIds):
+	"""Runs the monitor of given devices without the updaters, in the worker process started by the supervisor.
+	The measurements, alerts and the state of the devices are written to the standard output, which is the pipe read
+	by the supervisor. Returns on SIGTERM or when the supervisor closes the pipe.
+	"""
+	log = logging.getLogger("geiger.supervisor")
+
+	# only the messages go to the pipe, anything else printed goes to stderr
+	channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+	stopped = threading.Event()
+	# Ctrl-C reaches all processes of the terminal, the workers are stopped by the supervisor
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+	try:
+		usbcomm.configureTransport(configuration)
+		connectors = [usbcomm.Connector(configuration, deviceId) for deviceId in deviceIds]
+	except usbcomm.CommException as e:
+		log.critical("Error at initializing devices %s: %s", ', '.join(deviceIds), str(e))
+		sys.exit(1)
+
+	writer = _MessageWriter(channel, stopped)
+	worker = monitor.createMonitor(configuration, connectors, updating = False)
+	worker.addListener(writer.sample)
+	worker.addAlertListener(writer.alert)
+	# sent by the scheduler, so a device which holds it up stops the heartbeat
+	worker.addTimer(HEARTBEAT_PERIOD, functools.partial(writer.state, worker))
+	worker.start()
+	log.info("Worker %d monitors devices: %s.", os.getpid(), ', '.join(deviceIds))
+
+	while not stopped.isSet():
+		stopped.wait(1.0)
+
+	worker.stop()
+	try:
+		channel.close()
+	except IOError:
+		pass
+
+
+class _RemoteConnector(object):
+	"Stands for the connector of the device read by the worker, in the supervisor."
+
+	_deviceId = None
+	recovery = None
+
+	def __init__(self, deviceId):
+		self._deviceId = deviceId
+		self.recovery = {}
+
+	def getDeviceId(self):
+		return self._deviceId
+
+	def getRecoveryStatistics(self):
+		return self.recovery
+
+class _RemoteEvents(object):
+	"Stands for the event capture of the device read by the worker, with its latest statistics."
+
+	statistics = None
+
+	def __init__(self, statistics):
+		self.statistics = statistics
+
+	def getStatistics(self, window = None):
+		return self.statistics
+
+class _RemoteStatistics(object):
+	"""Stands for analytics.OnlineAnalytics or detector.DetectorStage of the workers: returns the latest statistics
+	the workers reported under given key.
+	"""
+
+	_states = None
+	_key = None
+
+	def __init__(self, states, key):
+		self._states = states
+		self._key = key
+
+	def getStatistics(self, deviceId, now = None):
+		return self._states.get(deviceId, {}).get(self._key)
+
+	getStatus = getStatistics
+
+class _Shard(object):
+	"Devices of one worker and the state of its process."
+
+	deviceIds = None
+	process = None
+	buffer = ''
+	lastMessage = None
+	restartAt = 0.0
+	failures = 0
+	restarts = 0
+	terminated = None
+	scheduler = None
+
+	def __init__(self, deviceIds):
+		self.deviceIds = deviceIds
+
+
+class Supervisor(monitor.Monitor):
+	"""Splits the devices between 'workers' processes, so reading them and the analysis use many cores, and a device
+	which hangs in a USB call holds up only its own worker. Each worker is main.py run with --worker: the monitor
+	of its share of the devices, without the updaters (see runWorker()). The workers send their measurements through
+	pipes to the supervisor, which passes them to the listeners, the rollups and the updaters like the monitor does.
+	It stands for the monitor towards the status server and the IPC publisher.
+
+	A worker which exits is restarted after a delay, doubled with each failure up to 'max_restart_delay' seconds.
+	A worker which sends nothing, not even its heartbeat, for 'heartbeat_timeout' seconds is killed and restarted.
+	"""
+
+	_configPath = None
+	_verbose = False
+	_heartbeatTimeout = DEFAULT_HEARTBEAT_TIMEOUT
+	_maxRestartDelay = DEFAULT_MAX_RESTART_DELAY
+
+	_shards = None
+	_devicesById = None
+	_states = None
+	_thread = None
+	_stopping = False
+
+	def __init__(self, configuration, configPath, deviceIds, workers, heartbeatTimeout = DEFAULT_HEARTBEAT_TIMEOUT,
+			maxRestartDelay = DEFAULT_MAX_RESTART_DELAY, verbose = False):
+		"""Takes ConfigParser instance, the path of the configuration file the workers read, the list of the device
+		IDs and the number of worker processes.
+		"""
+		monitor.Monitor.__init__(self, configuration, [], measuring = False, updating = False)
+		self._log = logging.getLogger("geiger.supervisor")
+		self._configPath = os.path.abspath(configPath)
+		self._verbose = verbose
+		self._heartbeatTimeout = heartbeatTimeout
+		self._maxRestartDelay = maxRestartDelay
+
+		self._devices = [monitor.Device(_RemoteConnector(deviceId)) for deviceId in deviceIds]
+		self._devicesById = dict((device.deviceId, device) for device in self._devices)
+		for device in self._devices:
+			device.interval = self._interval
+		self._states = {}
+		# the updaters are told the devices, so they're loaded after them
+		self._loadUpdaters(configuration)
+
+		workers = max(1, min(workers, len(deviceIds)))
+		self._shards = [_Shard(deviceIds[number::workers]) for number in xrange(workers)]
+
+		self._thread = threading.Thread(target = self._run, name = "geiger-supervisor")
+		self._thread.setDaemon(True)
+
+	@classmethod
+	def fromConfiguration(cls, configuration, configPath, verbose = False):
+		"""Creates the supervisor of all devices selected in the configuration file, with the settings from
+		[supervisor] section. The number of workers is the number of processors by default.
+		"""
+		confFileSection = 'supervisor'
+		try:
+			def option(name, default, getter = configuration.getfloat):
+				if configuration.has_option(confFileSection, name):
+					return getter(confFileSection, name)
+				return default
+
+			workers = option('workers', multiprocessing.cpu_count(), configuration.getint)
+			heartbeatTimeout = option('heartbeat_timeout', DEFAULT_HEARTBEAT_TIMEOUT)
+			maxRestartDelay = option('max_restart_delay', DEFAULT_MAX_RESTART_DELAY)
+		except (ConfigParser.Error, ValueError) as e:
+			raise SupervisorException("wrong supervisor settings: " + str(e))
+		if workers < 1:
+			raise SupervisorException("number of workers has to be positive")
+
+		try:
+			deviceIds = sorted(usbcomm.selectedDeviceIds(configuration))
+		except usbcomm.CommException as e:
+			raise SupervisorException(str(e))
+		if len(deviceIds) == 0:
+			raise SupervisorException("Geiger device not found")
+
+		return cls(configuration, configPath, deviceIds, workers, heartbeatTimeout, maxRestartDelay, verbose)
+
+	def start(self):
+		"Starts the workers and passing their measurements."
+		for shard in self._shards:
+			self._log.info("Worker will monitor devices: %s.", ', '.join(shard.deviceIds))
+		self._thread.start()
+
+	def stop(self):
+		"""Stops the workers, waits for their last measurements and closes all updaters."""
+		self._stopping = True
+		if self._thread.isAlive():
+			self._thread.join(STOP_TIMEOUT * 2)
+
+		self._closeUpdaters()
+
+	def _startWorker(self, shard):
+		command = [sys.executable, MAIN_SCRIPT, '-c', self._configPath, '--worker', ';'.join(shard.deviceIds)]
+		if self._verbose:
+			command.append('-v')
+		try:
+			shard.process = subprocess.Popen(command, stdout = subprocess.PIPE, close_fds = True)
+		except OSError as e:
+			self._workerFailed(shard, "could not be started: %s" % str(e))
+			return
+		shard.buffer = ''
+		shard.terminated = None
+		shard.lastMessage = clock.monotonic()
+		self._log.info("Worker %d of devices %s started.", shard.process.pid, ', '.join(shard.deviceIds))
+
+	def _workerFailed(self, shard, reason):
+		"Marks the devices of the worker as lost and schedules its restart."
+		delay = min(INITIAL_RESTART_DELAY * 2 ** shard.failures, self._maxRestartDelay)
+		shard.failures += 1
+		shard.restartAt = clock.monotonic() + delay
+		for deviceId in shard.deviceIds:
+			self._devicesById[deviceId].lost = True
+		self._log.error("Worker of devices %s %s, restarting in %.0f s.", ', '.join(shard.deviceIds), reason, delay)
+
+	def _workerExited(self, shard):
+		shard.process.stdout.close()
+		code = shard.process.wait()
+		shard.process = None
+		if not self._stopping:
+			shard.restarts += 1
+			self._workerFailed(shard, "exited with code %d" % code)
+
+	def _supervise(self, shard, now):
+		"Starts, kills or stops the worker, whatever is due."
+		if shard.process is None:
+			if not self._stopping and now >= shard.restartAt:
+				self._startWorker(shard)
+			return
+
+		try:
+			if self._stopping:
+				if shard.terminated is None:
+					shard.terminated = now
+					shard.process.terminate()
+				elif now - shard.terminated > STOP_TIMEOUT:
+					self._log.error("Worker %d didn't stop in %.0f s, killing it.", shard.process.pid, STOP_TIMEOUT)
+					shard.process.kill()
+			elif now - shard.lastMessage > self._heartbeatTimeout:
+				self._log.error("Worker %d of devices %s didn't respond for %.0f s, killing it.", shard.process.pid,
+					', '.join(shard.deviceIds), now - shard.lastMessage)
+				shard.process.kill()
+				# its pipe is closed then and it's restarted as any crashed worker
+				shard.lastMessage = now
+		except OSError as e:
+			if e.errno != errno.ESRCH:
+				raise
+
+	def _run(self):
+		while True:
+			now = clock.monotonic()
+			for shard in self._shards:
+				self._supervise(shard, now)
+
+			running = [shard for shard in self._shards if shard.process is not None]
+			if self._stopping and len(running) == 0:
+				return
+
+			try:
+				readable = select.select([shard.process.stdout for shard in running], [], [], HEARTBEAT_PERIOD)[0]
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			for shard in running:
+				if shard.process.stdout in readable:
+					self._receive(shard)
+
+	def _receive(self, shard):
+		"Reads what the worker sent and handles the complete lines."
+		try:
+			data = os.read(shard.process.stdout.fileno(), 65536)
+		except OSError as e:
+			if e.errno == errno.EINTR:
+				return
+			data = ''
+		if data == '':
+			self._workerExited(shard)
+			return
+
+		shard.lastMessage = clock.monotonic()
+		lines = (shard.buffer + data).split('\n')
+		shard.buffer = lines.pop()
+		for line in lines:
+			try:
+				self._handle(shard, json.loads(line))
+			except (ValueError, TypeError, KeyError, IndexError) as e:
+				self._log.error("Wrong message from worker %d: %s", shard.process.pid, str(e))
+			except Exception as e:
+				self._log.exception("Error at handling message from worker %d: %s", shard.process.pid, str(e))
+
+	def _handle(self, shard, message):
+		kind = message[0]
+		if kind == 'sample':
+			deviceId, seconds, cpm, radiation, voltage, interval = message[1:]
+			# a measurement proves the worker works, so the next failure is retried soon again
+			shard.failures = 0
+			self._pass(self._devicesById[deviceId], time.gmtime(seconds), usbcomm.Measurement(cpm, radiation, voltage),
+				interval)
+		elif kind == 'alert':
+			values = dict((str(name), value) for name, value in message[1].iteritems())
+			alert = detector.Alert(**values)
+			alert.deviceId = self._devicesById[alert.deviceId].deviceId
+			alert.kind = str(alert.kind)
+			alert.time = time.gmtime(alert.time)
+			# the worker which detected it logged it already
+			self._alertUpdaters(alert)
+		elif kind == 'state':
+			devices, shard.scheduler = message[1:]
+			for deviceId, entry in devices.iteritems():
+				device = self._devicesById[deviceId]
+				device.errors, device.missed, device.lost = entry['errors'], entry['missed'], entry['lost']
+				device.interval = entry['interval']
+				device.connector.recovery = entry['recovery']
+				if 'events' in entry:
+					device.events = _RemoteEvents(entry['events'])
+				self._states[deviceId] = entry
+		else:
+			raise ValueError("unknown message '%s'" % kind)
+
+	def _reported(self, key):
+		return any(key in entry for entry in self._states.values())
+
+	def getAnalytics(self):
+		"Returns the latest analytics statistics reported by the workers, or None if they're disabled."
+		return _RemoteStatistics(self._states, 'analytics') if self._reported('analytics') else None
+
+	def getDetector(self):
+		"Returns the latest state of the change detector reported by the workers, or None if it's disabled."
+		return _RemoteStatistics(self._states, 'detector') if self._reported('detector') else None
+
+	def getSchedulerStatistics(self):
+		"""Returns the statistics of the schedulers of all workers, summed up. The percentiles are the worst
+		of the workers.
+		"""
+		reports = [shard.scheduler for shard in self._shards if shard.scheduler is not None]
+		runs = sum(report['runs'] for report in reports)
+		statistics = {'runs' : runs, 'missed' : sum(report['missed'] for report in reports),
+			'delayMax' : max([report['delayMax'] for report in reports] + [0.0]),
+			'delayMean' : sum((report['delayMean'] or 0.0) * report['runs'] for report in reports) / runs
+			if runs > 0 else None}
+		for name in ('delayP50', 'delayP99'):
+			values = [report[name] for report in reports if report[name] is not None]
+			statistics[name] = max(values) if len(values) > 0 else None
+		return statistics
+
+	def getWorkerStatistics(self):
+		"""Returns the list of dictionaries, one for each worker: devices - the list of its device IDs, pid - process
+		ID or None if it isn't running, restarts - how many times it was restarted.
+		"""
+		statistics = []
+		for shard in self._shards:
+			process = shard.process
+			statistics.append({'devices' : shard.deviceIds, 'pid' : process.pid if process is not None else None,
+				'restarts' : shard.restarts})
+		return statistics
@@ -0,0 +1,267 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import collections
+import ConfigParser
+import functools
+import logging
+import marshal
+import math
+import os
+import signal
+import sys
+import threading
+import time
+import clock
+
+# histogram buckets: upper bounds from 1 us doubling up to about 67 s, then infinity
+BUCKET_BASE = 1e-6
+BUCKET_COUNT = 28
+BUCKET_BOUNDS = [BUCKET_BASE * 2 ** index for index in xrange(BUCKET_COUNT - 1)] + [float('inf')]
+
+# default settings, can be changed in [tracing] section
+DEFAULT_SAMPLING_INTERVAL = 0.005
+
+_enabled = False
+_histograms = {}
+_histogramsLock = threading.Lock()
+
+class TracingException(Exception):
+	pass
+
+class Histogram(object):
+	"Durations in seconds in buckets growing exponentially, see BUCKET_BOUNDS. Adding a value takes constant time."
+
+	_lock = None
+	_buckets = None
+	count = 0
+	total = 0.0
+	maximum = 0.0
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._buckets = [0] * BUCKET_COUNT
+
+	def add(self, seconds):
+		exponent = math.frexp(seconds / BUCKET_BASE)[1] if seconds > BUCKET_BASE else 0
+		with self._lock:
+			self._buckets[min(exponent, BUCKET_COUNT - 1)] += 1
+			self.count += 1
+			self.total += seconds
+			if seconds > self.maximum:
+				self.maximum = seconds
+
+	def getBuckets(self):
+		"Returns the list of (upper bound, number of values) tuples."
+		with self._lock:
+			return zip(BUCKET_BOUNDS, self._buckets)
+
+	def getQuantile(self, fraction):
+		"Returns the upper bound of the bucket containing the quantile, or None if there are no values."
+		with self._lock:
+			if self.count == 0:
+				return None
+			wanted = fraction * self.count
+			passed = 0
+			for bound, number in zip(BUCKET_BOUNDS, self._buckets):
+				passed += number
+				if passed >= wanted:
+					return min(bound, self.maximum)
+			return self.maximum
+
+def isEnabled():
+	"Returns True if the durations are recorded."
+	return _enabled
+
+def setEnabled(enabled):
+	"Turns recording of the durations on or off."
+	global _enabled
+	_enabled = enabled
+
+def record(name, seconds):
+	"Adds the duration to the histogram of given name."
+	histogram = _histograms.get(name)
+	if histogram is None:
+		with _histogramsLock:
+			histogram = _histograms.setdefault(name, Histogram())
+	histogram.add(seconds)
+
+def getHistograms():
+	"Returns the dictionary of histograms by name."
+	with _histogramsLock:
+		return dict(_histograms)
+
+def getStatistics():
+	"Returns the dictionary with count, mean, max, p50 and p99 of each histogram, in seconds, by name."
+	statistics = {}
+	for name, histogram in getHistograms().iteritems():
+		statistics[name] = {'count' : histogram.count, 'max' : histogram.maximum,
+			'mean' : histogram.total / histogram.count if histogram.count > 0 else None,
+			'p50' : histogram.getQuantile(0.5), 'p99' : histogram.getQuantile(0.99)}
+	return statistics
+
+def traced(name):
+	"""Decorator recording the duration of each call of the function in the histogram of given name. When tracing
+	is disabled, it costs only one check of the flag.
+	"""
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not _enabled:
+				return function(*args, **kwargs)
+			started = clock.monotonic()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				record(name, clock.monotonic() - started)
+		return wrapper
+	return decorator
+
+class span(object):
+	"Context manager recording the duration of the block in the histogram of given name, if tracing is enabled."
+
+	__slots__ = ('_name', '_started')
+
+	def __init__(self, name):
+		self._name = name
+		self._started = None
+
+	def __enter__(self):
+		if _enabled:
+			self._started = clock.monotonic()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		if self._started is not None:
+			record(self._name, clock.monotonic() - self._started)
+		return False
+
+
+class SamplingProfiler(threading.Thread):
+	"""Profiles all threads of the process by sampling their stacks every 'interval' seconds. cProfile can't be used
+	for that, since in Python 2 it only sees the thread which enabled it. The result is saved in the format of
+	cProfile, so it can be read by pstats: the times are the number of samples multiplied by the interval, the call
+	counts are the numbers of samples.
+	"""
+
+	_interval = None
+	_stopEvent = None
+	_selfSamples = None
+	_totalSamples = None
+	_callers = None
+	_samples = 0
+	_started = None
+
+	def __init__(self, interval = DEFAULT_SAMPLING_INTERVAL):
+		threading.Thread.__init__(self, name = "geiger-profiler")
+		self.setDaemon(True)
+		self._interval = interval
+		self._stopEvent = threading.Event()
+		self._selfSamples = collections.defaultdict(int)
+		self._totalSamples = collections.defaultdict(int)
+		self._callers = collections.defaultdict(lambda: collections.defaultdict(int))
+
+	def run(self):
+		self._started = time.time()
+		ownId = threading.currentThread().ident
+		while not self._stopEvent.isSet():
+			for threadId, frame in sys._current_frames().items():
+				if threadId != ownId:
+					self._sample(frame)
+			self._samples += 1
+			self._stopEvent.wait(self._interval)
+
+	def _sample(self, frame):
+		seen = set()
+		callee = None
+		while frame is not None:
+			code = frame.f_code
+			function = (code.co_filename, code.co_firstlineno, code.co_name)
+			if callee is None:
+				self._selfSamples[function] += 1
+			else:
+				self._callers[callee][function] += 1
+			if function not in seen:
+				seen.add(function)
+				self._totalSamples[function] += 1
+			callee = function
+			frame = frame.f_back
+
+	def stop(self):
+		"Stops sampling."
+		self._stopEvent.set()
+		self.join()
+
+	def getSampleCount(self):
+		"Returns the number of samples taken."
+		return self._samples
+
+	def dump(self, fileName):
+		"Saves the samples to the file readable by pstats.Stats."
+		stats = {}
+		for function, total in self._totalSamples.items():
+			selfTime = self._selfSamples.get(function, 0) * self._interval
+			stats[function] = (total, total, selfTime, total * self._interval, dict(self._callers.get(function, {})))
+		with open(fileName, 'wb') as handle:
+			marshal.dump(stats, handle)
+
+
+class ProfilerSwitch(object):
+	"""Starts the sampling profiler when the signal comes and stops it on the next one, saving the result as
+	geiger-<time>.pstats in the directory.
+	"""
+
+	_directory = None
+	_interval = None
+	_profiler = None
+	_log = None
+
+	def __init__(self, directory, interval = DEFAULT_SAMPLING_INTERVAL, signalNumber = signal.SIGUSR1):
+		self._directory = directory
+		self._interval = interval
+		self._log = logging.getLogger("geiger.tracing")
+		signal.signal(signalNumber, self._handle)
+
+	def _handle(self, signum, frame):
+		if self._profiler is None:
+			self._profiler = SamplingProfiler(self._interval)
+			self._profiler.start()
+			self._log.info("Profiling started, send the signal no. %d again to stop it.", signum)
+			return
+
+		profiler = self._profiler
+		self._profiler = None
+		profiler.stop()
+		fileName = os.path.join(self._directory, time.strftime("geiger-%Y%m%d-%H%M%S.pstats"))
+		try:
+			profiler.dump(fileName)
+			self._log.info("Profiling stopped, %d samples saved to %s.", profiler.getSampleCount(), fileName)
+		except (IOError, OSError) as e:
+			self._log.error("Could not save the profile to %s: %s", fileName, str(e))
+
+
+def configure(configuration):
+	"""Enables recording of the durations if 'enabled' is true in [tracing] section. If 'profile_directory' is
+	set, SIGUSR1 toggles the sampling profiler. Returns ProfilerSwitch or None.
+	"""
+	confFileSection = 'tracing'
+	try:
+		if not configuration.has_section(confFileSection):
+			return None
+		setEnabled(configuration.getboolean(confFileSection, 'enabled'))
+		if not configuration.has_option(confFileSection, 'profile_directory'):
+			return None
+		directory = configuration.get(confFileSection, 'profile_directory').strip()
+		interval = DEFAULT_SAMPLING_INTERVAL
+		if configuration.has_option(confFileSection, 'sampling_interval'):
+			interval = configuration.getfloat(confFileSection, 'sampling_interval')
+	except (ConfigParser.Error, ValueError) as e:
+		raise TracingException("wrong tracing settings: " + str(e))
+
+	if directory == '':
+		return None
+	return ProfilerSwitch(directory, interval)
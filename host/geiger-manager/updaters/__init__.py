@@ -0,0 +1,55 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import collections
+import ConfigParser
+import importlib
+
+# configuration file section of each updater: module in this package and the updater class in it. Only the modules
+# of enabled sections are imported. Other updaters can be plugged in by a section with 'plugin=module:ClassName'.
+REGISTRY = collections.OrderedDict([
+	('csvfile', ('updaters.csvfile', 'CsvFileUpdater')),
+	('binary', ('updaters.binary', 'BinaryArchiveUpdater')),
+	('mysql', ('updaters.mysql', 'MySQLUpdater')),
+	('cosm.com', ('updaters.cosm', 'PachubeUpdater')),
+	('email', ('updaters.email', 'EmailNotificationUpdater')),
+])
+
+class PluginException(Exception):
+	pass
+
+def _isEnabled(configuration, section):
+	try:
+		return configuration.getboolean(section, 'enabled')
+	except (ConfigParser.Error, ValueError):
+		return False
+
+def enabledUpdaters(configuration):
+	"""Returns the list of (section, module name, class name) tuples of the updaters enabled in the configuration,
+	the built-in ones first. Nothing is imported.
+	"""
+	enabled = [(section, moduleName, className) for section, (moduleName, className) in REGISTRY.iteritems()
+		if configuration.has_section(section) and _isEnabled(configuration, section)]
+
+	for section in configuration.sections():
+		if section in REGISTRY or not configuration.has_option(section, 'plugin') or not _isEnabled(configuration, section):
+			continue
+		plugin = configuration.get(section, 'plugin').strip()
+		if plugin.count(':') != 1:
+			raise PluginException("plugin of section [%s] should be given as module:ClassName, not '%s'" % (section, plugin))
+		moduleName, className = plugin.split(':')
+		enabled.append((section, moduleName.strip(), className.strip()))
+
+	return enabled
+
+def loadUpdater(moduleName, className):
+	"Imports the module and returns the tuple: the updater class and the name of the updater shown in the log."
+	try:
+		module = importlib.import_module(moduleName)
+		return getattr(module, className), getattr(module, 'IDENTIFICATOR', className)
+	except (ImportError, AttributeError) as e:
+		raise PluginException("could not load %s from %s: %s" % (className, moduleName, str(e)))
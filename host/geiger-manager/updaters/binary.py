@@ -0,0 +1,322 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import dummy
+import os
+import mmap
+import struct
+import calendar
+import ConfigParser
+
+IDENTIFICATOR = 'Binary archive'
+CONF_FILE_SECTION = 'binary'
+
+# file header: magic, record size, number of records
+HEADER_FORMAT = '<8sIQ8x'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAGIC = 'GEIGERTS'
+
+# record: time in seconds since epoch (UTC), device number, reserved, CPM, radiation in uSv/h
+RECORD_FORMAT = '<iHHff'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# the time index holds the lowest and the highest time of each block of records and 1 if the block is sorted by time
+BLOCK_RECORDS = 1024
+INDEX_FORMAT = '<iiI'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+# files grow by this number of records
+GROW_RECORDS = 64 * BLOCK_RECORDS
+GROW_BLOCKS = GROW_RECORDS // BLOCK_RECORDS
+
+INDEX_SUFFIX = '.idx'
+DEVICES_SUFFIX = '.devices'
+
+class BinaryArchiveException(dummy.UpdaterException):
+	pass
+
+def _mapFile(handle, size):
+	"Extends the file to given size if it's shorter and maps it in memory."
+	handle.seek(0, os.SEEK_END)
+	if handle.tell() < size:
+		handle.truncate(size)
+	return mmap.mmap(handle.fileno(), size)
+
+def _loadDevices(fileName):
+	try:
+		with open(fileName + DEVICES_SUFFIX) as handle:
+			return [line.rstrip('\n') for line in handle]
+	except IOError:
+		return []
+
+class BinaryArchiveUpdater(dummy.DummyUpdater):
+	"""Appends the measurements as fixed-width records to the memory-mapped file. Next to it there's a small time
+	index with the time range of each block of 1024 records and the list of device IDs, because the records keep
+	only the device number. Use BinaryArchiveReader to read the data back.
+	"""
+
+	_fileName = None
+	_handle = None
+	_map = None
+	_capacity = 0
+	_count = 0
+
+	_indexHandle = None
+	_indexMap = None
+	_indexCapacity = 0
+
+	_devices = None
+	_devicesHandle = None
+
+	def __init__(self, configuration):
+		"""Reads configuration and opens the archive, creating it if it doesn't exist."""
+		confFileSection = CONF_FILE_SECTION
+		try:
+			self._enabled = configuration.getboolean(confFileSection, 'enabled')
+		except Exception:
+			pass
+		if self._enabled is False:
+			return
+
+		try:
+			self._fileName = configuration.get(confFileSection, 'file_name')
+		except ConfigParser.Error as e:
+			self._enabled = False
+			raise BinaryArchiveException("could not load all needed settings from the config file: " + str(e))
+
+		try:
+			self._open()
+		except (IOError, OSError, mmap.error) as e:
+			self._enabled = False
+			raise BinaryArchiveException("could not open archive file: " + str(e))
+
+	def _open(self):
+		exists = os.path.exists(self._fileName) and os.path.getsize(self._fileName) >= HEADER_SIZE
+		self._handle = open(self._fileName, 'r+b' if exists else 'w+b')
+
+		if exists:
+			magic, recordSize, self._count = struct.unpack(HEADER_FORMAT, self._handle.read(HEADER_SIZE))
+			if magic != MAGIC or recordSize != RECORD_SIZE:
+				raise IOError("'%s' is not a Geiger archive file" % self._fileName)
+
+		self._mapData(max(self._count, 1))
+		self._writeHeader()
+
+		# the index is rebuilt from the records if it's missing or shorter than the archive
+		indexName = self._fileName + INDEX_SUFFIX
+		blocks = (self._count + BLOCK_RECORDS - 1) // BLOCK_RECORDS
+		indexValid = exists and os.path.exists(indexName) and os.path.getsize(indexName) >= blocks * INDEX_SIZE
+		self._indexHandle = open(indexName, 'r+b' if indexValid else 'w+b')
+		self._mapIndex(self._count // BLOCK_RECORDS + 1)
+		if not indexValid:
+			self._rebuildIndex()
+
+		self._devices = _loadDevices(self._fileName)
+		self._devicesHandle = open(self._fileName + DEVICES_SUFFIX, 'a')
+
+	def _mapData(self, records):
+		"Maps the data file big enough to hold given number of records, rounded up to GROW_RECORDS."
+		capacity = (records + GROW_RECORDS - 1) // GROW_RECORDS * GROW_RECORDS
+		if self._map is not None:
+			self._map.flush()
+			self._map.close()
+		self._map = _mapFile(self._handle, HEADER_SIZE + capacity * RECORD_SIZE)
+		self._capacity = capacity
+
+	def _mapIndex(self, blocks):
+		capacity = (blocks + GROW_BLOCKS - 1) // GROW_BLOCKS * GROW_BLOCKS
+		if self._indexMap is not None:
+			self._indexMap.flush()
+			self._indexMap.close()
+		self._indexMap = _mapFile(self._indexHandle, capacity * INDEX_SIZE)
+		self._indexCapacity = capacity
+
+	def _writeHeader(self):
+		struct.pack_into(HEADER_FORMAT, self._map, 0, MAGIC, RECORD_SIZE, self._count)
+
+	def _indexRecord(self, position, epoch):
+		"Adds the time of the record at given position to the entry of its block."
+		block = position // BLOCK_RECORDS
+		if position % BLOCK_RECORDS == 0:
+			low, high, isSorted = epoch, epoch, 1
+		else:
+			low, high, isSorted = struct.unpack_from(INDEX_FORMAT, self._indexMap, block * INDEX_SIZE)
+			# the high time is the time of the previous record as long as the block is sorted
+			isSorted = 1 if isSorted and epoch >= high else 0
+			low, high = min(low, epoch), max(high, epoch)
+		struct.pack_into(INDEX_FORMAT, self._indexMap, block * INDEX_SIZE, low, high, isSorted)
+
+	def _rebuildIndex(self):
+		for position in xrange(self._count):
+			self._indexRecord(position, struct.unpack_from(RECORD_FORMAT, self._map, HEADER_SIZE + position * RECORD_SIZE)[0])
+		self._indexMap.flush()
+
+	def _deviceNumber(self, deviceId):
+		deviceId = str(deviceId) if deviceId is not None else ''
+		try:
+			return self._devices.index(deviceId)
+		except ValueError:
+			self._devices.append(deviceId)
+			self._devicesHandle.write(deviceId + '\n')
+			self._devicesHandle.flush()
+			return len(self._devices) - 1
+
+	def _append(self, timestamp, radiation, cpm, deviceId):
+		epoch = calendar.timegm(timestamp)
+		if self._count == self._capacity:
+			self._mapData(self._count + 1)
+
+		struct.pack_into(RECORD_FORMAT, self._map, HEADER_SIZE + self._count * RECORD_SIZE, epoch,
+			self._deviceNumber(deviceId), 0, float(cpm), float(radiation))
+
+		block = self._count // BLOCK_RECORDS
+		if block >= self._indexCapacity:
+			self._mapIndex(block + 1)
+		self._indexRecord(self._count, epoch)
+
+		# the header is updated last, so readers never see incomplete record
+		self._count += 1
+		self._writeHeader()
+
+	def update(self, timestamp, radiation, cpm, deviceId = None):
+		"Appends the record to the archive."
+		try:
+			self._append(timestamp, radiation, cpm, deviceId)
+		except (IOError, OSError, mmap.error) as e:
+			raise BinaryArchiveException("could not write record to the archive: " + str(e))
+
+	def updateMany(self, samples):
+		"Appends the list of records to the archive."
+		try:
+			for sample in samples:
+				self._append(**sample)
+		except (IOError, OSError, mmap.error) as e:
+			raise BinaryArchiveException("could not write records to the archive: " + str(e))
+
+	def flush(self):
+		"Writes the mapped memory to the disk."
+		if self._map is not None:
+			self._map.flush()
+			self._indexMap.flush()
+
+	def close(self):
+		"Closes the archive."
+		self._enabled = False
+		if self._map is not None:
+			self.flush()
+			self._map.close()
+			self._indexMap.close()
+			self._map = None
+		for handle in (self._handle, self._indexHandle, self._devicesHandle):
+			if handle is not None:
+				handle.close()
+
+
+class BinaryArchiveReader(object):
+	"""Reads the archive written by BinaryArchiveUpdater. The file is memory-mapped and the records are exposed as
+	NumPy structured array with fields: time, device, cpm, radiation. Requires NumPy.
+	"""
+
+	_fileName = None
+	_map = None
+	_records = None
+	_index = None
+	_devices = None
+
+	def __init__(self, fileName):
+		self._fileName = fileName
+		self.refresh()
+
+	def refresh(self):
+		"Maps the archive again to see the records appended since opening it."
+		import numpy
+
+		self.close()
+		with open(self._fileName, 'rb') as handle:
+			magic, recordSize, count = struct.unpack(HEADER_FORMAT, handle.read(HEADER_SIZE))
+			if magic != MAGIC or recordSize != RECORD_SIZE:
+				raise IOError("'%s' is not a Geiger archive file" % self._fileName)
+			self._map = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+
+		dtype = numpy.dtype([('time', '<i4'), ('device', '<u2'), ('reserved', '<u2'), ('cpm', '<f4'), ('radiation', '<f4')])
+		self._records = numpy.frombuffer(self._map, dtype, count, HEADER_SIZE)
+
+		blocks = (count + BLOCK_RECORDS - 1) // BLOCK_RECORDS
+		indexType = numpy.dtype([('low', '<i4'), ('high', '<i4'), ('sorted', '<u4')])
+		try:
+			with open(self._fileName + INDEX_SUFFIX, 'rb') as handle:
+				self._index = numpy.fromfile(handle, indexType, blocks)
+		except IOError:
+			self._index = numpy.zeros(0, indexType)
+		if len(self._index) < blocks:
+			self._index = self._computeIndex(indexType, blocks)
+
+		self._devices = _loadDevices(self._fileName)
+
+	def _computeIndex(self, indexType, blocks):
+		"Computes the index from the records, when the index file is missing or incomplete."
+		import numpy
+
+		times = self._records['time']
+		starts = numpy.arange(blocks) * BLOCK_RECORDS
+		index = numpy.zeros(blocks, indexType)
+		index['low'] = numpy.minimum.reduceat(times, starts)
+		index['high'] = numpy.maximum.reduceat(times, starts)
+		decreases = numpy.nonzero(times[1:] < times[:-1])[0] + 1
+		index['sorted'] = 1
+		# a decrease between two blocks doesn't make either of them unsorted
+		index['sorted'][decreases[decreases % BLOCK_RECORDS != 0] // BLOCK_RECORDS] = 0
+		return index
+
+	def close(self):
+		"Unmaps the archive. Arrays returned before become invalid."
+		self._records = None
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+
+	def getDevices(self):
+		"Returns the list of device IDs, the device field of the record is the index in this list."
+		return list(self._devices)
+
+	def getAll(self):
+		"Returns all records as the view of the mapped file."
+		return self._records
+
+	def getRange(self, start, end, deviceId = None):
+		"""Returns the records with time in range [start, end), both in seconds since epoch (UTC). If the blocks
+		covering the range are sorted by time, which is the case unless older measurements were appended after newer
+		ones there, the result is the view of the mapped file, without copying. Filtering by deviceId or unsorted
+		blocks need a copy.
+		"""
+		import numpy
+
+		# the blocks which can contain records in the range
+		candidates = numpy.nonzero((self._index['high'] >= start) & (self._index['low'] < end))[0]
+		if len(candidates) == 0:
+			return self._records[0:0]
+
+		first = candidates[0] * BLOCK_RECORDS
+		last = min((candidates[-1] + 1) * BLOCK_RECORDS, len(self._records))
+		records = self._records[first:last]
+
+		# the records are sorted if each block is and the blocks don't overlap
+		blocks = self._index[candidates[0]:candidates[-1] + 1]
+		if numpy.all(blocks['sorted']) and numpy.all(blocks['high'][:-1] <= blocks['low'][1:]):
+			times = records['time']
+			records = records[numpy.searchsorted(times, start, 'left'):numpy.searchsorted(times, end, 'left')]
+		else:
+			records = records[(records['time'] >= start) & (records['time'] < end)]
+
+		if deviceId is not None:
+			try:
+				number = self._devices.index(str(deviceId))
+			except ValueError:
+				return self._records[0:0]
+			records = records[records['device'] == number]
+
+		return records
@@ -7,75 +7,235 @@
 
 import json
 import httplib
+import socket
+import urlparse
+import zlib
+import collections
 import dummy
 import ConfigParser
 import time
+import tracing
 
 IDENTIFICATOR = 'Pachube cosm.com'
+CONF_FILE_SECTION = 'cosm.com'
+
+# new name - xively. Cosm is an old service name.
+DEFAULT_URL = 'http://api.xively.com/v2/feeds/'
+
+# default batching settings
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_BATCH_TIME = 60.0
+DEFAULT_MAX_BUFFER = 1000
 
 class PachubeException(dummy.UpdaterException):
 	pass
 
 class PachubeUpdater(dummy.DummyUpdater):
+	"""Sends the measurements to the xively.com (formerly cosm.com) feed. The measurements are buffered and sent
+	in one request carrying up to 'batch_size' datapoints per datastream, or after 'batch_time' seconds since the oldest
+	buffered measurement. The HTTP connection is kept open between the requests. The option 'url' sets the feeds
+	API endpoint, so any compatible service or a local test server can be used; 'gzip' compresses the requests.
+	"""
+
 	_feedId = None
 	_CPMID = None
 	_RadiationID = None
 	_apiKey = None
 	_version = '1.0.0'
 
-	_mesg = {}
+	_url = DEFAULT_URL
+	_host = None
+	_port = None
+	_path = None
+	_secure = False
+	_gzip = False
+	_connection = None
+
+	_batchSize = DEFAULT_BATCH_SIZE
+	_batchTime = DEFAULT_BATCH_TIME
+	_maxBuffer = DEFAULT_MAX_BUFFER
+	_buffer = None
+	_bufferSince = None
 
 	def __init__(self, configuration):
-		confFileSection = 'cosm.com'
+		confFileSection = CONF_FILE_SECTION
 		try:
 			self._enabled = configuration.getboolean(confFileSection, 'enabled')
 		except ConfigParser.Error:
 			pass
 		if self._enabled is False:
 			return
+
+		def option(name, default, getter = configuration.get):
+			if configuration.has_option(confFileSection, name):
+				return getter(confFileSection, name)
+			return default
+
 		try:
 			self._feedId = configuration.get(confFileSection, 'feed_id')
 			self._RadiationID = configuration.get(confFileSection, 'radiation_id')
 			self._CPMID = configuration.get(confFileSection, 'cpm_id')
 			self._apiKey = configuration.get(confFileSection, 'api_key')
-		except ConfigParser.Error as e:
+
+			self._url = option('url', DEFAULT_URL).strip()
+			self._gzip = option('gzip', False, configuration.getboolean)
+			self._batchSize = max(1, option('batch_size', DEFAULT_BATCH_SIZE, configuration.getint))
+			self._batchTime = option('batch_time', DEFAULT_BATCH_TIME, configuration.getfloat)
+			self._maxBuffer = max(self._batchSize, option('max_buffer', DEFAULT_MAX_BUFFER, configuration.getint))
+		except (ConfigParser.Error, ValueError) as e:
 			self._enabled = False
 			raise PachubeException(str(e) + ". data is incomplete.")
 
-		self._mesg['version'] = self._version
-		self._mesg['id'] = self._feedId
+		url = urlparse.urlsplit(self._url)
+		if url.scheme not in ('http', 'https') or not url.hostname:
+			self._enabled = False
+			raise PachubeException("wrong url: '%s'" % self._url)
+
+		self._secure = url.scheme == 'https'
+		self._host = url.hostname
+		self._port = url.port
+		self._path = url.path.rstrip('/') + '/' + self._feedId
+
+		self._buffer = []
+
+	def _message(self, samples):
+		"Builds the request body with the datapoints of given measurements, grouped by datastream."
+		streams = collections.OrderedDict()
+
+		def add(streamId, timeStr, value):
+			streams.setdefault(streamId, []).append({'at' : timeStr, 'value' : value})
+
+		for sample in samples:
+			timeStr = time.strftime("%Y-%m-%dT%H:%M:%SZ", sample['timestamp'])
+			deviceId = str(sample['deviceId'])
+			if sample['cpm'] is not None:
+				add(self._CPMID.replace('$device$', deviceId), timeStr, sample['cpm'])
+			if sample['radiation'] is not None:
+				add(self._RadiationID.replace('$device$', deviceId), timeStr, sample['radiation'])
+
+		return {'version' : self._version, 'id' : self._feedId,
+			'datastreams' : [{'id' : streamId, 'datapoints' : points} for streamId, points in streams.iteritems()]}
+
+	@tracing.traced('cosm.connect')
+	def _connect(self):
+		"Opens the connection at once, so the time of name resolution and connecting is traced apart from requests."
+		if self._secure:
+			self._connection = httplib.HTTPSConnection(self._host, self._port, timeout = 10)
+		else:
+			self._connection = httplib.HTTPConnection(self._host, self._port, timeout = 10)
+		try:
+			self._connection.connect()
+		except (httplib.HTTPException, socket.error):
+			self._connection = None
+			raise
+
+	def connect(self):
+		"Opens the connection with the server, if it isn't open."
+		if self._connection is not None:
+			return
+		try:
+			self._connect()
+		except (httplib.HTTPException, socket.error) as e:
+			raise PachubeException("Error at connecting to %s: %s" % (self._host, str(e)))
+
+	def _disconnect(self):
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
+
+	@tracing.traced('cosm.request')
+	def _request(self, body, headers):
+		if self._connection is None:
+			self._connect()
+
+		self._connection.request("PUT", self._path, body, headers)
+		response = self._connection.getresponse()
+		# the response has to be read completely before the connection can be reused
+		response.read()
+		if response.status != 200:
+			self._disconnect()
+			raise httplib.HTTPException("bad response: %d %s" % (response.status, response.reason))
+
+	def _send(self, samples):
+		"""Sends the measurements in one request. If the kept connection turns out to be closed by the server,
+		it's opened again and the request is repeated once.
+		"""
+		body = json.dumps(self._message(samples))
+		headers = {"X-PachubeApiKey" : self._apiKey, "Content-Type" : "application/json"}
+		if self._gzip:
+			compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+			headers["Content-Encoding"] = "gzip"
+
+		try:
+			try:
+				self._request(body, headers)
+			except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+				self._disconnect()
+				self._request(body, headers)
+		except (httplib.HTTPException, socket.error) as e:
+			self._disconnect()
+			raise PachubeException("Error at sending values to cosm.com: " + str(e))
 
-	def update(self, timestamp, radiation = None, cpm = None):
-		"""Sends data to the server. Both parameters are optional, but at least one should be specified.
+	def update(self, timestamp, radiation = None, cpm = None, deviceId = None):
+		"""Adds the measurement to the buffer and sends the buffer if it's full or old enough. Both parameters are
+		optional, but at least one should be specified. The text '$device$' in radiation_id and cpm_id is replaced
+		by the device ID.
 		Warning! If radiation_id or cpm_id are specified in the wrong way, there's no information about that.
 		Only bad API key or feed ID are beeing checked by the server.
 		"""
 		if not self._enabled:
 			return
 
-		timeStr = time.strftime("%Y-%m-%dT%H:%M:%SZ", timestamp)
+		if cpm is None and radiation is None:  # nothing to send
+			raise PachubeException("no data to send")
 
-		# construct message structure
-		dataPoints = []
-		if cpm is not None:
-			dataPoints.append({'id': self._CPMID, 'datapoints' : [{'at' : timeStr, 'value' : cpm}]})
-		if radiation is not None:
-			dataPoints.append({'id': self._RadiationID, 'datapoints' : [{'at' : timeStr, 'value' : radiation}]})
+		if len(self._buffer) == 0:
+			self._bufferSince = time.time()
+		self._buffer.append({'timestamp' : timestamp, 'radiation' : radiation, 'cpm' : cpm, 'deviceId' : deviceId})
 
-		if len(dataPoints) == 0:  # nothing to send
-			raise PachubeException("no data to send")
+		if len(self._buffer) >= self._batchSize:
+			self._sendBuffer()
+		else:
+			self.flush()
 
-		self._mesg['datastreams'] = dataPoints
+	def flush(self):
+		"Sends the buffered measurements if the oldest of them waits longer than batch_time."
+		if self._buffer and time.time() - self._bufferSince >= self._batchTime:
+			self._sendBuffer()
 
-		# send it
-		headers = {"X-PachubeApiKey" : self._apiKey}
-		try:
-			# new name - xively. Cosm is an old service name.
-			conn = httplib.HTTPConnection('api.xively.com', timeout = 10)
-			conn.request("PUT", '//v2/feeds/' + self._feedId, json.dumps(self._mesg), headers)
-			if conn.getresponse().status != 200:
-				raise httplib.HTTPException("bad response")
-			conn.close()
-		except Exception as e:
-			conn.close()
-			raise PachubeException("Error at sending values to cosm.com: " + str(e))
+	def updateMany(self, samples):
+		"""Sends the list of measurements, batch_size at once, bypassing the buffer. Sending the datapoints again
+		after the failure is harmless, the server keeps one value per time.
+		"""
+		for start in xrange(0, len(samples), self._batchSize):
+			self._send(samples[start:start + self._batchSize])
+
+	def _sendBuffer(self):
+		"""Sends the buffered measurements, batch_size per request. Measurements which couldn't be sent stay in
+		the buffer, up to max_buffer newest ones. The older ones are passed in the exception, so they can be spooled.
+		"""
+		while self._buffer:
+			batch = self._buffer[:self._batchSize]
+			try:
+				self._send(batch)
+			except PachubeException as e:
+				e.samples = self._buffer[:max(0, len(self._buffer) - self._maxBuffer)]
+				del self._buffer[:len(e.samples)]
+				raise
+			del self._buffer[:len(batch)]
+
+	def close(self):
+		"""Sends the buffered measurements and closes the connection. If sending fails, all measurements which weren't
+		sent are passed in the exception, so they can be spooled.
+		"""
+		if self._enabled:
+			try:
+				self._sendBuffer()
+			except PachubeException as e:
+				e.samples = (e.samples or []) + self._buffer
+				self._buffer = []
+				raise
+			finally:
+				self._disconnect()
+		self._enabled = False
@@ -7,28 +7,90 @@
 
 import dummy
 import time
+import calendar
 import csv
+import gzip
+import os
+import shutil
 import ConfigParser
 
 IDENTIFICATOR = 'CSV file'
+CONF_FILE_SECTION = 'csvfile'
+
+# default settings, can be changed in [csvfile] section; by default every row is flushed and the file isn't rotated
+DEFAULT_FLUSH_ROWS = 1
+DEFAULT_FLUSH_TIME = 0.0
+
+# size of the write buffer of the file, rows are written to the disk when it's full even if flushing isn't due
+BUFFER_SIZE = 64 * 1024
+
+# suffixes of the rotated segments by compression; zstd needs the zstandard module
+COMPRESSIONS = {'none' : '', 'gzip' : '.gz', 'zstd' : '.zst'}
 
 class CsvFileException(dummy.UpdaterException):
 	pass
 
+def openSegment(fileName):
+	"Opens the CSV file or its rotated segment to read, decompressing it according to the suffix."
+	if fileName.endswith(COMPRESSIONS['gzip']):
+		return gzip.open(fileName, 'rb')
+	if fileName.endswith(COMPRESSIONS['zstd']):
+		import zstandard
+		return zstandard.ZstdDecompressor().stream_reader(open(fileName, 'rb'))
+	return open(fileName, 'rb')
+
+def compressSegment(fileName, compression):
+	"Compresses the file to the file with the suffix of the compression and removes it. Returns the new name."
+	target = fileName + COMPRESSIONS[compression]
+	with open(fileName, 'rb') as source:
+		if compression == 'gzip':
+			with gzip.open(target, 'wb') as output:
+				shutil.copyfileobj(source, output, BUFFER_SIZE)
+		else:
+			import zstandard
+			with open(target, 'wb') as output:
+				zstandard.ZstdCompressor().copy_stream(source, output)
+	os.unlink(fileName)
+	return target
+
 class CsvFileUpdater(dummy.DummyUpdater):
 	"""Writes the CPM and radiation data to CSV file. Each row contains information: date, time, radiation in uSV/h
-	and CPM (counts per minute) value.
+	and CPM (counts per minute) value, followed by the device ID if 'device_column' is true. With 'auto', the default,
+	the column is added if the file already has it or, for a new file, if more than one device is monitored.
+	The rows are buffered and written after 'flush_rows' rows or 'flush_time'
+	seconds, with fsync if 'fsync' is set. With 'rotate_size' (bytes) or 'rotate_time' (seconds, counted from
+	the epoch, e.g. 86400 for UTC days) the file is renamed to <file_name>.<local time of rotation>, compressed
+	according to 'compression' and a new file is started.
 	"""
 	_csv = None
 	_fileHandle = None
+	_fileName = None
+	_delimiter = None
 
 	_dateFormat = None
 	_timeFormat = None
 	_decimalSep = '.'
+	# None until it's known whether more than one device is monitored
+	_deviceColumn = False
+
+	_flushRows = DEFAULT_FLUSH_ROWS
+	_flushTime = DEFAULT_FLUSH_TIME
+	_fsync = False
+	_pendingRows = 0
+	_pendingSince = None
+
+	_rotateSize = 0
+	_rotateTime = 0
+	_compression = 'none'
+	_segmentPeriod = None
+
+	# the date and time strings of the latest timestamp, the measurements of many devices usually share it
+	_cachedTimestamp = None
+	_cachedDateTime = None
 
 	def __init__(self, configuration):
 		"""Reads configuration and opens the file to read."""
-		confFileSection = 'csvfile'
+		confFileSection = CONF_FILE_SECTION
 		try:
 			self._enabled = configuration.getboolean(confFileSection, 'enabled')
 		except Exception:
@@ -36,40 +98,164 @@ class CsvFileUpdater(dummy.DummyUpdater):
 		if self._enabled is False:
 			return
 
+		def option(name, default, getter = configuration.get):
+			if configuration.has_option(confFileSection, name):
+				return getter(confFileSection, name)
+			return default
+
 		try:
-			fileName = configuration.get(confFileSection, 'file_name')
+			self._fileName = configuration.get(confFileSection, 'file_name')
 			self._dateFormat = configuration.get(confFileSection, 'date_format')
 			self._timeFormat = configuration.get(confFileSection, 'time_format')
 			self._decimalSep = configuration.get(confFileSection, 'decimal_separator')
-			delimiter = configuration.get(confFileSection, 'delimiter')
-		except ConfigParser.Error as e:
+			self._delimiter = configuration.get(confFileSection, 'delimiter')
+			deviceColumn = option('device_column', 'auto').strip().lower()
+			if deviceColumn == 'auto':
+				self._deviceColumn = self._existingDeviceColumn()
+			else:
+				self._deviceColumn = option('device_column', False, configuration.getboolean)
+
+			self._flushRows = max(1, option('flush_rows', DEFAULT_FLUSH_ROWS, configuration.getint))
+			self._flushTime = option('flush_time', DEFAULT_FLUSH_TIME, configuration.getfloat)
+			self._fsync = option('fsync', False, configuration.getboolean)
+			self._rotateSize = option('rotate_size', 0, configuration.getint)
+			self._rotateTime = option('rotate_time', 0, configuration.getint)
+			self._compression = option('compression', 'none').strip()
+		except (ConfigParser.Error, ValueError) as e:
 			self._enabled = False
 			raise CsvFileException("could not load all needed settings from the config file: " + str(e))
 
+		if self._compression not in COMPRESSIONS:
+			self._enabled = False
+			raise CsvFileException("unknown compression '%s', use one of: %s" % (self._compression,
+				', '.join(sorted(COMPRESSIONS))))
+		if self._compression == 'zstd':
+			try:
+				import zstandard
+			except ImportError:
+				self._enabled = False
+				raise CsvFileException("zstd compression needs the zstandard module")
+
 		try:
-			self._fileHandle = open(fileName, 'ab')
-			self._csv = csv.writer(self._fileHandle, delimiter = delimiter)
-
-			# write header
-			if self._fileHandle.tell() == 0:
-				print("Adding header to CSV file.")
-				self._csv.writerow(("Date:", "Time:", "Radiation [uSv/h]:", "CPM:"))
-		except IOError as e:
+			self._open()
+		except (IOError, OSError) as e:
 			self._enabled = False
 			raise CsvFileException("could not open log file to write: " + str(e))
 
+		if self._rotateTime > 0 and self._fileHandle.tell() > 0:
+			# the rows already in the file belong to the period of its last change
+			self._segmentPeriod = int(os.path.getmtime(self._fileName)) // self._rotateTime
+
+	def _existingDeviceColumn(self):
+		"""The rows appended to the file have to match its header, so the existing file decides. Returns None if
+		there's no file yet, the column is chosen by setDevices() then.
+		"""
+		try:
+			with open(self._fileName, 'rb') as existing:
+				header = existing.readline()
+			if header != '':
+				return 'Device:' in header
+		except IOError:
+			pass
+		return None
+
+	def setDevices(self, deviceIds):
+		"With 'device_column' set to 'auto', the new file gets the device column if more than one device is monitored."
+		if self._deviceColumn is None:
+			self._deviceColumn = len(deviceIds) > 1
+			self._writeHeader()
+
+	def _open(self, rotated = False):
+		self._fileHandle = open(self._fileName, 'ab', BUFFER_SIZE)
+		self._csv = csv.writer(self._fileHandle, delimiter = self._delimiter)
+		self._segmentPeriod = None
+
+		if self._deviceColumn is not None:
+			self._writeHeader(rotated)
+
+	def _writeHeader(self, rotated = False):
+		if self._fileHandle.tell() > 0:
+			return
+		if not rotated:
+			print("Adding header to CSV file.")
+		header = ("Date:", "Time:", "Radiation [uSv/h]:", "CPM:")
+		if self._deviceColumn:
+			header += ("Device:",)
+		self._csv.writerow(header)
+
+	def _rotate(self):
+		"Closes the file, renames and compresses it and opens a new one."
+		self._fileHandle.close()
+		base = segment = self._fileName + time.strftime(".%Y%m%d-%H%M%S")
+		number = 1
+		while os.path.exists(segment) or os.path.exists(segment + COMPRESSIONS[self._compression]):
+			segment = "%s-%d" % (base, number)
+			number += 1
+		os.rename(self._fileName, segment)
+		self._open(rotated = True)
+		if self._compression != 'none':
+			compressSegment(segment, self._compression)
+
 	def close(self):
-		"Closes the file."
+		"Writes the buffered rows and closes the file."
 		self._enabled = False
-		self._fileHandle.close()
+		if self._fileHandle is not None:
+			try:
+				self.flush(force = True)
+			finally:
+				self._fileHandle.close()
+				self._fileHandle = None
 
-	def update(self, timestamp, radiation, cpm):
-		timestamp = self.localTime(timestamp)
-		currDate = time.strftime(self._dateFormat, timestamp)
-		currTime = time.strftime(self._timeFormat, timestamp)
+	def flush(self, force = False):
+		"Writes the buffered rows to the disk if 'flush_time' passed since the oldest of them, or at once if forced."
+		if self._pendingRows == 0:
+			return
+		if not force and (self._flushTime <= 0 or time.time() - self._pendingSince < self._flushTime):
+			return
 		try:
-			self._csv.writerow((currDate, currTime, str(radiation).replace('.', self._decimalSep),
-					str(cpm).replace('.', self._decimalSep)))
 			self._fileHandle.flush()
-		except IOError as e:
+			if self._fsync:
+				os.fsync(self._fileHandle.fileno())
+		except (IOError, OSError) as e:
+			raise CsvFileException("could not write rows to the CSV file: " + str(e))
+		self._pendingRows = 0
+
+	def _formatTime(self, timestamp):
+		if timestamp != self._cachedTimestamp:
+			local = self.localTime(timestamp)
+			self._cachedDateTime = (time.strftime(self._dateFormat, local), time.strftime(self._timeFormat, local))
+			self._cachedTimestamp = timestamp
+		return self._cachedDateTime
+
+	def _formatNumber(self, value):
+		if self._decimalSep == '.':
+			return str(value)
+		return str(value).replace('.', self._decimalSep)
+
+	def update(self, timestamp, radiation, cpm, deviceId = None):
+		if self._deviceColumn is None:
+			# the devices weren't told, so it's used without the monitor
+			self.setDevices([deviceId])
+		currDate, currTime = self._formatTime(timestamp)
+		row = (currDate, currTime, self._formatNumber(radiation), self._formatNumber(cpm))
+		if self._deviceColumn:
+			row += (deviceId,)
+		try:
+			if self._rotateTime > 0:
+				period = calendar.timegm(timestamp) // self._rotateTime
+				if self._segmentPeriod is not None and period != self._segmentPeriod:
+					self.flush(force = True)
+					self._rotate()
+				self._segmentPeriod = period
+
+			self._csv.writerow(row)
+			if self._pendingRows == 0:
+				self._pendingSince = time.time()
+			self._pendingRows += 1
+			self.flush(force = self._pendingRows >= self._flushRows)
+
+			if self._rotateSize > 0 and self._fileHandle.tell() >= self._rotateSize:
+				self.flush(force = True)
+				self._rotate()
+		except (IOError, OSError) as e:
 			raise CsvFileException("could not write row to the CSV file: " + str(e))
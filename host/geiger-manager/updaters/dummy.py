@@ -10,13 +10,18 @@ import calendar
 import abc
 
 class UpdaterException(Exception):
-	pass
+	"""Thrown by the updater if the data couldn't be delivered. If the updater keeps the failed measurement to retry it
+	by itself, it sets 'samples' to the list of measurements it gave up on instead (possibly empty).
+	"""
+	samples = None
 
 class DummyUpdater(object):
 	"""This 'abstract' class provides and interface for all updater modules."""
 
 	__metaclass__ = abc.ABCMeta
 	_enabled = False
+	# whether failed measurements should be stored in the spool and delivered later
+	_spoolable = True
 
 	def __init__(self, configuration):
 		pass
@@ -25,10 +30,32 @@ class DummyUpdater(object):
 		"Returns status basing on configuration file entry."
 		return self._enabled
 
+	def isSpoolable(self):
+		"Returns True if it makes sense to deliver the measurements later, when they failed."
+		return self._spoolable
+
+	def setDevices(self, deviceIds):
+		"""Called by the monitor after creating the updater, before the first measurement, with the list of IDs of
+		the monitored devices. The updaters don't open the devices themselves.
+		"""
+		pass
+
+	def connect(self):
+		"""Opens the connection to the service in advance. It's called in the updater's own thread, so the updaters
+		connect in parallel without delaying the start. Updaters which connect also when sending don't have to care.
+		"""
+		pass
+
 	def close(self):
 		"Frees the resources."
 		self._enabled = False
 
+	def flush(self):
+		"""Sends the data buffered by the updater, if it buffers any. Called periodically when there are no new
+		measurements.
+		"""
+		pass
+
 	_timeDiffMeasured = None
 
 	def localTime(self, utcTime):
@@ -43,8 +70,27 @@ class DummyUpdater(object):
 
 		return time.gmtime(calendar.timegm(utcTime) + self._timeDiffMeasured)
 
-	def update(self, timestamp, radiation = None, cpm = None):
+	def update(self, timestamp, radiation = None, cpm = None, deviceId = None):
 		"""Sends data wherever they are sent. Both parameters are optional. Raises exception if no data
-		was delivered
+		was delivered. deviceId tells which Geiger device the measurement comes from.
 		"""
 		raise NotImplementedError
+
+	def updateRollup(self, rollup):
+		"""Sends the aggregate of many measurements (rollup.Rollup), if the updater is subscribed to minute, hour or
+		day resolution. By default the mean values are sent by update(), with the period start as the timestamp.
+		"""
+		self.update(**rollup.asSample())
+
+	def alert(self, alert):
+		"""Notifies about the start or the end of the radiation alarm (detector.Alert). Updaters which can tell
+		someone should override it, the others ignore the alerts.
+		"""
+		pass
+
+	def updateMany(self, samples):
+		"""Sends the list of measurements, each one is the dictionary of update() arguments. Used to replay the spool.
+		Updaters which can send many measurements at once should override it.
+		"""
+		for sample in samples:
+			self.update(**sample)
@@ -6,18 +6,84 @@
 '''
 
 import dummy
+import re
 import time
+import socket
 import ConfigParser
 import smtplib
+import tracing
 
 IDENTIFICATOR = 'SMTP e-mail notification'
+CONF_FILE_SECTION = 'email'
+
+# default alert coalescing settings, in seconds and uSv/h
+DEFAULT_MIN_INTERVAL = 300
+DEFAULT_DIGEST_INTERVAL = 3600
+DEFAULT_HYSTERESIS = 0.0
+
+DEFAULT_DIGEST_SUBJECT = 'Radiation above $threshold$ uSv/h: $count$ measurements, max. $max$ uSv/h'
+DEFAULT_DIGEST_CONTENT = 'Between $first$ and $last$ the radiation measured by $device$ exceeded $threshold$ uSv/h ' \
+	+ '$count$ times. Maximal value: $max$ uSv/h, mean: $mean$ uSv/h. The last measurement: $radiation$ uSv/h, ' \
+	+ 'CPM: $cpm$.'
+
+DEFAULT_ALERT_SUBJECT = 'Radiation $event$ at $device$: $cpm$ CPM, background $baseline$ CPM'
+DEFAULT_ALERT_CONTENT = 'At $time$ $date$ the change detector found the radiation measured by $device$ $event$. ' \
+	+ 'Estimated rate: $cpm$ CPM, background: $baseline$ CPM.'
+
+# the text put for $event$ in the alert templates, by the kind of detector.Alert
+ALERT_EVENTS = {'rise' : 'rising', 'end' : 'back to background'}
 
 class EmailNotificationException(dummy.UpdaterException):
 	pass
 
+class Template(object):
+	"""Message template with fields like $date$. It's split into the text and the field names once, so filling it
+	is a single join.
+	"""
+
+	_parts = None
+
+	def __init__(self, text):
+		self._parts = re.split(r'(\$\w+\$)', text.replace('\\n', '\n'))
+
+	def render(self, fields):
+		"Returns the text with the fields replaced by the values from the dictionary. Unknown fields stay untouched."
+		return ''.join([str(fields[part]) if part in fields else part for part in self._parts])
+
+class _Alarm(object):
+	"State of the alarm of one device: measurements above the threshold which weren't reported yet."
+
+	active = False
+	pending = 0
+	maximum = None
+	total = 0.0
+	first = None
+	last = None
+
+	def add(self, radiation, fields):
+		if self.pending == 0:
+			self.maximum = radiation
+			self.total = 0.0
+			self.first = fields
+		self.pending += 1
+		self.maximum = max(self.maximum, radiation)
+		self.total += radiation
+		self.last = fields
+
+	def clear(self):
+		self.pending = 0
+
 class EmailNotificationUpdater(dummy.DummyUpdater):
 	"""Sends the e-mail notifications to the addresses on the list if the radiation or CPM level exceeds
 	the given limit. You have to configure local SMTP server or use external one to use this module.
+
+	The alarm starts when the radiation reaches radiation_threshold and ends when it drops below
+	radiation_threshold - hysteresis. The first measurement of the alarm is reported at once; the following ones
+	are collected and sent as one digest mail every digest_interval seconds and when the alarm ends. No two mails
+	are sent closer than min_interval seconds. If the change detector is enabled and 'detector_alerts' is set, its
+	alerts are mailed at once, using alert_subject and alert_content.
+
+	The SMTP session is opened when the first mail is sent and kept open; it's reestablished if the server closes it.
 	"""
 
 	_dateFormat = None
@@ -26,18 +92,36 @@ class EmailNotificationUpdater(dummy.DummyUpdater):
 	_addressList = None
 	_messageSubject = None
 	_messageContent = None
+	_digestSubject = None
+	_digestContent = None
+	_alertSubject = None
+	_alertContent = None
+	_detectorAlerts = True
 
 	_smtp_server = None
 	_smtp_port = None
 	_smtp_user = None
 	_smtp_password = None
 	_smtp_sender_email = None
+	_smtp_starttls = True
 
 	_threshold = None
+	_thresholdValue = None
+	_hysteresis = DEFAULT_HYSTERESIS
+	_minInterval = DEFAULT_MIN_INTERVAL
+	_digestInterval = DEFAULT_DIGEST_INTERVAL
+
+	_session = None
+	_lastSent = None
+	_lastDigest = None
+	_alarms = None
+
+	# outdated alerts are useless
+	_spoolable = False
 
 	def __init__(self, configuration):
 		"""Reads configuration and sets up everything."""
-		confFileSection = 'email'
+		confFileSection = CONF_FILE_SECTION
 		try:
 			self._enabled = configuration.getboolean(confFileSection, 'enabled')
 		except Exception:
@@ -45,64 +129,161 @@ class EmailNotificationUpdater(dummy.DummyUpdater):
 		if self._enabled is False:
 			return
 
+		def option(name, default, getter = configuration.get):
+			if configuration.has_option(confFileSection, name):
+				return getter(confFileSection, name)
+			return default
+
 		try:
 			self._dateFormat = configuration.get(confFileSection, 'date_format')
 			self._timeFormat = configuration.get(confFileSection, 'time_format')
 
 			self._addressList = configuration.get(confFileSection, 'addresses').split(';')
-			self._addressList = map(lambda x: x.strip(), self._addressList)
+			self._addressList = [address.strip() for address in self._addressList if address.strip() != '']
 
-			self._messageSubject = configuration.get(confFileSection, 'message_subject')
-			self._messageContent = configuration.get(confFileSection, 'message_content')
+			self._messageSubject = Template(configuration.get(confFileSection, 'message_subject'))
+			self._messageContent = Template(configuration.get(confFileSection, 'message_content'))
+			self._digestSubject = Template(option('digest_subject', DEFAULT_DIGEST_SUBJECT))
+			self._digestContent = Template(option('digest_content', DEFAULT_DIGEST_CONTENT))
+			self._alertSubject = Template(option('alert_subject', DEFAULT_ALERT_SUBJECT))
+			self._alertContent = Template(option('alert_content', DEFAULT_ALERT_CONTENT))
+			self._detectorAlerts = option('detector_alerts', True, configuration.getboolean)
 
 			self._smtp_server = configuration.get(confFileSection, 'smtp_server')
 			self._smtp_port = int(configuration.get(confFileSection, 'smtp_port'))
 			self._smtp_user = configuration.get(confFileSection, 'smtp_user')
 			self._smtp_password = configuration.get(confFileSection, 'smtp_password')
 			self._smtp_sender_email = configuration.get(confFileSection, 'smtp_sender_email')
+			self._smtp_starttls = option('smtp_starttls', True, configuration.getboolean)
 
 			self._threshold = configuration.get(confFileSection, 'radiation_threshold')
+			self._thresholdValue = float(self._threshold)
+			self._hysteresis = option('hysteresis', DEFAULT_HYSTERESIS, configuration.getfloat)
+			self._minInterval = option('min_interval', DEFAULT_MIN_INTERVAL, configuration.getfloat)
+			self._digestInterval = option('digest_interval', DEFAULT_DIGEST_INTERVAL, configuration.getfloat)
 
-		except ConfigParser.Error as e:
+		except (ConfigParser.Error, ValueError) as e:
 			self._enabled = False
 			raise EmailNotificationException("could not load all needed settings from the config file: " + str(e))
 
-	def _fillFields(self, tmpl, timestamp, radiation, cpm):
+		self._alarms = {}
+
+	def _fields(self, timestamp, radiation, cpm, deviceId):
 		timestamp = self.localTime(timestamp)
 		currDate = time.strftime(self._dateFormat, timestamp)
 		currTime = time.strftime(self._timeFormat, timestamp)
 
-		replaces = {'$date$' : currDate, '$time$' : currTime, '$cpm$' : cpm,
-			'$radiation$' : radiation, '$threshold$' : self._threshold, '\\n' : '\n' }
+		return {'$date$' : currDate, '$time$' : currTime, '$cpm$' : cpm, '$radiation$' : radiation,
+			'$threshold$' : self._threshold, '$device$' : deviceId}
 
-		for old in replaces:
-			tmpl = tmpl.replace(old, str(replaces[old]))
+	@tracing.traced('email.connect')
+	def _openSession(self):
+		session = smtplib.SMTP(self._smtp_server, self._smtp_port, timeout = 30)
+		session.ehlo()
+		if self._smtp_starttls:
+			session.starttls()
+			session.ehlo()
+		if self._smtp_user:
+			session.login(self._smtp_user, self._smtp_password)
+		return session
 
-		return tmpl
+	def _closeSession(self):
+		if self._session is not None:
+			try:
+				self._session.quit()
+			except (smtplib.SMTPException, socket.error):
+				pass
+			self._session = None
 
+	def _send(self, subject, content):
+		"Sends one mail to all addresses. If the kept session turns out to be closed, it's opened again once."
+		header = 'To: ' + ', '.join(self._addressList) + '\n' + 'From: ' + self._smtp_sender_email + '\n' \
+			+ 'Subject: ' + subject + '\n\n'
 
+		for attempt in (1, 2):
+			try:
+				if self._session is None:
+					self._session = self._openSession()
+				with tracing.span('email.send'):
+					self._session.sendmail(self._smtp_sender_email, self._addressList, header + content)
+				break
+			except (smtplib.SMTPServerDisconnected, socket.error) as e:
+				self._session = None
+				if attempt == 2:
+					raise EmailNotificationException("Failed to send notification e-mail: " + str(e))
+			except Exception as e:
+				self._closeSession()
+				raise EmailNotificationException("Failed to send notification e-mail: " + str(e))
 
-	def update(self, timestamp, radiation, cpm):
+		self._lastSent = time.time()
+
+	def _canSend(self):
+		return self._lastSent is None or time.time() - self._lastSent >= self._minInterval
+
+	def _sendDigest(self, deviceId, alarm):
+		fields = dict(alarm.last)
+		fields.update({'$count$' : alarm.pending, '$max$' : alarm.maximum, '$mean$' : round(alarm.total / alarm.pending, 3),
+			'$first$' : alarm.first['$time$'] + ' ' + alarm.first['$date$'],
+			'$last$' : alarm.last['$time$'] + ' ' + alarm.last['$date$']})
+		self._send(self._digestSubject.render(fields), self._digestContent.render(fields))
+		alarm.clear()
+		self._lastDigest = time.time()
+
+	def update(self, timestamp, radiation, cpm, deviceId = None):
 		"""If the radiation level exceeds the defined threshold, e-mails to all defined receivers are send.
 		"""
+		alarm = self._alarms.get(deviceId)
+		if alarm is None:
+			alarm = self._alarms[deviceId] = _Alarm()
 
-		if radiation < float(self._threshold):
+		if not alarm.active:
+			if radiation < self._thresholdValue:
+				return
+			alarm.active = True
+			fields = self._fields(timestamp, radiation, cpm, deviceId)
+			if not self._canSend():
+				alarm.add(radiation, fields)
+				return
+			try:
+				self._send(self._messageSubject.render(fields), self._messageContent.render(fields))
+			except EmailNotificationException:
+				# the measurement isn't lost, it goes with the next digest
+				alarm.add(radiation, fields)
+				raise
+			self._lastDigest = time.time()
 			return
 
-		subject = self._fillFields(self._messageSubject, timestamp, radiation, cpm)
-		content = self._fillFields(self._messageContent, timestamp, radiation, cpm)
+		if radiation < self._thresholdValue - self._hysteresis:
+			# the alarm ends, what wasn't reported yet is sent as soon as the rate limit allows
+			alarm.active = False
+			self.flush()
+			return
 
-		try:
-			smtpserver = smtplib.SMTP(self._smtp_server, self._smtp_port)
-			smtpserver.ehlo()
-			smtpserver.starttls()
-			smtpserver.ehlo
-			smtpserver.login(self._smtp_user, self._smtp_password)
-
-			for address in self._addressList:
-				header = 'To:' + address + '\n' + 'From: ' + self._smtp_sender_email + '\n' + 'Subject:' + subject + '\n\n'
-				smtpserver.sendmail(self._smtp_sender_email, address, header + content)
-
-			smtpserver.close()
-		except Exception as e:
-			raise EmailNotificationException("Failed to send notification e-mail: " + str(e))
+		if radiation >= self._thresholdValue:
+			alarm.add(radiation, self._fields(timestamp, radiation, cpm, deviceId))
+		self.flush()
+
+	def alert(self, alert):
+		"""Mails the alert of the change detector. It's sent regardless of min_interval, the early warning is
+		its point.
+		"""
+		if not self._detectorAlerts:
+			return
+		fields = self._fields(alert.time, None, round(alert.cpm or 0.0, 1), alert.deviceId)
+		fields.update({'$event$' : ALERT_EVENTS[alert.kind], '$baseline$' : round(alert.baselineCPM, 1)})
+		self._send(self._alertSubject.render(fields), self._alertContent.render(fields))
+
+	def flush(self):
+		"Sends the digests which are due."
+		if self._alarms is None:
+			return
+		for deviceId, alarm in self._alarms.items():
+			if alarm.pending == 0 or not self._canSend():
+				continue
+			if self._lastDigest is None or time.time() - self._lastDigest >= self._digestInterval or not alarm.active:
+				self._sendDigest(deviceId, alarm)
+
+	def close(self):
+		"Closes the SMTP session."
+		self._enabled = False
+		self._closeSession()
@@ -7,16 +7,28 @@
 
 import dummy
 import ConfigParser
+import importlib
 import time
+import tracing
 
 IDENTIFICATOR = 'MySQL'
+CONF_FILE_SECTION = 'mysql'
+
+# default batching settings
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_BATCH_TIME = 60.0
+DEFAULT_MAX_BUFFER = 1000
 
 class MySQLUpdaterException(dummy.UpdaterException):
 	pass
 
 class MySQLUpdater(dummy.DummyUpdater):
 	"""Inserts data to MySQL table given. The table has to have columns named 'cpm', 'radiation' and 'time'.
-	Connects the database each time.
+	If the option 'device_column' is set, the device ID is stored in the column of that name.
+	The rows are buffered and inserted in batches of 'batch_size' rows, or after 'batch_time' seconds since
+	the oldest buffered row, whichever comes first. The connection is kept open and reestablished after errors.
+	The option 'driver' selects other DB-API module than MySQLdb, e.g. sqlite3 for local tests; in that case
+	'db_name' is the database file name and the remaining connection options are ignored.
 	"""
 
 	_dbName = None
@@ -24,12 +36,24 @@ class MySQLUpdater(dummy.DummyUpdater):
 	_dbPassword = None
 	_dbHost = None
 	_tableName = None
+	_deviceColumn = None
+
+	_driverName = 'MySQLdb'
+	_driver = None
+	_db = None
+	_query = None
+
+	_batchSize = DEFAULT_BATCH_SIZE
+	_batchTime = DEFAULT_BATCH_TIME
+	_maxBuffer = DEFAULT_MAX_BUFFER
+	_buffer = None
+	_bufferSince = None
 
 	def __init__(self, configuration):
-		"""Reads configuration from the file and starts the connection with the database. The connection
-		is held during the whole program runtime.
+		"""Reads configuration from the file. The connection with the database is opened by connect() or by the first
+		insert and held during the whole program runtime.
 		"""
-		confFileSection = 'mysql'
+		confFileSection = CONF_FILE_SECTION
 		try:
 			self._enabled = configuration.getboolean(confFileSection, 'enabled')
 		except Exception:
@@ -38,44 +62,167 @@ class MySQLUpdater(dummy.DummyUpdater):
 			return
 		try:
 			self._dbName = configuration.get(confFileSection, 'db_name')
-			self._dbUser = configuration.get(confFileSection, 'user')
-			self._dbPassword = configuration.get(confFileSection, 'password')
-			self._dbHost = configuration.get(confFileSection, 'host')
 			self._tableName = configuration.get(confFileSection, 'table_name')
-		except ConfigParser.Error as e:
+			if configuration.has_option(confFileSection, 'driver'):
+				self._driverName = configuration.get(confFileSection, 'driver').strip()
+			if self._driverName != 'sqlite3':
+				self._dbUser = configuration.get(confFileSection, 'user')
+				self._dbPassword = configuration.get(confFileSection, 'password')
+				self._dbHost = configuration.get(confFileSection, 'host')
+			if configuration.has_option(confFileSection, 'device_column'):
+				self._deviceColumn = configuration.get(confFileSection, 'device_column').strip() or None
+			if configuration.has_option(confFileSection, 'batch_size'):
+				self._batchSize = max(1, configuration.getint(confFileSection, 'batch_size'))
+			if configuration.has_option(confFileSection, 'batch_time'):
+				self._batchTime = configuration.getfloat(confFileSection, 'batch_time')
+			if configuration.has_option(confFileSection, 'max_buffer'):
+				self._maxBuffer = max(self._batchSize, configuration.getint(confFileSection, 'max_buffer'))
+		except (ConfigParser.Error, ValueError) as e:
 			self._enabled = False
 			raise MySQLUpdaterException(str(e) + ". data is incomplete.")
 
-		# import is  here to don't throw exceptions about missing MySQLdb odules if they're not used
-		import MySQLdb
-
+		# import is here to don't throw exceptions about missing MySQLdb modules if they're not used
 		try:
-			db = MySQLdb.connect(host = self._dbHost, user = self._dbUser,
-				passwd = self._dbPassword, db = self._dbName)
-			db.close()
-		except MySQLdb.Error as e:
+			self._driver = importlib.import_module(self._driverName)
+		except ImportError as e:
 			self._enabled = False
+			raise MySQLUpdaterException(str(e) + ". Database driver is missing.")
+
+		self._query = self._buildQuery()
+		self._buffer = []
+
+	def connect(self):
+		"Opens the connection with the database, if it isn't open."
+		if self._db is not None:
+			return
+		try:
+			self._connect()
+		except self._driver.Error as e:
 			raise MySQLUpdaterException(str(e) + ". Connection failed.")
 
+	def _buildQuery(self):
+		columns = ['radiation', 'cpm', 'time']
+		if self._deviceColumn is not None:
+			columns.append(self._deviceColumn)
+
+		# MySQLdb uses %s, sqlite3 uses ? as the parameter placeholder
+		if self._driver.paramstyle == 'qmark':
+			placeholder = '?'
+		else:
+			placeholder = '%s'
+
+		return "insert into " + self._tableName + "(" + ', '.join(columns) + ") values (" \
+			+ ', '.join([placeholder] * len(columns)) + ")"
+
+	@tracing.traced('mysql.connect')
+	def _connect(self):
+		if self._driverName == 'sqlite3':
+			self._db = self._driver.connect(self._dbName)
+		else:
+			self._db = self._driver.connect(host = self._dbHost, user = self._dbUser,
+				passwd = self._dbPassword, db = self._dbName)
+
+	def _disconnect(self):
+		if self._db is not None:
+			try:
+				self._db.close()
+			except self._driver.Error:
+				pass
+			self._db = None
+
 	def close(self):
-		"Disconnects the database."
+		"""Inserts the buffered rows, regardless of batch_time, and disconnects the database. It should be called
+		in the thread which inserted the rows, as some drivers (e.g. sqlite3) don't let the connection change threads.
+		If the insert fails, all buffered rows are passed in the exception, so they can be spooled.
+		"""
+		if self._enabled:
+			try:
+				if len(self._buffer) > 0:
+					self._insertBuffer()
+			except MySQLUpdaterException as e:
+				e.samples = (e.samples or []) + self._buffer
+				self._buffer = []
+				raise
+			finally:
+				self._disconnect()
 		self._enabled = False
 
-	def update(self, timestamp, radiation, cpm):
-		"""Inserts new row to the database table. Both radiation and CPM have to be provided.
+	def _row(self, sample):
+		strTime = time.strftime('%Y-%m-%d %H:%M:%S', self.localTime(sample['timestamp']))
+		row = (float(sample['radiation']), float(sample['cpm']), strTime)
+		if self._deviceColumn is not None:
+			row += (sample['deviceId'],)
+		return row
+
+	def update(self, timestamp, radiation, cpm, deviceId = None):
+		"""Adds new row to the buffer and inserts the buffer to the database table if it's full or old enough.
+		Both radiation and CPM have to be provided.
 		"""
-		import MySQLdb
+		if len(self._buffer) == 0:
+			self._bufferSince = time.time()
+		self._buffer.append({'timestamp' : timestamp, 'radiation' : radiation, 'cpm' : cpm, 'deviceId' : deviceId})
+
+		if len(self._buffer) >= self._batchSize:
+			self._insertBuffer()
+		else:
+			self.flush()
+
+	def flush(self):
+		"Inserts the buffered rows if the oldest of them waits longer than batch_time."
+		if len(self._buffer) > 0 and time.time() - self._bufferSince >= self._batchTime:
+			self._insertBuffer()
+
+	def updateMany(self, samples):
+		"Inserts the list of measurements at once, bypassing the buffer."
 		try:
-			db = MySQLdb.connect(host = self._dbHost, user = self._dbUser,
-				passwd = self._dbPassword, db = self._dbName)
+			self._insertSamples(samples)
+		except self._driver.Error as e:
+			exp = MySQLUpdaterException("Could not insert %d rows to the table: %s" % (len(samples), str(e)))
+			exp.samples = []
+			raise exp
 
-			cursor = db.cursor()
-			strTime = time.strftime('%Y-%m-%d %H:%M:%S', self.localTime(timestamp))
-			cursor.execute("insert into " + self._tableName + "(radiation, cpm, time) values (%s, %s, %s)",
-				(float(radiation), float(cpm), strTime))
-			cursor.close()
-			db.commit()
-			db.close()
+	def _insertBuffer(self):
+		"""Inserts all buffered rows with one query. Rows which couldn't be inserted stay in the buffer, up to
+		max_buffer newest ones. The older ones are passed in the exception, so they can be spooled.
+		"""
+		try:
+			self._insertSamples(self._buffer)
+		except self._driver.Error as e:
+			exp = MySQLUpdaterException("Could not insert %d rows to the table: %s" % (len(self._buffer), str(e)))
+			exp.samples = self._buffer[:max(0, len(self._buffer) - self._maxBuffer)]
+			del self._buffer[:len(exp.samples)]
+			raise exp
+
+		self._buffer = []
+
+	def _insertSamples(self, samples):
+		"If the query fails, the connection is reestablished and the query is repeated once."
+		rows = [self._row(sample) for sample in samples]
+		try:
+			self._insertRows(rows)
+		except self._driver.Error:
+			self._disconnect()
+			try:
+				self._insertRows(rows)
+			except self._driver.Error:
+				self._disconnect()
+				raise
 
-		except MySQLdb.Error as e:
-			raise MySQLUpdaterException("Could not insert new row to the table: " + str(e))
+	def _insertRows(self, rows):
+		if self._db is None:
+			self._connect()
+
+		cursor = self._db.cursor()
+		try:
+			with tracing.span('mysql.execute'):
+				cursor.executemany(self._query, rows)
+			with tracing.span('mysql.commit'):
+				self._db.commit()
+		except self._driver.Error:
+			try:
+				self._db.rollback()
+			except self._driver.Error:
+				pass
+			raise
+		finally:
+			cursor.close()
@@ -0,0 +1,261 @@
+# -*- encoding: utf-8 -*-
+'''
+ * USB Geiger counter manager
+ * 2013 Michał Słomkowski
+ * This code is distributed under the terms of GNU General Public License version 3.0.
+'''
+
+import os
+import json
+import time
+import calendar
+import logging
+import dummy
+
+# default settings, can be changed in [spool] section
+DEFAULT_DIRECTORY = 'spool'
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_SYNC_EVERY = 50
+DEFAULT_SYNC_INTERVAL = 5.0
+
+SEGMENT_SUFFIX = '.seg'
+POSITION_FILE = 'position'
+
+class SpoolException(dummy.UpdaterException):
+	pass
+
+class Spool(object):
+	"""Write-ahead log for measurements which couldn't be delivered by an updater. The measurements are appended
+	as JSON lines to segment files in the directory of the updater. A segment is closed after reaching segmentSize
+	bytes and a new one is started. Writes are synced to disk every syncEvery records or syncInterval seconds.
+	When the spool grows over maxSize bytes, the oldest segments are removed.
+
+	The measurements are read back oldest first with read() and removed with consume() after successful delivery,
+	so nothing is lost if the program stops in the middle of replay. The read position is kept in a small file
+	next to the segments.
+	"""
+
+	_directory = None
+	_maxSize = None
+	_segmentSize = None
+	_syncEvery = None
+	_syncInterval = None
+
+	# sorted list of segment numbers
+	_segments = None
+	_sizes = None
+
+	_writeHandle = None
+	_unsynced = 0
+	_lastSync = None
+
+	# (segment number, byte offset) of the first unconsumed record
+	_readSegment = None
+	_readOffset = 0
+
+	_lost = 0
+	_log = None
+
+	def __init__(self, directory, maxSize = DEFAULT_MAX_SIZE, segmentSize = DEFAULT_SEGMENT_SIZE,
+			syncEvery = DEFAULT_SYNC_EVERY, syncInterval = DEFAULT_SYNC_INTERVAL):
+		self._log = logging.getLogger("geiger.spool")
+		self._directory = directory
+		self._maxSize = maxSize
+		self._segmentSize = min(segmentSize, maxSize)
+		self._syncEvery = syncEvery
+		self._syncInterval = syncInterval
+		self._lastSync = time.time()
+
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+
+			self._segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+				if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+			self._sizes = {}
+			for number in self._segments:
+				self._sizes[number] = os.path.getsize(self._segmentPath(number))
+
+			if len(self._segments) > 0:
+				self._repairLastSegment()
+			self._loadPosition()
+		except (IOError, OSError) as e:
+			raise SpoolException("could not open spool directory '%s': %s" % (directory, str(e)))
+
+	def _segmentPath(self, number):
+		return os.path.join(self._directory, "%010d%s" % (number, SEGMENT_SUFFIX))
+
+	def _repairLastSegment(self):
+		"If the program was killed in the middle of writing, the last line is incomplete and it's cut off."
+		number = self._segments[-1]
+		size = self._sizes[number]
+		if size == 0:
+			return
+		with open(self._segmentPath(number), 'r+b') as handle:
+			handle.seek(max(0, size - 4096))
+			tail = handle.read()
+			if tail.endswith('\n'):
+				return
+			cut = tail.rfind('\n')
+			newSize = size - len(tail) + cut + 1
+			handle.truncate(newSize)
+			self._sizes[number] = newSize
+			self._log.warning("Removed incomplete record from spool segment %s.", self._segmentPath(number))
+
+	def _loadPosition(self):
+		self._readSegment = self._segments[0] if len(self._segments) > 0 else None
+		self._readOffset = 0
+		try:
+			with open(os.path.join(self._directory, POSITION_FILE)) as handle:
+				number, offset = [int(value) for value in handle.read().split()]
+		except (IOError, ValueError):
+			return
+		if number in self._sizes:
+			self._readSegment = number
+			self._readOffset = min(offset, self._sizes[number])
+
+	def _savePosition(self):
+		path = os.path.join(self._directory, POSITION_FILE)
+		with open(path + '.tmp', 'w') as handle:
+			handle.write("%d %d\n" % (self._readSegment if self._readSegment is not None else 0, self._readOffset))
+		os.rename(path + '.tmp', path)
+
+	def getSize(self):
+		"Returns the number of bytes in all segments."
+		return sum(self._sizes.values())
+
+	def getPendingSize(self):
+		"Returns the number of bytes not consumed yet."
+		if self._readSegment is None:
+			return 0
+		return sum(size for number, size in self._sizes.items() if number >= self._readSegment) - self._readOffset
+
+	def getLostCount(self):
+		"Returns the number of records removed because the spool exceeded its maximal size."
+		return self._lost
+
+	def isEmpty(self):
+		"Returns True if there's nothing to replay."
+		return self.getPendingSize() <= 0
+
+	def append(self, samples):
+		"""Appends the list of measurements. Each measurement is the dictionary with keys timestamp (UTC time_struct),
+		radiation, cpm and deviceId.
+		"""
+		if len(samples) == 0:
+			return
+		try:
+			for s in samples:
+				line = json.dumps([calendar.timegm(s['timestamp']), s['radiation'], s['cpm'], s['deviceId']],
+					separators = (',', ':')) + '\n'
+				if self._writeHandle is None or self._sizes[self._segments[-1]] >= self._segmentSize:
+					self._rotate()
+					self._enforceLimit()
+				self._writeHandle.write(line)
+				self._sizes[self._segments[-1]] += len(line)
+				self._unsynced += 1
+
+			if self._unsynced >= self._syncEvery or time.time() - self._lastSync >= self._syncInterval:
+				self.sync()
+		except (IOError, OSError) as e:
+			raise SpoolException("could not write to spool: " + str(e))
+
+	def _rotate(self):
+		"Closes the current segment and starts the new one."
+		self.sync()
+		if self._writeHandle is not None:
+			self._writeHandle.close()
+			self._writeHandle = None
+
+		number = self._segments[-1] + 1 if len(self._segments) > 0 else 1
+		self._writeHandle = open(self._segmentPath(number), 'ab')
+		self._segments.append(number)
+		self._sizes[number] = 0
+		if self._readSegment is None:
+			self._readSegment = number
+			self._readOffset = 0
+
+	def _enforceLimit(self):
+		while self.getSize() > self._maxSize and len(self._segments) > 1:
+			number = self._segments.pop(0)
+			path = self._segmentPath(number)
+			if self._readSegment is None or number >= self._readSegment:
+				# the segment wasn't replayed, so its records are lost
+				with open(path, 'rb') as handle:
+					handle.seek(self._readOffset if number == self._readSegment else 0)
+					lost = sum(1 for line in handle)
+				self._lost += lost
+				self._log.error("Spool %s exceeded %d bytes, %d oldest records dropped.", self._directory,
+					self._maxSize, lost)
+			os.remove(path)
+			del self._sizes[number]
+			if self._readSegment == number:
+				self._readSegment = self._segments[0]
+				self._readOffset = 0
+				self._savePosition()
+
+	def sync(self):
+		"Forces the written records to the disk."
+		if self._writeHandle is not None and self._unsynced > 0:
+			self._writeHandle.flush()
+			os.fsync(self._writeHandle.fileno())
+		self._unsynced = 0
+		self._lastSync = time.time()
+
+	def read(self, count):
+		"""Returns the tuple: list of at most count oldest measurements and the position to pass to consume()
+		after they have been delivered.
+		"""
+		samples = []
+		number = self._readSegment
+		offset = self._readOffset
+
+		if self._writeHandle is not None:
+			self._writeHandle.flush()
+
+		while number is not None and len(samples) < count:
+			with open(self._segmentPath(number), 'rb') as handle:
+				handle.seek(offset)
+				while len(samples) < count:
+					line = handle.readline()
+					if not line.endswith('\n'):
+						break
+					offset += len(line)
+					try:
+						epoch, radiation, cpm, deviceId = json.loads(line)
+					except ValueError:
+						self._log.error("Corrupted record in spool segment %s skipped.", self._segmentPath(number))
+						continue
+					samples.append({'timestamp' : time.gmtime(epoch), 'radiation' : radiation, 'cpm' : cpm,
+						'deviceId' : deviceId})
+
+			if len(samples) < count:
+				following = [n for n in self._segments if n > number]
+				if len(following) == 0:
+					break
+				number = following[0]
+				offset = 0
+
+		return (samples, (number, offset))
+
+	def consume(self, position):
+		"Marks the measurements returned by read() as delivered and removes the segments which were replayed."
+		number, offset = position
+		try:
+			for old in [n for n in self._segments if n < number]:
+				os.remove(self._segmentPath(old))
+				self._segments.remove(old)
+				del self._sizes[old]
+			self._readSegment = number
+			self._readOffset = offset
+			self._savePosition()
+		except (IOError, OSError) as e:
+			raise SpoolException("could not update spool position: " + str(e))
+
+	def close(self):
+		"Syncs and closes the current segment."
+		if self._writeHandle is not None:
+			self.sync()
+			self._writeHandle.close()
+			self._writeHandle = None
@@ -5,10 +5,14 @@
  * This code is distributed under the terms of GNU General Public License version 3.0.
 '''
 
-import usb.core
-import usb.util
 import ConfigParser
+import collections
 import logging
+import os
+import struct
+import threading
+import time
+import tracing
 
 # these values are provided with V-USB for shared use
 VENDOR_ID = 0x16c0
@@ -25,6 +29,25 @@ GET_INTERVAL = 21
 SET_VOLTAGE = 30
 GET_VOLTAGE = 31
 ACKNOWLEDGE_UNCHECKED_COUNT = 40
+GET_SNAPSHOT = 50
+GET_HISTORY = 60
+
+# layout of the GET_SNAPSHOT response: CPI, interval, voltage, count acknowledged flag
+SNAPSHOT_FORMAT = '<HHHB'
+SNAPSHOT_LENGTH = struct.calcsize(SNAPSHOT_FORMAT)
+
+# layout of the GET_HISTORY response: sequence number of the latest interval, number of counts, interval, voltage,
+# followed by the counts; the firmware keeps the counts of HISTORY_LENGTH latest intervals
+HISTORY_HEADER_FORMAT = '<BBHH'
+HISTORY_HEADER_LENGTH = struct.calcsize(HISTORY_HEADER_FORMAT)
+HISTORY_LENGTH = 8
+# wValue of GET_HISTORY asking for all stored counts
+HISTORY_ALL = 0x100
+
+# vendor request to the device, host to device and device to host; the same values give
+# usb.util.build_request_type(), but pyusb is imported only when the USB transport is used
+REQUEST_TYPE_OUT = 0x40
+REQUEST_TYPE_IN = 0xc0
 
 # default values
 TUBE_SENSITIVITY = 25.0
@@ -32,8 +55,19 @@ VOLTAGE_DIVIDER_UPPER_RESISTOR = 2000
 VOLTAGE_DIVIDER_LOWER_RESISTOR = 4.7
 TUBE_VOLTAGE = 390
 
+# failed transfer is repeated this number of times, waiting RETRY_DELAY seconds doubled after each attempt
+TRANSFER_RETRIES = 2
+RETRY_DELAY = 0.01
+
+# device nodes of usbfs, their changes show plugging and unplugging of the devices
+USB_DEVICE_DIRECTORY = '/dev/bus/usb'
+# how often ReplugWatcher checks the devices, in seconds
+WATCH_INTERVAL = 0.5
+
 # unmodifiable values
 TIMER_TICKS_PER_SECOND = 100
+# the interval is sent to the device in timer ticks, as two bytes
+MAX_INTERVAL = 0xffff / TIMER_TICKS_PER_SECOND
 MIN_VOLTAGE = 50
 MAX_VOLTAGE = 450
 
@@ -41,6 +75,191 @@ class CommException(Exception):
 	"This exception is thrown if an USB communication error with the Geiger device occurs."
 	pass
 
+class TransportError(Exception):
+	"Thrown by the transport if the transfer or the reset of the device failed."
+	pass
+
+
+DeviceInfo = collections.namedtuple('DeviceInfo', ['deviceId', 'bus', 'port', 'address', 'serial'])
+
+Snapshot = collections.namedtuple('Snapshot', ['cpi', 'rawInterval', 'rawVoltage', 'countAcknowledged'])
+
+Measurement = collections.namedtuple('Measurement', ['cpm', 'radiation', 'voltage'])
+
+History = collections.namedtuple('History', ['sequence', 'counts', 'rawInterval', 'rawVoltage', 'lost'])
+
+class UsbTransport(object):
+	"""Transport to the real devices, using pyusb. A transport finds the Geiger devices and performs control
+	transfers; the simulated one is in the module simulator.
+	"""
+
+	_core = None
+	_util = None
+
+	def __init__(self):
+		# import is here to don't require pyusb when the simulated devices are used
+		try:
+			import usb.core
+			import usb.util
+		except ImportError as e:
+			raise CommException(str(e) + ". pyusb library is missing.")
+		self._core = usb.core
+		self._util = usb.util
+
+	def _describeDevice(self, dev):
+		"""Builds DeviceInfo for given pyusb device. The ID is the serial number if the firmware provides one,
+		otherwise it's the bus number and the port path, like '1-1.2'. The port path doesn't change when the device
+		is re-enumerated, so the ID stays the same after reset.
+		"""
+		serial = None
+		try:
+			if dev.iSerialNumber:
+				serial = self._util.get_string(dev, 256, dev.iSerialNumber)
+		except (self._core.USBError, ValueError):
+			pass
+
+		portNumbers = getattr(dev, 'port_numbers', None)
+		if portNumbers:
+			port = '.'.join(str(number) for number in portNumbers)
+		else:
+			port = str(getattr(dev, 'port_number', None) or dev.address)
+
+		deviceId = serial if serial else "%d-%s" % (dev.bus, port)
+
+		return DeviceInfo(deviceId, dev.bus, port, dev.address, serial)
+
+	def findDevices(self):
+		"Yields (DeviceInfo, device handle) pairs for each Geiger device connected to the host."
+		for dev in self._core.find(idVendor = VENDOR_ID, idProduct = DEVICE_ID, find_all = True):
+			try:
+				vendorName = self._util.get_string(dev, 256, dev.iManufacturer)
+				deviceName = self._util.get_string(dev, 256, dev.iProduct)
+			except (self._core.USBError, ValueError):
+				# device without access rights or in the middle of enumeration
+				continue
+
+			if vendorName == VENDOR_NAME and deviceName == DEVICE_NAME:
+				yield (self._describeDevice(dev), dev)
+
+	def reopen(self, device, info):
+		"""Frees the device and finds it again at the bus and address from info, without reading the descriptors of
+		other devices. Returns the new handle, or None if there's no device with the same ID at that address.
+		"""
+		if device is not None:
+			try:
+				self._util.dispose_resources(device)
+			except self._core.USBError:
+				pass
+		dev = self._core.find(idVendor = VENDOR_ID, idProduct = DEVICE_ID, bus = info.bus, address = info.address)
+		if dev is None or self._describeDevice(dev).deviceId != info.deviceId:
+			return None
+		return dev
+
+	def getTopology(self):
+		"""Returns the set of the USB device nodes, which changes when any device is plugged or unplugged. It costs
+		no USB transfer. Returns None if it can't be told, i.e. there's no usbfs.
+		"""
+		try:
+			return frozenset(os.path.join(bus, node) for bus in os.listdir(USB_DEVICE_DIRECTORY)
+				for node in os.listdir(os.path.join(USB_DEVICE_DIRECTORY, bus)))
+		except OSError:
+			return None
+
+	def controlOut(self, device, request, value):
+		"Sends the vendor request without data."
+		try:
+			device.ctrl_transfer(REQUEST_TYPE_OUT, request, value)
+		except self._core.USBError as e:
+			raise TransportError(str(e))
+
+	def controlIn(self, device, request, value, length):
+		"Sends the vendor request and returns at most length bytes of the response."
+		try:
+			return device.ctrl_transfer(REQUEST_TYPE_IN, request, value, 0, length)
+		except self._core.USBError as e:
+			raise TransportError(str(e))
+
+	def reset(self, device):
+		"Resets the device and frees its resources."
+		try:
+			device.reset()
+			self._util.dispose_resources(device)
+		except self._core.USBError as e:
+			raise TransportError(str(e))
+
+
+_transport = None
+
+def getTransport():
+	"Returns the transport used by default by the connectors. If none was set, the USB transport is created."
+	global _transport
+	if _transport is None:
+		_transport = UsbTransport()
+	return _transport
+
+def setTransport(transport):
+	"Sets the transport used by default by the connectors."
+	global _transport
+	_transport = transport
+
+def configureTransport(configuration):
+	"""Sets the default transport chosen by the option 'transport' in section 'device': 'usb', which is the default,
+	or 'simulator', which uses the simulated devices configured in section 'simulator'.
+	"""
+	try:
+		name = configuration.get('device', 'transport').strip()
+	except ConfigParser.Error:
+		name = 'usb'
+
+	if name == 'usb':
+		setTransport(UsbTransport())
+	elif name == 'simulator':
+		import simulator
+		setTransport(simulator.SimulatedTransport.fromConfiguration(configuration))
+	else:
+		raise CommException("unknown transport: '%s'" % name)
+
+class ReplugWatcher(threading.Thread):
+	"""Calls the callback without arguments each time a device is plugged or unplugged, checking the topology of
+	the transport every 'interval' seconds. It doesn't access the devices. If the transport can't report its
+	topology, the watcher ends at once.
+	"""
+
+	_transport = None
+	_callback = None
+	_interval = None
+	_stopEvent = None
+
+	def __init__(self, transport, callback, interval = WATCH_INTERVAL):
+		threading.Thread.__init__(self, name = "geiger-replug")
+		self.setDaemon(True)
+		self._transport = transport
+		self._callback = callback
+		self._interval = interval
+		self._stopEvent = threading.Event()
+
+	def run(self):
+		topology = self._transport.getTopology()
+		if topology is None:
+			logging.getLogger("geiger.usbcomm").info("Plugging in of the devices can't be watched.")
+			return
+		while not self._stopEvent.wait(self._interval):
+			current = self._transport.getTopology()
+			if current != topology:
+				topology = current
+				self._callback()
+
+	def stop(self):
+		"Stops watching."
+		self._stopEvent.set()
+		if self.isAlive() and self is not threading.currentThread():
+			self.join()
+
+
+def listDevices():
+	"Returns the list of DeviceInfo tuples describing all Geiger devices connected to the host, sorted by ID."
+	return sorted((info for info, dev in getTransport().findDevices()), key = lambda info: info.deviceId)
+
 
 class RawConnector(object):
 	"""Low level class for Geiger device communication. It handles all libusb calls and supports all low level functions.
@@ -49,52 +268,141 @@ class RawConnector(object):
 	units.
 	"""
 
+	_transport = None
 	_device = None
-
-	def __init__(self):
-		"""Initiates the class and opens the device. Warning! The constructor assumes that only one Geiger device
-		is connected to the bus. Otherwise, it opens the first-found one.
+	_deviceInfo = None
+	_deviceId = None
+	_retries = TRANSFER_RETRIES
+	_retryDelay = RETRY_DELAY
+	# recovery counters: transfers repeated, reopens and resets which restored communication, failed recoveries
+	_recoveries = None
+	# None until the first GET_SNAPSHOT attempt tells if the firmware supports it
+	_snapshotSupported = None
+	# None until the first GET_HISTORY attempt tells if the firmware keeps the history
+	_historySupported = None
+	# serializes device access when the connector is shared by threads, e.g. in event capture mode
+	_lock = None
+
+	def __init__(self, deviceId = None, transport = None):
+		"""Initiates the class and opens the device with given ID (see listDevices()). If the ID is not given,
+		the first-found Geiger device is opened. If the transport is not given, the default one is used.
 		"""
+		self._deviceId = deviceId
+		self._transport = transport if transport is not None else getTransport()
+		self._lock = threading.RLock()
+		self._recoveries = {'retry' : 0, 'reopen' : 0, 'reset' : 0, 'failed' : 0}
 		self._openDevice()
 
 	def _openDevice(self):
-		for dev in usb.core.find(idVendor = VENDOR_ID, idProduct = DEVICE_ID, find_all = True):
-			vendorName = usb.util.get_string(dev, 256, dev.iManufacturer)
-			deviceName = usb.util.get_string(dev, 256, dev.iProduct)
-
-			if vendorName == VENDOR_NAME and deviceName == DEVICE_NAME:
+		self._device = None
+		for info, dev in self._transport.findDevices():
+			if self._deviceId is None or info.deviceId == self._deviceId:
 				self._device = dev
+				self._deviceInfo = info
 				break
 
 		if self._device is None:
-			raise CommException("Geiger device not found")
+			if self._deviceId is None:
+				raise CommException("Geiger device not found")
+			raise CommException("Geiger device '%s' not found" % self._deviceId)
+
+	def getDeviceId(self):
+		"Returns the ID of the opened device."
+		return self._deviceInfo.deviceId
+
+	def getDeviceInfo(self):
+		"Returns DeviceInfo tuple describing the opened device."
+		return self._deviceInfo
+
+	def getTransport(self):
+		"Returns the transport the device is accessed by."
+		return self._transport
+
+	def setRetries(self, retries, delay = RETRY_DELAY):
+		"Sets how many times a failed transfer is repeated and the delay before the first repetition in seconds."
+		self._retries = max(0, int(retries))
+		self._retryDelay = delay
+
+	def getRecoveryStatistics(self):
+		"""Returns the dictionary with the numbers of: retry - repeated transfers, reopen and reset - recoveries done
+		by each of these methods, failed - recoveries which didn't find the device.
+		"""
+		with self._lock:
+			return dict(self._recoveries)
 
+	@tracing.traced('usb.reset')
 	def resetConnection(self):
 		"Forces the device to reset and discovers it one more time."
-		try:
-			self._device.reset()
-			usb.util.dispose_resources(self._device)
-		except usb.core.USBError:
-			pass
-		self._openDevice()
-
+		with self._lock:
+			if self._device is not None:
+				try:
+					self._transport.reset(self._device)
+				except TransportError:
+					pass
+			self._openDevice()
+
+	@tracing.traced('usb.recover')
+	def recover(self):
+		"""Restores the communication after an error, trying the cheaper way first: the device is reopened at its
+		known bus and address; if it isn't there or doesn't answer, it's reset and searched for among all devices.
+		Returns the way which worked: 'reopen' or 'reset'. If the device was plugged in again, it's found under a new
+		address, which getDeviceInfo() shows. Raises CommException if the device can't be found.
+		"""
+		with self._lock:
+			try:
+				device = self._transport.reopen(self._device, self._deviceInfo)
+				if device is not None:
+					self._device = device
+					self._transport.controlIn(self._device, GET_INTERVAL, 0, 2)
+					self._recoveries['reopen'] += 1
+					return 'reopen'
+			except TransportError:
+				pass
+
+			try:
+				self.resetConnection()
+				self._transport.controlIn(self._device, GET_INTERVAL, 0, 2)
+			except (CommException, TransportError) as e:
+				self._recoveries['failed'] += 1
+				raise CommException("device can't be recovered: " + str(e))
+			self._recoveries['reset'] += 1
+			return 'reset'
+
+	def _transfer(self, function, *args):
+		"Performs the transfer, repeating it after short delays if it fails."
+		attempt = 0
+		while True:
+			try:
+				with self._lock:
+					return function(self._device, *args)
+			except TransportError:
+				if attempt >= self._retries:
+					raise
+			time.sleep(self._retryDelay * 2 ** attempt)
+			attempt += 1
+			with self._lock:
+				self._recoveries['retry'] += 1
+
+	@tracing.traced('usb.send')
 	def _sendMessage(self, request, value):
 		if value > 0xffff:
 			raise CommException("device doesn't support values longer than two bytes")
 
-		requestType = usb.util.build_request_type(usb.util.ENDPOINT_OUT, usb.util.CTRL_TYPE_VENDOR, usb.util.CTRL_RECIPIENT_DEVICE)
 		try:
-			self._device.ctrl_transfer(requestType, request, value)
-		except usb.core.USBError:
+			self._transfer(self._transport.controlOut, request, value)
+		except TransportError:
 			raise CommException("error at communication with the device")
 
-	def _recvMessage(self, request):
-		requestType = usb.util.build_request_type(usb.util.ENDPOINT_IN, usb.util.CTRL_TYPE_VENDOR, usb.util.CTRL_RECIPIENT_DEVICE)
+	@tracing.traced('usb.receive')
+	def _recvRawMessage(self, request, length, value = 0):
 		try:
-			response = self._device.ctrl_transfer(requestType, request, 0, 0, 2)
-		except usb.core.USBError:
+			return self._transfer(self._transport.controlIn, request, value, length)
+		except TransportError:
 			raise CommException("error at receiving data from the device")
 
+	def _recvMessage(self, request):
+		response = self._recvRawMessage(request, 2)
+
 		if len(response) < 2:
 			raise CommException("device sent less than two bytes")
 
@@ -132,11 +440,59 @@ class RawConnector(object):
 		else:
 			return False
 
+	def getSnapshot(self, acknowledge = False):
+		"""Returns Snapshot tuple with CPI, raw interval, raw voltage and countAcknowledged flag. Newer firmware
+		sends them in one transfer, so CPI and interval always come from the same counting interval. On older
+		firmware, which answers GET_SNAPSHOT with no data, the values are read by separate requests.
+		The flag is cleared on the device only if acknowledge is True. Old firmware can't report the flag without
+		clearing it, so it's None there unless acknowledge is True.
+		"""
+		if self._snapshotSupported is not False:
+			response = self._recvRawMessage(GET_SNAPSHOT, SNAPSHOT_LENGTH, 1 if acknowledge else 0)
+			if len(response) >= SNAPSHOT_LENGTH:
+				self._snapshotSupported = True
+				cpi, rawInterval, rawVoltage, flag = struct.unpack(SNAPSHOT_FORMAT, bytearray(response[:SNAPSHOT_LENGTH]))
+				return Snapshot(float(cpi), rawInterval, rawVoltage, flag == 1)
+			elif self._snapshotSupported is None:
+				self._snapshotSupported = False
+			else:
+				raise CommException("device sent incomplete snapshot")
+
+		flag = self.isCountAcknowledged() if acknowledge else None
+		return Snapshot(self.getCPI(), self.getRawInterval(), self.getRawVoltage(), flag)
+
+	def getHistory(self, since = None):
+		"""Returns History tuple with the counts of the intervals completed after the one with sequence number 'since',
+		the oldest first, or all counts kept by the device if it's None. sequence is the number of the latest
+		interval; the numbers wrap at 256. lost is the number of intervals after 'since' which are no longer kept by
+		the device, so they're missing from counts. Returns None if the firmware doesn't keep the history.
+		"""
+		if self._historySupported is False:
+			return None
+
+		response = self._recvRawMessage(GET_HISTORY, HISTORY_HEADER_LENGTH + 2 * HISTORY_LENGTH,
+			HISTORY_ALL if since is None else since & 0xff)
+		if len(response) < HISTORY_HEADER_LENGTH:
+			if self._historySupported is None:
+				self._historySupported = False
+				return None
+			raise CommException("device sent incomplete history")
+		self._historySupported = True
+
+		response = bytearray(response)
+		sequence, count, rawInterval, rawVoltage = struct.unpack(HISTORY_HEADER_FORMAT, response[:HISTORY_HEADER_LENGTH])
+		if len(response) < HISTORY_HEADER_LENGTH + 2 * count:
+			raise CommException("device sent incomplete history")
+		counts = struct.unpack('<%dH' % count, response[HISTORY_HEADER_LENGTH:HISTORY_HEADER_LENGTH + 2 * count])
+		lost = ((sequence - since) & 0xff) - count if since is not None else 0
+		return History(sequence, list(counts), rawInterval, rawVoltage, lost)
+
 	def __str__(self):
 		"""Returns the string containing all data acquired from the device: actual voltage, current CPI
 		and countAcknowledged flag.
 		"""
-		return "CPI: " + str(self.getCPI()) + ", supply: " + str(self.getRawVoltage()) + ", count acknowledged: " + str(self.isCountAcknowledged())
+		snapshot = self.getSnapshot(acknowledge = True)
+		return "CPI: " + str(snapshot.cpi) + ", supply: " + str(snapshot.rawVoltage) + ", count acknowledged: " + str(snapshot.countAcknowledged)
 
 
 class Connector(RawConnector):
@@ -147,9 +503,11 @@ class Connector(RawConnector):
 	_tubeVoltage = TUBE_VOLTAGE
 	_configuration = None
 
-	def __init__(self, configuration = None):
-		"Optional parameter is ConfigParser instance."
-		super(Connector, self).__init__()
+	def __init__(self, configuration = None, deviceId = None, transport = None):
+		"""Optional parameters are ConfigParser instance, the ID of the device to open and the transport. The options
+		are read from the section 'device:<ID>' first, then from the common section 'device'.
+		"""
+		super(Connector, self).__init__(deviceId, transport)
 		if configuration is not None:
 			self._configuration = configuration
 
@@ -161,12 +519,23 @@ class Connector(RawConnector):
 
 			self._voltDividerFactor = lowerRes / (lowerRes + upperRes)
 
+			if self._hasOption('transfer_retries') or self._hasOption('retry_delay'):
+				self.setRetries(self._loadOption('transfer_retries', TRANSFER_RETRIES),
+					self._loadOption('retry_delay', RETRY_DELAY))
+
+	def _hasOption(self, option):
+		return (self._configuration.has_option('device:' + self.getDeviceId(), option)
+			or self._configuration.has_option('device', option))
+
 	def _loadOption(self, option, defaultValue):
+		deviceSection = 'device:' + self.getDeviceId()
 		try:
+			if self._configuration.has_option(deviceSection, option):
+				return self._configuration.getfloat(deviceSection, option)
 			return self._configuration.getfloat('device', option)
-		except ConfigParser.Error:
+		except (ConfigParser.Error, ValueError):
 			log = logging.getLogger("geiger.usbcomm")
-			log.error("Error at loading option '%s'. Assigning default value: %f", option, str(defaultValue))
+			log.error("Error at loading option '%s'. Assigning default value: %s", option, str(defaultValue))
 			return defaultValue
 
 	def setVoltageFromConfigFile(self):
@@ -179,9 +548,38 @@ class Connector(RawConnector):
 		radiation = self.getRadiation(cpm)
 		return (cpm, radiation)
 
-	def getCPM(self):
-		"Returns radiation in counts per minute."
-		return round(self.getCPI() / self.getInterval() * 60.0, 2)
+	def getMeasurement(self):
+		"""Returns Measurement tuple: CPM, radiation in uSv/h and the tube supply voltage in volts, all from one
+		snapshot of the device.
+		"""
+		snapshot = self.getSnapshot()
+		cpm = self.getCPM(snapshot)
+		return Measurement(cpm, self.getRadiation(cpm), self.getVoltage(snapshot))
+
+	def getMeasurements(self, since = None):
+		"""Returns the tuple: the sequence number of the latest interval, the list of Measurement tuples of
+		the intervals completed after 'since', the oldest first, and the number of intervals lost, see getHistory().
+		All of them come from one transfer. Returns None if the firmware doesn't keep the history.
+		"""
+		history = self.getHistory(since)
+		if history is None:
+			return None
+		seconds = history.rawInterval / float(TIMER_TICKS_PER_SECOND)
+		voltage = self.getVoltage(Snapshot(None, history.rawInterval, history.rawVoltage, None))
+		measurements = []
+		for count in history.counts:
+			cpm = round(count / seconds * 60.0, 2)
+			measurements.append(Measurement(cpm, self.getRadiation(cpm), voltage))
+		return (history.sequence, measurements, history.lost)
+
+	def getCPM(self, snapshot = None):
+		"Returns radiation in counts per minute. CPI and interval are taken from the snapshot if it's given."
+		if snapshot is None:
+			if self._snapshotSupported is False:
+				# two requests are cheaper than the full fallback snapshot
+				return round(self.getCPI() / self.getInterval() * 60.0, 2)
+			snapshot = self.getSnapshot()
+		return round(snapshot.cpi / (snapshot.rawInterval / TIMER_TICKS_PER_SECOND) * 60.0, 2)
 
 	def getRadiation(self, cpm = None):
 		"Returns radiation in uSv/h."
@@ -196,13 +594,14 @@ class Connector(RawConnector):
 
 	def setInterval(self, seconds):
 		"Sets the measuring interval in seconds."
-		if seconds < 1 or seconds > 0xffff / TIMER_TICKS_PER_SECOND:
-			raise CommException("interval has to be between 1 and " + str(0xffff / TIMER_TICKS_PER_SECOND) + " seconds")
+		if seconds < 1 or seconds > MAX_INTERVAL:
+			raise CommException("interval has to be between 1 and " + str(MAX_INTERVAL) + " seconds")
 		self.setRawInterval(TIMER_TICKS_PER_SECOND * seconds)
 
-	def getVoltage(self):
-		"Returns the measured Geiger tube supply voltage in volts."
-		return int(round(1.1 * self.getRawVoltage() / (self._voltDividerFactor * 1024.0)))
+	def getVoltage(self, snapshot = None):
+		"Returns the measured Geiger tube supply voltage in volts. The raw value is taken from the snapshot if it's given."
+		rawVoltage = self.getRawVoltage() if snapshot is None else snapshot.rawVoltage
+		return int(round(1.1 * rawVoltage / (self._voltDividerFactor * 1024.0)))
 
 	def setVoltage(self, volts):
 		"Sets the desired Geiger tube supply voltage in volts."
@@ -214,4 +613,34 @@ class Connector(RawConnector):
 	def __str__(self):
 		"Returns a string containing all data from the device: CPM, current radioactivity, voltage etc."
 
-		return "Radiation: " + str(self.getRadiation()) + " uS/h, CPM: " + str(self.getCPM()) + " int. " + str(self.getInterval()) + " s, supply: " + str(self.getVoltage()) + " V, count acknowledged: " + str(self.isCountAcknowledged())
+		snapshot = self.getSnapshot(acknowledge = True)
+		cpm = self.getCPM(snapshot)
+		return "Radiation: " + str(self.getRadiation(cpm)) + " uS/h, CPM: " + str(cpm) + " int. " + str(snapshot.rawInterval / TIMER_TICKS_PER_SECOND) + " s, supply: " + str(self.getVoltage(snapshot)) + " V, count acknowledged: " + str(snapshot.countAcknowledged)
+
+
+def selectedDeviceIds(configuration):
+	"""Returns the list of IDs of the devices chosen by the option 'devices' in section 'device'. The option contains
+	IDs separated by semicolons or the word 'all', which is the default.
+	"""
+	try:
+		selection = configuration.get('device', 'devices').strip()
+	except ConfigParser.Error:
+		selection = 'all'
+
+	available = [info.deviceId for info in listDevices()]
+
+	if selection == '' or selection == 'all':
+		return available
+
+	wanted = [deviceId.strip() for deviceId in selection.split(';') if deviceId.strip() != '']
+	missing = [deviceId for deviceId in wanted if deviceId not in available]
+	if len(missing) > 0:
+		raise CommException("Geiger devices not found: " + ', '.join(missing))
+	return wanted
+
+def openConnectors(configuration):
+	"Returns the list of Connector instances, one for each device selected in the configuration file."
+	deviceIds = selectedDeviceIds(configuration)
+	if len(deviceIds) == 0:
+		raise CommException("Geiger device not found")
+	return [Connector(configuration, deviceId) for deviceId in deviceIds]